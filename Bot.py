@@ -1,6 +1,7 @@
 import asyncio
 import logging
 import sqlite3
+import time
 from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import CommandStart, Command
@@ -10,17 +11,23 @@ import requests
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from rag_handler import RAGHandler
+from async_rag import AsyncRAG, RAGOverloaded
 from rag_trainer import RAGTrainer
+from model_registry import DEFAULT_MODEL
 import os
 from pathlib import Path
 import uuid
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
+STARTUP_TIME = time.monotonic()
 
-# Инициализация RAG и RAGTrainer в начале файла
-rag = RAGHandler()
+# RAG (модель и база знаний) создаётся в init_rag; обработчики перед обращением к нему ждут wait_for_rag()
+rag = None
+# Синхронные вызовы RAG выполняются в пуле потоков, чтобы не останавливать диспетчер
+rag_async = None
 rag_trainer = RAGTrainer()
+rag_ready = None
 
 GENERAL_QUESTIONS = {
     "как дела": "🌟 Всё отлично, спасибо! Готов помочь с вопросами о питании и здоровье! 😊",
@@ -40,6 +47,20 @@ TOKEN = '7705327980:AAHxGu09YYsvDsrjq_Ff-bGg-l4bb7x3wRU'
 ADMIN_ID = 753655653
 DATABASE_NAME = 'nutrition_bot.db'
 LOCAL_LLM_URL = "http://localhost:11434/api/generate"
+# True — опрос Telegram начинается сразу, а модель и база знаний готовятся в фоне
+RAG_BACKGROUND_STARTUP = True
+# Периодичность фонового обслуживания базы знаний (чистка, слияние дублей, уплотнение, VACUUM)
+COMPACTION_INTERVAL_HOURS = 24
+# Переранжирование найденного контекста кросс-энкодером (CPU) с бюджетом времени на запрос
+RAG_RERANK = False
+RAG_RERANK_BUDGET_MS = 300
+# Запросы с темами (сон, стресс, ЖКТ...) ищутся только по тематическим шардам базы и общему шарду.
+# Выключено, пока bench_retrieval.py не покажет, что recall@k с шардами не падает
+RAG_TOPIC_ROUTING = False
+# ANN-индекс для большой базы знаний: None — точный поиск по всей матрице, "hnsw" (нужен hnswlib) или "ivf"
+RAG_INDEX_BACKEND = None
+# Модель векторизации; если база построена другой моделью, она переводится на эту фоновой переиндексацией
+EMBEDDING_MODEL = DEFAULT_MODEL
 
 # Инициализация базы данных
 def init_db():
@@ -97,6 +118,92 @@ logger = logging.getLogger(__name__)
 # Инициализация бота
 bot = Bot(token=TOKEN)
 dp = Dispatcher()
+first_update_logged = False
+
+
+@dp.update.outer_middleware()
+async def log_first_update(handler, event, data):
+    global first_update_logged
+    if not first_update_logged:
+        first_update_logged = True
+        rag_state = "готов" if rag_ready is not None and rag_ready.done() else "ещё загружается"
+        logger.info(f"Первое обновление через {time.monotonic() - STARTUP_TIME:.1f} с после запуска, RAG {rag_state}")
+    return await handler(event, data)
+
+
+def create_rag():
+    """Тяжёлая часть запуска: загрузка модели и подготовка базы знаний (выполняется в отдельном потоке)"""
+    handler = RAGHandler(model_name=EMBEDDING_MODEL, persist_query_cache=True, rerank=RAG_RERANK,
+                         rerank_budget_ms=RAG_RERANK_BUDGET_MS, topic_routing=RAG_TOPIC_ROUTING,
+                         index_backend=RAG_INDEX_BACKEND)
+    handler.optimize_knowledge_base()
+    return handler
+
+
+async def init_rag():
+    global rag, rag_async
+    try:
+        handler = await asyncio.get_running_loop().run_in_executor(None, create_rag)
+    except Exception as e:
+        logger.error(f"Ошибка инициализации RAG: {e}")
+        rag_ready.set_exception(e)
+        return
+    rag = handler
+    # Запросы к Ollama идут в своём пуле (llm_workers) и не занимают потоки поиска
+    rag_async = AsyncRAG(rag, max_workers=4, max_pending=32, llm_workers=4)
+    rag_trainer.rag = rag
+    rag_trainer.rag_async = rag_async
+    rag_ready.set_result(rag)
+    logger.info(f"RAG готов через {time.monotonic() - STARTUP_TIME:.1f} с после запуска")
+
+
+async def wait_for_rag():
+    await asyncio.shield(rag_ready)
+
+
+# Фоновые задачи держатся здесь до завершения, иначе цикл событий может собрать их сборщиком мусора
+background_tasks = set()
+
+
+def remember_approved_answer(question, answer):
+    """Сохраняет одобренный ответ в базу знаний и кэш ответов в фоне, после отправки пользователю:
+    загрузка RAG, переполненный пул или занятая база не задерживают ответ, а ошибка только логируется"""
+    async def remember():
+        try:
+            await wait_for_rag()
+            await rag_async.remember_answer(question, answer, approved=True)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить одобренный ответ в кэш ответов: {e}")
+
+    task = asyncio.create_task(remember())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+def format_compaction_report(report):
+    return (f"🧹 Обслуживание базы знаний за {report['seconds']} с:\n"
+            f"• удалено редко используемых записей: {report['pruned']}\n"
+            f"• слито почти одинаковых записей: {report['merged']}\n"
+            f"• удалено из кэша ответов: {report['answer_cache']}, из журнала изменений: {report['changelog']}\n"
+            f"• освобождено строк в файле векторов: {report['vector_rows']}\n"
+            f"• освобождено в файле базы: {report['freed_bytes'] / 1024:.0f} КБ")
+
+
+async def compaction_loop():
+    """Раз в COMPACTION_INTERVAL_HOURS обслуживает базу знаний в пуле потоков RAG, не блокируя обработчики"""
+    try:
+        await wait_for_rag()
+    except Exception:
+        return
+    while True:
+        await asyncio.sleep(COMPACTION_INTERVAL_HOURS * 3600)
+        try:
+            report = await rag_async.run(rag.compact_knowledge_base)
+            logger.info(format_compaction_report(report))
+        except RAGOverloaded:
+            logger.warning("Обслуживание базы знаний отложено: очередь RAG переполнена")
+        except Exception as e:
+            logger.error(f"Ошибка обслуживания базы знаний: {e}")
 
 # Временное хранилище запросов
 pending_requests = {}
@@ -296,7 +403,7 @@ async def send_media_with_caption(chat_id, file_id, caption, is_photo, reply_to_
             )
 
 
-async def generate_ai_response(prompt):
+async def generate_ai_response(prompt, use_cache=True):
     # Проверяем, является ли запрос общим
     prompt_lower = prompt.lower().strip()
 
@@ -330,15 +437,18 @@ async def generate_ai_response(prompt):
                 }
                 response = requests.post(LOCAL_LLM_URL, headers=headers, json=data)
                 response.raise_for_status()
-                return response.json().get("response", "Не удалось получить ответ от модели.")
+                # Пустой ответ или ошибка не сохраняются в базу знаний и кэш ответов
+                return response.json().get("response")
             except Exception as e:
                 logger.error(f"Ошибка при генерации ответа AI: {e}")
-                return "Извините, я не смог обработать ваш запрос из-за технической ошибки."
-
-        rag_response = rag.generate_rag_response(prompt, local_llm_generate)
-        if "Недостаточно информации" not in rag_response:
-            rag.add_to_knowledge_base(prompt, rag_response)
-        return rag_response
+                return None
+
+        await wait_for_rag()
+        # Перегенерация администратором (use_cache=False) не пишет черновик в базу знаний и кэш ответов
+        return await rag_async.generate_rag_response(prompt, local_llm_generate, use_cache=use_cache,
+                                                     remember=use_cache)
+    except RAGOverloaded:
+        return "⏳ Сейчас очень много вопросов. Пожалуйста, повторите запрос через минуту."
     except Exception as e:
         logger.error(f"Ошибка при генерации ответа с RAG: {e}")
         return "Извините, я не смог найти информацию по вашему запросу."
@@ -659,7 +769,7 @@ async def handle_test_query(message: Message, state: FSMContext):
     if message.from_user.id != ADMIN_ID:
         return
 
-    response = await generate_ai_response(message.text)
+    response = await generate_ai_response(message.text, use_cache=False)
     await message.answer(f"Ответ бота:\n{response}")
     await state.clear()
     admin_keyboard = ReplyKeyboardMarkup(
@@ -677,7 +787,8 @@ async def cmd_check_knowledge(message: Message):
         await message.answer("Эта команда доступна только администратору.")
         return
 
-    entries = rag.get_recent_entries()
+    await wait_for_rag()
+    entries = await rag_async.run(rag.get_recent_entries)
     if not entries:
         await message.answer("База знаний пуста.")
         return
@@ -732,8 +843,9 @@ async def handle_media(message: types.Message, state: FSMContext):
     loading_message, loading_task = await show_loading_indicator(message)
 
     try:
-        # Генерация ответа
-        bot_text = await generate_ai_response(prompt)
+        # Генерация ответа. Вектор запроса определяет шаблон промпта, а не описание, поэтому семантический
+        # кэш ответов не используется и ответ в него не пишется (use_cache=False)
+        bot_text = await generate_ai_response(prompt, use_cache=False)
         if not bot_text:
             await bot.edit_message_text(
                 chat_id=loading_message.chat.id,
@@ -895,6 +1007,7 @@ async def handle_training_file_upload(message: Message, state: FSMContext):
 
     if (file_type == "pdf" and file_ext == ".pdf") or (file_type == "txt" and file_ext == ".txt"):
         try:
+            await wait_for_rag()
             result = await rag_trainer.process_training_file(message, bot, generate_qa=False)
             if "Ошибка" in result:
                 back_keyboard = ReplyKeyboardMarkup(
@@ -1179,6 +1292,8 @@ async def approve_original(callback: types.CallbackQuery):
                     reply_to_message_id=message_id,
                     reply_markup=return_keyboard if i + 4096 >= len(bot_text) else None
                 )
+        # Одобренный экспертом ответ отдаётся из семантического кэша без ограничения по времени
+        remember_approved_answer(request_data.get("question", ""), bot_text)
 
         await callback.message.edit_text(
             text=callback.message.text + "\n\n✅ Ответ отправлен в чат без изменений",
@@ -1522,7 +1637,7 @@ async def handle_ai_refinement(message: Message, state: FSMContext):
               f"Инструкции эксперта по редактированию ответа: {instructions}\n\n"
               f"Пожалуйста, переформулируй ответ согласно инструкциям, сохраняя профессиональный тон.")
 
-    new_answer = await generate_ai_response(prompt)
+    new_answer = await generate_ai_response(prompt, use_cache=False)
     if not new_answer:
         await message.answer("Ошибка при генерации ответа. Пожалуйста, попробуйте еще раз.")
         return
@@ -1570,7 +1685,7 @@ async def handle_new_query(message: Message, state: FSMContext):
         "Ориентируйся только на указания эксперта и не используй предыдущий ответ бота."
     )
 
-    new_answer = await generate_ai_response(prompt)
+    new_answer = await generate_ai_response(prompt, use_cache=False)
     if not new_answer:
         await message.reply("Ошибка при генерации нового ответа. Пожалуйста, попробуйте еще раз.")
         return
@@ -1644,6 +1759,7 @@ async def handle_admin_edit(message: Message, state: FSMContext):
         )
 
         update_learning_data(request_data.get("question", ""), message.text)
+        remember_approved_answer(request_data.get("question", ""), message.text)
 
         await message.reply(f"✅ Отредактированный ответ отправлен в чат для пользователя {user_id}")
 
@@ -1661,6 +1777,8 @@ async def cmd_check_db(message: Message):
         await message.answer("Эта команда доступна только администратору.")
         return
 
+    await wait_for_rag()
+    await rag_async.run(rag.flush_usage_counts)
     conn = sqlite3.connect(DATABASE_NAME)
     cursor = conn.cursor()
     cursor.execute("SELECT question, answer, usage_count FROM knowledge_vectors ORDER BY last_used DESC LIMIT 5")
@@ -1683,6 +1801,8 @@ async def cmd_rag_stats(message: Message):
         return
 
     try:
+        await wait_for_rag()
+        await rag_async.run(rag.flush_usage_counts)
         conn = sqlite3.connect(DATABASE_NAME)
         cursor = conn.cursor()
 
@@ -1712,6 +1832,46 @@ async def cmd_rag_stats(message: Message):
             question_text = question[:50] + "..." if question and len(question) > 50 else question or "Без вопроса"
             stats_text.append(f"{i}. {question_text} - {count} раз")
 
+        cache_stats = rag.query_cache.stats()
+        stats_text.extend([
+            "",
+            f"⚡ <b>Кэш векторов запросов:</b> {cache_stats['size']}/{cache_stats['max_size']}, "
+            f"попаданий {cache_stats['hits']}, промахов {cache_stats['misses']} ({cache_stats['hit_rate']:.0%})"
+        ])
+        chunk_stats = rag.chunk_embedding_stats()
+        stats_text.append(
+            f"📄 <b>Векторы чанков:</b> уже в базе {chunk_stats['reused']}, закодировано {chunk_stats['encoded']} "
+            f"({chunk_stats['reuse_rate']:.0%} без модели)"
+        )
+        reembed_status = rag.reembed_status()
+        stats_text.append(f"🧬 <b>Модель векторов:</b> {rag.model_name}")
+        if reembed_status is not None:
+            stats_text.append(
+                f"🔄 <b>Переиндексация</b> моделью {reembed_status['model']}: {reembed_status['state']}, "
+                f"{reembed_status['embedded']}/{reembed_status['total']}"
+                + (f" ({reembed_status['error']})" if reembed_status['error'] else "")
+            )
+        if rag.topic_routing:
+            routing_stats = rag.topic_routing_stats()
+            stats_text.append(
+                f"🧭 <b>Тематические шарды:</b> запросов {routing_stats['routed']}, "
+                f"оценено в среднем {routing_stats['fraction']:.0%} базы, "
+                f"пересчитано по всей базе {routing_stats['fallback']}"
+            )
+        if rag.reranker is not None:
+            rerank_stats = rag.reranker.stats()
+            stats_text.append(
+                f"🎯 <b>Переранжирование:</b> {'готово' if rerank_stats['ready'] else 'модель загружается'}, "
+                f"выполнено {rerank_stats['reranked']}, по порядку би-энкодера {rerank_stats['fallbacks']}"
+            )
+        if rag.answer_cache is not None:
+            answer_stats = rag.answer_cache.stats()
+            stats_text.append(
+                f"💬 <b>Кэш ответов:</b> {answer_stats['entries']} записей (одобрено {answer_stats['approved']}), "
+                f"попаданий {answer_stats['hits']}, промахов {answer_stats['misses']} ({answer_stats['hit_rate']:.0%}), "
+                f"в обход {answer_stats['bypassed']}, всего попаданий {answer_stats['total_hits']}"
+            )
+
         conn.close()
         await message.answer("\n".join(stats_text), parse_mode="HTML")
         logger.info("RAG статистика успешно отправлена")
@@ -1723,6 +1883,68 @@ async def cmd_rag_stats(message: Message):
         logger.error(f"Ошибка при получении RAG статистики: {e}")
         await message.answer("⚠️ Произошла ошибка при получении статистики RAG.")
 
+@dp.message(Command("topic_masks"))
+async def cmd_topic_masks(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    try:
+        await wait_for_rag()
+        updated = await rag_async.run(rag.backfill_topic_masks, force=True)
+        await message.answer(f"Тематические маски пересчитаны для {updated} записей.")
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка базы данных при пересчёте тематических масок: {e}")
+        await message.answer("⚠️ Ошибка базы данных при пересчёте тематических масок.")
+
+@dp.message(Command("compact"))
+async def cmd_compact(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    await message.answer("⏳ Обслуживание базы знаний запущено...")
+    try:
+        await wait_for_rag()
+        report = await rag_async.run(rag.compact_knowledge_base)
+        await message.answer(format_compaction_report(report))
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка базы данных при обслуживании базы знаний: {e}")
+        await message.answer("⚠️ Ошибка базы данных при обслуживании базы знаний.")
+
+@dp.message(Command("vacuum"))
+async def cmd_vacuum(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    await message.answer("⏳ Полный VACUUM базы: на время его работы запись в базу блокируется...")
+    try:
+        await wait_for_rag()
+        freed = await rag_async.run(rag.enable_incremental_vacuum)
+        await message.answer(f"✅ Включён режим incremental vacuum, освобождено {freed / 1024:.0f} КБ. "
+                             f"Дальше свободные страницы возвращаются при плановом обслуживании.")
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка базы данных при VACUUM: {e}")
+        await message.answer("⚠️ Ошибка базы данных при VACUUM.")
+
+@dp.message(Command("reembed"))
+async def cmd_reembed(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        await message.answer("Эта команда доступна только администратору.")
+        return
+
+    await wait_for_rag()
+    try:
+        # Перезапуск (например, после ошибки) переиндексации моделью EMBEDDING_MODEL; загрузка модели
+        # и переиндексация идут в отдельном потоке, бот продолжает отвечать старой моделью
+        rag.start_reembedding(EMBEDDING_MODEL)
+    except (RuntimeError, ValueError) as e:
+        await message.answer(f"⚠️ {e}")
+        return
+    await message.answer(f"🔄 Переиндексация базы моделью {EMBEDDING_MODEL} запущена. "
+                         f"До её завершения поиск идёт моделью {rag.model_name}; ход — в /rag_stats.")
+
 @dp.message(Command("train"))
 async def cmd_train(message: Message):
     if message.from_user.id != ADMIN_ID:
@@ -1791,9 +2013,27 @@ async def handle_admin_stats_buttons(message: Message):
 
 # ========== Запуск бота ==========
 async def main():
-    rag.optimize_knowledge_base()
+    global rag_ready
+    rag_ready = asyncio.get_running_loop().create_future()
+    init_task = asyncio.create_task(init_rag())
+    if not RAG_BACKGROUND_STARTUP:
+        await init_task
+    compaction_task = asyncio.create_task(compaction_loop())
     await bot(DeleteWebhook(drop_pending_updates=True))
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        compaction_task.cancel()
+        await init_task
+        # Дописываем одобренные ответы, отправленные перед остановкой
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        if rag is not None:
+            rag_async.shutdown()
+            if rag.reranker is not None:
+                rag.reranker.shutdown()
+            rag.usage_buffer.stop()
+            rag.save_ann_index()
+            rag.save_query_cache()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
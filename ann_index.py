@@ -0,0 +1,323 @@
+import os
+import json
+import logging
+import argparse
+from typing import Optional
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+logger = logging.getLogger(__name__)
+
+
+class HNSWIndex:
+    """Граф HNSW (hnswlib) по скалярному произведению нормированных векторов; метки — id из knowledge_vectors"""
+    kind = "hnsw"
+    file_suffix = ".hnsw"
+
+    def __init__(self, dim: int, M: int = 16, ef_construction: int = 200, ef_search: int = 64):
+        if hnswlib is None:
+            raise ImportError("Для HNSW-индекса нужен пакет hnswlib (pip install hnswlib)")
+        self.dim = dim
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.index = None
+        self.deleted_count = 0
+
+    def params(self) -> dict:
+        return {"M": self.M, "ef_construction": self.ef_construction, "ef_search": self.ef_search}
+
+    def state(self) -> dict:
+        return {"deleted_count": self.deleted_count}
+
+    def build(self, vectors: np.ndarray, ids: np.ndarray):
+        self.index = hnswlib.Index(space="ip", dim=self.dim)
+        self.index.init_index(max_elements=max(len(ids), 1), M=self.M, ef_construction=self.ef_construction)
+        if len(ids):
+            self.index.add_items(vectors, ids)
+        self.index.set_ef(self.ef_search)
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        """Вставка и обновление по id; ёмкость графа растёт удвоением"""
+        needed = self.index.get_current_count() + len(ids)
+        if needed > self.index.get_max_elements():
+            self.index.resize_index(max(needed, 2 * self.index.get_max_elements()))
+        self.index.add_items(vectors, ids)
+
+    def remove(self, ids):
+        for vec_id in ids:
+            try:
+                self.index.mark_deleted(int(vec_id))
+                self.deleted_count += 1
+            except RuntimeError:
+                pass
+
+    def search(self, query: np.ndarray, k: int) -> np.ndarray:
+        count = self.index.get_current_count() - self.deleted_count
+        if count <= 0:
+            return np.zeros(0, dtype=np.int64)
+        k = min(k, count)
+        self.index.set_ef(max(self.ef_search, k))
+        labels, _ = self.index.knn_query(query, k=k)
+        return labels[0].astype(np.int64)
+
+    def save(self, path: str):
+        self.index.save_index(path)
+
+    def load(self, path: str, meta: dict):
+        self.index = hnswlib.Index(space="ip", dim=self.dim)
+        self.index.load_index(path)
+        self.index.set_ef(self.ef_search)
+        self.deleted_count = meta.get("deleted_count", 0)
+
+
+class IVFIndex:
+    """Инвертированный индекс (IVF): сферический k-means по центроидам, поиск по nprobe ближайшим спискам"""
+    kind = "ivf"
+    file_suffix = ".ivf.npz"
+
+    def __init__(self, dim: int, nlist: Optional[int] = None, nprobe: int = 8, train_iterations: int = 10):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_iterations = train_iterations
+        self.centroids = np.zeros((0, dim), dtype=np.float32)
+        self.list_offsets = np.zeros(1, dtype=np.int64)
+        self.list_ids = np.zeros(0, dtype=np.int64)
+        # Вставки после построения: номер списка -> id; сливаются в list_ids при сохранении
+        self.pending = {}
+
+    def params(self) -> dict:
+        return {"nlist": self.nlist, "nprobe": self.nprobe}
+
+    def state(self) -> dict:
+        return {}
+
+    def build(self, vectors: np.ndarray, ids: np.ndarray):
+        n = len(ids)
+        if not n:
+            return
+        nlist = self.nlist or max(1, int(4 * np.sqrt(n)))
+        nlist = min(nlist, n)
+        rng = np.random.default_rng(0)
+        sample = vectors[rng.choice(n, size=min(n, nlist * 64), replace=False)]
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+        for _ in range(self.train_iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(nlist):
+                members = sample[assign == c]
+                if len(members):
+                    centroid = members.sum(axis=0)
+                    norm = np.linalg.norm(centroid)
+                    if norm > 0:
+                        centroids[c] = centroid / norm
+
+        assign = np.empty(n, dtype=np.int64)
+        for start in range(0, n, 65536):
+            assign[start:start + 65536] = np.argmax(vectors[start:start + 65536] @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        self.centroids = centroids.astype(np.float32)
+        self.list_ids = ids[order].astype(np.int64)
+        self.list_offsets = np.concatenate(([0], np.cumsum(np.bincount(assign, minlength=nlist)))).astype(np.int64)
+        self.nlist = nlist
+
+    def add(self, vectors: np.ndarray, ids: np.ndarray):
+        """Новая запись попадает в список ближайшего центроида; центроиды не переобучаются"""
+        if not len(self.centroids):
+            self.build(vectors, ids)
+            return
+        for c, vec_id in zip(np.argmax(vectors @ self.centroids.T, axis=1), ids):
+            self.pending.setdefault(int(c), []).append(int(vec_id))
+
+    def remove(self, ids):
+        # Удалённые id отбрасывает VectorStore.positions_for_ids, из списков они уходят при перестроении
+        pass
+
+    def search(self, query: np.ndarray, k: int) -> np.ndarray:
+        """Возвращает id всех записей из nprobe ближайших списков; точные оценки считает вызывающий код"""
+        if not len(self.centroids):
+            return np.zeros(0, dtype=np.int64)
+        nprobe = min(self.nprobe, len(self.centroids))
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        parts = []
+        for c in probe:
+            parts.append(self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]])
+            if int(c) in self.pending:
+                parts.append(np.array(self.pending[int(c)], dtype=np.int64))
+        return np.concatenate(parts)
+
+    def _merge_pending(self):
+        if not self.pending:
+            return
+        nlist = len(self.centroids)
+        lists = [list(self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]]) + self.pending.get(c, [])
+                 for c in range(nlist)]
+        self.list_ids = np.array([vec_id for ids in lists for vec_id in ids], dtype=np.int64)
+        self.list_offsets = np.concatenate(([0], np.cumsum([len(ids) for ids in lists]))).astype(np.int64)
+        self.pending = {}
+
+    def save(self, path: str):
+        self._merge_pending()
+        with open(path, "wb") as f:
+            np.savez(f, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids)
+
+    def load(self, path: str, meta: dict):
+        data = np.load(path)
+        self.centroids = data["centroids"]
+        self.list_offsets = data["list_offsets"]
+        self.list_ids = data["list_ids"]
+        self.nlist = len(self.centroids)
+
+
+ANN_BACKENDS = {HNSWIndex.kind: HNSWIndex, IVFIndex.kind: IVFIndex}
+
+
+class ANNIndex:
+    """Сменный ANN-индекс рядом с файлом базы (nutrition_bot.db.hnsw / nutrition_bot.db.ivf.npz).
+
+    Рядом лежит <файл индекса>.meta.json с числом записей и номером журнала knowledge_changes, до которого
+    индекс доведён. Изменения базы применяются к индексу инкрементально (apply_changes, catch_up); если догнать
+    журнал нельзя, индекс считается устаревшим и поиск идёт точным перебором.
+    """
+
+    def __init__(self, db_path: str, backend: str = "hnsw", **params):
+        if backend not in ANN_BACKENDS:
+            raise ValueError(f"Неизвестный тип ANN-индекса: {backend}")
+        self.backend = backend
+        self.params = params
+        self.path = db_path + ANN_BACKENDS[backend].file_suffix
+        self.meta_path = self.path + ".meta.json"
+        self.impl = None
+        self.meta = None
+
+    def _new_impl(self, dim: int):
+        return ANN_BACKENDS[self.backend](dim, **self.params)
+
+    @staticmethod
+    def _fingerprint(store) -> dict:
+        return {"count": store.live_count, "last_seq": store.last_seq, "dim": store.dim, "model": store.model_name}
+
+    def build(self, store):
+        self.impl, self.meta = self.build_snapshot(*self.snapshot(store))
+
+    @classmethod
+    def snapshot(cls, store):
+        """Копия живых векторов store, их id и отпечаток: по снимку индекс строится без блокировки матрицы"""
+        live = store.positions_for_ids(list(store.id_to_pos))
+        return store.matrix[live], store.ids[live], cls._fingerprint(store)
+
+    def build_snapshot(self, vectors: np.ndarray, ids: np.ndarray, fingerprint: dict):
+        """Новый индекс (impl, meta) по снимку; текущий индекс не меняется"""
+        impl = self._new_impl(fingerprint["dim"])
+        impl.build(vectors, ids)
+        logger.info(f"Построен ANN-индекс {self.backend}: {len(ids)} векторов")
+        return impl, {"backend": self.backend, "params": impl.params(), **fingerprint}
+
+    def write_staged(self, impl, meta):
+        """Записывает ещё не подключённый индекс рядом с рабочими файлами (*.tmp); install_staged их подменяет"""
+        impl.save(self.path + ".tmp")
+        with open(self.meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(dict(meta, **impl.state()), f)
+
+    def install_staged(self, impl, meta):
+        """Подключает индекс, построенный build_snapshot и записанный write_staged"""
+        os.replace(self.path + ".tmp", self.path)
+        os.replace(self.meta_path + ".tmp", self.meta_path)
+        self.impl = impl
+        self.meta = dict(meta, **impl.state())
+
+    def discard_staged(self):
+        for path in (self.path + ".tmp", self.meta_path + ".tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def apply_changes(self, store, upserted, removed):
+        """Переносит в индекс изменения, уже применённые к store; индекс должен был быть актуален до них"""
+        positions = store.positions_for_ids(upserted)
+        if len(positions):
+            self.impl.add(store.matrix[positions], store.ids[positions])
+        if removed:
+            self.impl.remove(removed)
+        self.meta.update(self._fingerprint(store))
+
+    def catch_up(self, store) -> bool:
+        """Догоняет журнал изменений с момента сохранения индекса до состояния store"""
+        if self.impl is None or self.meta.get("dim") != store.dim:
+            return False
+        # Индексы, сохранённые до появления метаданных модели, построены единственной тогда моделью
+        self.meta.setdefault("model", store.model_name)
+        if self.meta["model"] != store.model_name:
+            return False
+        since_seq = self.meta.get("last_seq", 0)
+        if since_seq != store.last_seq:
+            changed = store.changed_ids(store.db_path, since_seq)
+            if changed is None:
+                return False
+            upserted, removed, _ = changed
+            self.apply_changes(store, upserted, removed)
+            logger.info(f"ANN-индекс догнал журнал: +{len(upserted)} / -{len(removed)} записей")
+        return self.is_fresh(store)
+
+    def save(self):
+        self.impl.save(self.path)
+        self.meta.update(self.impl.state())
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        logger.info(f"ANN-индекс сохранён: {self.path}")
+
+    def load(self) -> bool:
+        if not (os.path.exists(self.path) and os.path.exists(self.meta_path)):
+            logger.info(f"ANN-индекс не найден: {self.path}")
+            return False
+        try:
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            impl = self._new_impl(meta["dim"])
+            impl.load(self.path, meta)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки ANN-индекса {self.path}: {e}")
+            return False
+        self.impl = impl
+        self.meta = meta
+        logger.info(f"Загружен ANN-индекс {self.backend}: {meta['count']} векторов")
+        return True
+
+    def is_fresh(self, store) -> bool:
+        if self.impl is None or self.meta is None:
+            return False
+        fingerprint = self._fingerprint(store)
+        return all(self.meta.get(key) == value for key, value in fingerprint.items())
+
+    def search(self, query: np.ndarray, k: int) -> np.ndarray:
+        return self.impl.search(query, k)
+
+
+def main():
+    from vector_store import VectorStore
+
+    parser = argparse.ArgumentParser(description="Построение ANN-индекса по векторам knowledge_vectors")
+    parser.add_argument("--db", default="nutrition_bot.db")
+    parser.add_argument("--backend", choices=sorted(ANN_BACKENDS), default="hnsw")
+    parser.add_argument("--M", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--nlist", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    store = VectorStore()
+    store.load(args.db)
+    if args.backend == "hnsw":
+        params = {"M": args.M, "ef_construction": args.ef_construction}
+    else:
+        params = {"nlist": args.nlist}
+    index = ANNIndex(args.db, args.backend, **params)
+    index.build(store)
+    index.save()
+
+
+if __name__ == "__main__":
+    main()
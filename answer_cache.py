@@ -0,0 +1,106 @@
+import sqlite3
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Записи (question, answer) из knowledge_vectors, которые можно отдавать без обращения к LLM
+ANSWER_CACHE_SCHEMA = '''CREATE TABLE IF NOT EXISTS answer_cache (
+                    row_id INTEGER PRIMARY KEY,
+                    answered_at DATETIME NOT NULL,
+                    approved BOOLEAN DEFAULT 0,
+                    hits INTEGER DEFAULT 0,
+                    last_hit DATETIME)'''
+
+
+class AnswerCache:
+    """Семантический кэш ответов поверх пар вопрос-ответ из knowledge_vectors.
+
+    Если сохранённый вопрос ближе к запросу, чем threshold, его ответ возвращается сразу. Одобренные
+    экспертом ответы живут, пока их не вытеснит лимит max_entries; остальные — ttl_hours с момента генерации.
+    При переполнении первыми вытесняются неодобренные записи с наименьшим числом попаданий.
+    """
+
+    def __init__(self, db_path: str, threshold: float = 0.92, ttl_hours: float = 72, max_entries: int = 5000):
+        self.db_path = db_path
+        self.threshold = threshold
+        self.ttl = timedelta(hours=ttl_hours)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    @staticmethod
+    def init_schema(cursor):
+        cursor.execute(ANSWER_CACHE_SCHEMA)
+
+    def remember(self, cursor, row_id: int, approved: bool = False):
+        """Отмечает ответ записи row_id как только что полученный; новый ответ сбрасывает одобрение"""
+        cursor.execute('''INSERT INTO answer_cache (row_id, answered_at, approved) VALUES (?, ?, ?)
+                        ON CONFLICT(row_id) DO UPDATE SET answered_at = excluded.answered_at,
+                                                          approved = excluded.approved''',
+                       (row_id, datetime.now().isoformat(), int(approved)))
+
+    @staticmethod
+    def is_approved(cursor, question: str) -> bool:
+        """Есть ли одобренный экспертом ответ на вопрос question"""
+        cursor.execute('''SELECT 1 FROM answer_cache c JOIN knowledge_vectors k ON k.id = c.row_id
+                        WHERE k.question = ? AND c.approved = 1 LIMIT 1''', (question,))
+        return cursor.fetchone() is not None
+
+    def prune(self, cursor) -> int:
+        cutoff = (datetime.now() - self.ttl).isoformat()
+        cursor.execute('DELETE FROM answer_cache WHERE approved = 0 AND answered_at < ?', (cutoff,))
+        removed = cursor.rowcount
+        cursor.execute('DELETE FROM answer_cache WHERE row_id NOT IN (SELECT id FROM knowledge_vectors)')
+        removed += cursor.rowcount
+        cursor.execute('''DELETE FROM answer_cache WHERE row_id IN (
+                            SELECT row_id FROM answer_cache
+                            ORDER BY approved DESC, hits DESC, COALESCE(last_hit, answered_at) DESC
+                            LIMIT -1 OFFSET ?)''', (self.max_entries,))
+        removed += cursor.rowcount
+        return removed
+
+    def lookup(self, candidates: List[Tuple[int, float]]) -> Optional[Tuple[int, str, float]]:
+        """Первый подходящий ответ среди кандидатов (row_id, схожесть), отсортированных по убыванию схожести"""
+        candidates = [(row_id, similarity) for row_id, similarity in candidates if similarity >= self.threshold]
+        if not candidates:
+            self.misses += 1
+            return None
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        row_ids = [row_id for row_id, _ in candidates]
+        cursor.execute(f'''SELECT c.row_id, c.answered_at, c.approved, k.answer
+                         FROM answer_cache c JOIN knowledge_vectors k ON k.id = c.row_id
+                         WHERE c.row_id IN ({",".join("?" * len(row_ids))})''', row_ids)
+        entries = {row[0]: row[1:] for row in cursor.fetchall()}
+        cutoff = (datetime.now() - self.ttl).isoformat()
+        for row_id, similarity in candidates:
+            if row_id not in entries:
+                continue
+            answered_at, approved, answer = entries[row_id]
+            if not answer or (not approved and answered_at < cutoff):
+                continue
+            cursor.execute('UPDATE answer_cache SET hits = hits + 1, last_hit = ? WHERE row_id = ?',
+                           (datetime.now().isoformat(), row_id))
+            conn.commit()
+            conn.close()
+            self.hits += 1
+            logger.info(f"Ответ из семантического кэша: id={row_id}, схожесть={similarity:.3f}, "
+                        f"{'одобрен' if approved else 'сгенерирован ' + answered_at}")
+            return row_id, answer, similarity
+        conn.close()
+        self.misses += 1
+        return None
+
+    def stats(self) -> dict:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*), COALESCE(SUM(approved), 0), COALESCE(SUM(hits), 0) FROM answer_cache')
+        entries, approved, total_hits = cursor.fetchone()
+        conn.close()
+        lookups = self.hits + self.misses
+        return {"entries": entries, "approved": approved, "total_hits": total_hits, "hits": self.hits,
+                "misses": self.misses, "bypassed": self.bypassed, "hit_rate": self.hits / lookups if lookups else 0.0}
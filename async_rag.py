@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class RAGOverloaded(Exception):
+    """Очередь запросов к RAG переполнена дольше допустимого ожидания"""
+
+
+class AsyncRAG:
+    """Асинхронный фасад RAGHandler для aiogram: синхронная работа (векторизация, поиск, SQLite)
+    выполняется в ограниченном пуле потоков, а цикл событий продолжает обслуживать других пользователей.
+
+    Одновременно принимается не больше max_pending вызовов (выполняемых и ждущих свободного потока);
+    остальные ждут места до wait_timeout секунд и получают RAGOverloaded. Запрос к LLM идёт секундами,
+    поэтому он выполняется в отдельном пуле из llm_workers потоков и не занимает ни потоки, ни места RAG.
+    """
+
+    def __init__(self, rag, max_workers: int = 4, max_pending: int = 32, wait_timeout: float = 30.0,
+                 llm_workers: int = 4):
+        self.rag = rag
+        self.max_pending = max_pending
+        self.wait_timeout = wait_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rag")
+        self.llm_executor = ThreadPoolExecutor(max_workers=llm_workers, thread_name_prefix="llm")
+        # Семафор создаётся в работающем цикле событий при первом вызове
+        self._slots = None
+        self.pending = 0
+        self.rejected = 0
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет func(*args, **kwargs) в пуле потоков с учётом ограничения очереди"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            logger.warning(f"Очередь RAG переполнена: {self.pending} запросов в работе, отказ №{self.rejected}")
+            raise RAGOverloaded("Слишком много одновременных запросов")
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self.pending -= 1
+            self._slots.release()
+
+    async def generate_rag_response(self, query, llm_generate_func, use_cache=True, remember=False):
+        """Поиск и сборка промпта — в пуле RAG, запрос к LLM — в пуле LLM, сохранение ответа — снова в пуле RAG"""
+        answer, prompt, relevant = await self.run(self.rag.prepare_rag_prompt, query, use_cache)
+        if answer is not None:
+            return answer
+        response = await asyncio.get_running_loop().run_in_executor(self.llm_executor, llm_generate_func, prompt)
+        if remember and response:
+            try:
+                return await self.run(self.rag.finish_rag_response, query, response, relevant, remember)
+            except RAGOverloaded:
+                # Ответ уже получен: пользователь его не теряет, в базу знаний он просто не попадает
+                logger.warning("Ответ LLM не сохранён в базу знаний: очередь RAG переполнена")
+        # Без сохранения остаётся только учёт использованных записей в памяти — это не работа для пула
+        return self.rag.finish_rag_response(query, response, relevant)
+
+    async def find_relevant_context(self, query, **kwargs):
+        return await self.run(self.rag.find_relevant_context, query, **kwargs)
+
+    async def remember_answer(self, question, answer, approved=False):
+        return await self.run(self.rag.remember_answer, question, answer, approved)
+
+    def shutdown(self):
+        self.llm_executor.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,310 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import zlib
+import shutil
+import sqlite3
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from typing import List, Optional
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from keyword_groups import KEYWORD_GROUPS
+from model_registry import DEFAULT_MODEL, register_model
+
+logger = logging.getLogger(__name__)
+
+STUB_MODEL = "stub"
+
+# Конфигурации поиска — параметры RAGHandler; exact (точный перебор) — эталон для recall@k
+BACKENDS = {
+    "exact": {},
+    "float16": {"quantization": "float16"},
+    "int8": {"quantization": "int8"},
+    "hnsw": {"index_backend": "hnsw"},
+    "ivf": {"index_backend": "ivf"},
+    "hybrid": {"lexical_search": True},
+    "sharded": {"topic_routing": True},
+}
+
+# Пороги отключены, чтобы каждая конфигурация возвращала ровно top_k записей и recall@k был сравним
+SEARCH_PARAMS = {"threshold": float("-inf"), "min_threshold": None}
+
+
+class StubEmbeddingModel:
+    """Заглушка SentenceTransformer без загрузки весов: вектор текста — сумма фиксированных
+    псевдослучайных векторов его слов, поэтому тексты с общими словами близки"""
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+        self._words = {}
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def _word_vector(self, word: str) -> np.ndarray:
+        vector = self._words.get(word)
+        if vector is None:
+            rng = np.random.default_rng(zlib.crc32(word.encode("utf-8")))
+            vector = self._words[word] = rng.standard_normal(self.dim).astype(np.float32)
+        return vector
+
+    def encode(self, texts, batch_size: int = 32, show_progress_bar: bool = False, **kwargs):
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words = re.findall(r"\w+", text.lower()) or [text]
+            vectors[i] = np.sum([self._word_vector(word) for word in words], axis=0)
+        return vectors[0] if single else vectors
+
+
+def synthetic_vocabulary(size: int, rng) -> List[str]:
+    """Слова тематических групп плюс псевдослова из слогов; порядок задаёт частоту по закону Ципфа"""
+    words = {word for phrases in KEYWORD_GROUPS.values() for phrase in phrases for word in phrase.split()}
+    syllables = ["ка", "ли", "мо", "ра", "те", "ви", "но", "су", "ди", "ло", "ме", "та", "ро", "ни", "па", "зе"]
+    while len(words) < size:
+        words.add("".join(rng.choice(syllables, size=rng.integers(2, 5))))
+    vocabulary = sorted(words)
+    rng.shuffle(vocabulary)
+    return vocabulary
+
+
+class PhraseGenerator:
+    def __init__(self, vocabulary: List[str], rng):
+        self.vocabulary = vocabulary
+        self.rng = rng
+        weights = 1.0 / np.arange(1, len(vocabulary) + 1)
+        self.cdf = np.cumsum(weights / weights.sum())
+
+    def phrase(self, low: int, high: int) -> str:
+        picks = np.searchsorted(self.cdf, self.rng.random(self.rng.integers(low, high)))
+        return " ".join(self.vocabulary[min(i, len(self.vocabulary) - 1)] for i in picks)
+
+
+def build_synthetic_db(db_path: str, rows: int, dim: int, seed: int = 0, qa_share: float = 0.3,
+                       batch_size: int = 5000) -> float:
+    """Заполняет knowledge_vectors rows синтетическими записями через add_many_to_knowledge_base:
+    доля qa_share — пары вопрос-ответ, остальное — чанки PDF. Возвращает скорость вставки (записей/с)"""
+    from rag_handler import RAGHandler
+
+    register_model(STUB_MODEL, StubEmbeddingModel(dim))
+    rng = np.random.default_rng(seed)
+    phrases = PhraseGenerator(synthetic_vocabulary(20000, rng), rng)
+    rag = RAGHandler(db_path, model_name=STUB_MODEL, answer_cache=False, query_cache_size=0)
+    started = time.perf_counter()
+    for start in range(0, rows, batch_size):
+        count = min(batch_size, rows - start)
+        qa_count = int(count * qa_share)
+        rag.add_many_to_knowledge_base([(phrases.phrase(5, 12), phrases.phrase(20, 40), None, None)
+                                        for _ in range(qa_count)])
+        rag.add_many_to_knowledge_base([(None, None, phrases.phrase(40, 120), None)
+                                        for _ in range(count - qa_count)], is_from_pdf=True)
+        logger.info(f"Синтетическая база: {start + count}/{rows} записей")
+    elapsed = time.perf_counter() - started
+    rag.usage_buffer.stop()
+    return rows / elapsed if elapsed else 0.0
+
+
+def synthetic_queries(db_path: str, count: int, seed: int = 0) -> List[str]:
+    """Запросы из случайных записей базы: часть их слов в случайном порядке"""
+    rng = np.random.default_rng(seed + 1)
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT COALESCE(question, context) FROM knowledge_vectors ORDER BY RANDOM() LIMIT ?', (count,))
+    texts = [row[0] for row in cursor.fetchall() if row[0]]
+    conn.close()
+    queries = []
+    for text in texts:
+        words = text.split()
+        keep = max(2, int(len(words) * rng.uniform(0.3, 0.7)))
+        queries.append(" ".join(rng.permutation(words)[:keep]))
+    return queries
+
+
+def replayed_queries(db_path: str, count: int) -> List[str]:
+    """Последние вопросы пользователей из таблицы conversations"""
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT question FROM conversations ORDER BY id DESC LIMIT ?', (count,))
+    queries = [row[0] for row in cursor.fetchall() if row[0]]
+    conn.close()
+    return queries
+
+
+def copy_database(db_path: str, workdir: str) -> str:
+    """Копия базы вместе с файлами векторов и индексов: бенчмарк не трогает рабочую базу"""
+    target = os.path.join(workdir, os.path.basename(db_path))
+    for path in glob.glob(glob.escape(db_path) + "*"):
+        shutil.copy2(path, os.path.join(workdir, os.path.basename(path)))
+    return target
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS — байты
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_backend(name: str, db_path: str, model_name: str, dim: int, queries: List[str], top_k: int,
+                batch_size: int) -> dict:
+    """Замер одной конфигурации; запускается в отдельном процессе, чтобы пиковый RSS был её собственным"""
+    logging.basicConfig(level=logging.WARNING)
+    try:
+        if model_name == STUB_MODEL:
+            register_model(STUB_MODEL, StubEmbeddingModel(dim))
+        from rag_handler import RAGHandler
+
+        params = {"lexical_search": False, "topic_routing": False, **BACKENDS[name]}
+        rag = RAGHandler(db_path, model_name=model_name, answer_cache=False, query_cache_size=0, auto_reembed=False,
+                         **params)
+        started = time.perf_counter()
+        if "index_backend" in params:
+            rag.build_ann_index()
+        build_seconds = time.perf_counter() - started
+        # Прогрев: загрузка матрицы и индекса не должна попасть в задержку первого запроса
+        rag.find_relevant_context(queries[0], top_k=top_k, **SEARCH_PARAMS)
+
+        latencies, found = [], []
+        for query in queries:
+            started = time.perf_counter()
+            results = rag.find_relevant_context(query, top_k=top_k, **SEARCH_PARAMS)
+            latencies.append(time.perf_counter() - started)
+            found.append([row[0] for row in results])
+        started = time.perf_counter()
+        for start in range(0, len(queries), batch_size):
+            rag.find_relevant_context_many(queries[start:start + batch_size], top_k=top_k, **SEARCH_PARAMS)
+        batch_seconds = time.perf_counter() - started
+    except Exception as e:
+        return {"backend": name, "error": f"{type(e).__name__}: {e}"}
+
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "backend": name,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "qps": len(queries) / float(np.sum(latencies)),
+        "batch_qps": len(queries) / batch_seconds if batch_seconds else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "build_s": build_seconds,
+        "found": found,
+    }
+
+
+def recall_at_k(found: List[List[int]], expected: List[List[int]]) -> Optional[float]:
+    hits = total = 0
+    for ids, exact_ids in zip(found, expected):
+        hits += len(set(ids) & set(exact_ids))
+        total += len(exact_ids)
+    return hits / total if total else None
+
+
+def benchmark(db_path: str, model_name: str, dim: int, queries: List[str], backends: List[str], top_k: int,
+              batch_size: int) -> List[dict]:
+    # spawn, а не fork: дочерний процесс не наследует память родителя, и RSS меряется честно
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for name in ["exact"] + [backend for backend in backends if backend != "exact"]:
+        with context.Pool(1) as pool:
+            result = pool.apply(run_backend, (name, db_path, model_name, dim, queries, top_k, batch_size))
+        if "error" in result:
+            logger.warning(f"{name}: {result['error']}")
+        results.append(result)
+    expected = results[0].get("found")
+    for result in results:
+        found = result.pop("found", None)
+        result["recall"] = recall_at_k(found, expected) if found is not None and expected is not None else None
+    return [result for result in results if result["backend"] in backends]
+
+
+def format_report(title: str, results: List[dict], top_k: int) -> str:
+    def cell(value, width, digits=1):
+        return f"{'—' if value is None else f'{value:.{digits}f}':>{width}}"
+
+    lines = [title, f"{'конфигурация':<12}{'p50 мс':>9}{'p95 мс':>9}{'p99 мс':>9}{'запр/с':>9}"
+                    f"{'пакет/с':>9}{'RSS МБ':>9}{f'recall@{top_k}':>11}{'индекс с':>10}"]
+    for result in results:
+        if "error" in result:
+            lines.append(f"{result['backend']:<12}ошибка: {result['error']}")
+            continue
+        lines.append(f"{result['backend']:<12}{cell(result['p50_ms'], 9, 2)}{cell(result['p95_ms'], 9, 2)}"
+                     f"{cell(result['p99_ms'], 9, 2)}{cell(result['qps'], 9)}{cell(result['batch_qps'], 9)}"
+                     f"{cell(result['peak_rss_mb'], 9)}{cell(result['recall'], 11, 3)}{cell(result['build_s'], 10, 2)}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк поиска по базе знаний: задержка, пропускная способность, "
+                                                 "пиковый RSS и recall@k относительно точного поиска")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000],
+                        help="размеры синтетических баз (от 1k до 1M записей)")
+    parser.add_argument("--db", help="вместо синтетических баз — копия существующей базы")
+    parser.add_argument("--replay", help="база, из таблицы conversations которой берутся вопросы "
+                                         "(по умолчанию с --db — она же; без него — синтетические запросы)")
+    parser.add_argument("--model", default=None,
+                        help=f"модель векторизации; по умолчанию {STUB_MODEL} для синтетики и {DEFAULT_MODEL} для --db")
+    parser.add_argument("--dim", type=int, default=384, help="размерность векторов заглушки модели")
+    parser.add_argument("--backends", nargs="+", choices=sorted(BACKENDS), default=list(BACKENDS))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workdir", default=None, help="каталог для синтетических баз (переиспользуются)")
+    parser.add_argument("--rebuild", action="store_true", help="пересоздать синтетические базы")
+    parser.add_argument("--json", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rag_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    report = []
+
+    if args.db:
+        model_name = args.model or DEFAULT_MODEL
+        db_path = copy_database(args.db, workdir)
+        queries = replayed_queries(args.replay or args.db, args.queries)
+        runs = [(f"База {args.db}, вопросов из conversations: {len(queries)}", db_path, None, queries)]
+    else:
+        model_name = args.model or STUB_MODEL
+        runs = []
+        for rows in args.rows:
+            db_path = os.path.join(workdir, f"synthetic_{rows}_{args.dim}.db")
+            ingest = None
+            if args.rebuild or not os.path.exists(db_path):
+                for path in glob.glob(glob.escape(db_path) + "*"):
+                    os.remove(path)
+                ingest = build_synthetic_db(db_path, rows, args.dim)
+            queries = replayed_queries(args.replay, args.queries) if args.replay \
+                else synthetic_queries(db_path, args.queries)
+            runs.append((f"Синтетическая база: {rows} записей, запросов: {len(queries)}", db_path, ingest, queries))
+
+    for title, db_path, ingest, queries in runs:
+        if not queries:
+            logger.error(f"{title}: нет запросов для замера")
+            continue
+        results = benchmark(db_path, model_name, args.dim, queries, args.backends, args.top_k, args.batch_size)
+        if ingest is not None:
+            title += f", вставка {ingest:.0f} записей/с"
+        print(format_report(title, results, args.top_k) + "\n")
+        report.append({"title": title, "db": db_path, "ingest_rows_per_s": ingest, "results": results})
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
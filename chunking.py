@@ -0,0 +1,122 @@
+import logging
+import threading
+from functools import lru_cache
+from typing import Callable, Iterable, Iterator, List, TextIO, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+_punkt_lock = threading.Lock()
+_punkt_ready = False
+
+
+def _ensure_punkt():
+    """nltk импортируется, а ресурс punkt_tab проверяется один раз при первом вызове"""
+    global _punkt_ready
+    import nltk
+    if not _punkt_ready:
+        with _punkt_lock:
+            if not _punkt_ready:
+                try:
+                    nltk.data.find('tokenizers/punkt_tab')
+                except LookupError:
+                    logger.info("Загрузка ресурса NLTK punkt_tab")
+                    nltk.download('punkt_tab', quiet=True)
+                _punkt_ready = True
+    return nltk
+
+
+def sent_tokenize(text: str, language: str = "russian") -> List[str]:
+    return _ensure_punkt().sent_tokenize(text, language=language)
+
+
+@lru_cache(maxsize=None)
+def _punkt_tokenizer(language: str):
+    from nltk.tokenize import PunktTokenizer
+    _ensure_punkt()
+    return PunktTokenizer(language)
+
+
+def sent_spans(text: str, language: str = "russian") -> List[Tuple[int, int]]:
+    """Границы предложений text (начало, конец) — те же, что у sent_tokenize; пробелы между предложениями
+    в них не входят, но остаются в text"""
+    return list(_punkt_tokenizer(language).span_tokenize(text))
+
+
+def read_blocks(file: TextIO, block_size: int = 1 << 16) -> Iterator[str]:
+    """Текст открытого файла блоками по block_size символов — файл целиком в память не читается"""
+    return iter(lambda: file.read(block_size), "")
+
+
+def _text_blocks(text: str, block_size: int = 1 << 16) -> Iterator[str]:
+    for start in range(0, len(text), block_size):
+        yield text[start:start + block_size]
+
+
+def iter_sentences(blocks: Iterable[str], language: str = "russian", max_sentence: int = 10000) -> Iterator[str]:
+    """Предложения потока текстовых блоков. Токенизируется только очередной блок вместе с незаконченным
+    последним предложением предыдущего; «предложение» длиннее max_sentence символов (текст без знаков
+    препинания) режется по пробелу, чтобы хвост не рос и не токенизировался заново с каждым блоком"""
+    pending = ""
+    for block in blocks:
+        text = pending + block
+        spans = sent_spans(text, language=language)
+        if not spans:
+            pending = ""
+            continue
+        # Последнее предложение может продолжиться в следующем блоке. Переносится необработанный остаток
+        # текста с начала этого предложения: пробел на границе блоков должен дойти до следующей токенизации
+        for start, end in spans[:-1]:
+            yield text[start:end]
+        pending = text[spans[-1][0]:]
+        while len(pending) > max_sentence:
+            cut = pending.rfind(" ", 0, max_sentence)
+            if cut <= 0:
+                cut = max_sentence
+            yield pending[:cut].strip()
+            pending = pending[cut:].lstrip()
+    if pending.strip():
+        yield pending.strip()
+
+
+def iter_chunks(text: Union[str, Iterable[str]], chunk_size: int = 2000, overlap: int = 0,
+                length: Callable[[str], int] = len, language: str = "russian") -> Iterator[str]:
+    """Чанки из предложений текста (строки или потока блоков, например read_blocks(file)) по мере чтения.
+
+    В чанк входят целые предложения, пока его длина вместе с пробелами между ними не превысит chunk_size;
+    длина считается функцией length — по умолчанию в символах, estimate_tokens даёт ограничение в токенах.
+    Предложение длиннее chunk_size становится отдельным чанком. overlap последних предложений чанка
+    повторяются в начале следующего, если помещаются в него вместе с новым предложением.
+    Чанк собирается одним join из списка предложений, без повторной конкатенации строки.
+    """
+    blocks = _text_blocks(text) if isinstance(text, str) else text
+    current: List[str] = []
+    sizes: List[int] = []
+    # Длина текущего чанка: сумма длин предложений и по одному пробелу между ними
+    total = -1
+    for sentence in iter_sentences(blocks, language=language):
+        size = length(sentence)
+        if current and total + 1 + size > chunk_size:
+            yield " ".join(current)
+            keep = min(overlap, len(current) - 1) if overlap else 0
+            current, sizes = current[len(current) - keep:], sizes[len(sizes) - keep:]
+            total = sum(sizes) + len(sizes) - 1
+            while current and total + 1 + size > chunk_size:
+                total -= sizes.pop(0) + 1
+                current.pop(0)
+        current.append(sentence)
+        sizes.append(size)
+        total += 1 + size
+    if current:
+        yield " ".join(current)
+
+
+def batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """Элементы iterable списками по size (последний может быть короче)"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
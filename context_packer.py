@@ -0,0 +1,147 @@
+import re
+import logging
+from typing import Callable, List, Optional, Tuple
+import numpy as np
+from chunking import sent_tokenize
+from embedding_cache import EmbeddingCache
+from vector_store import normalize_vector
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """Приблизительное число токенов BPE-токенизатора llama: слово — токен на каждые 4 символа,
+    знак препинания — отдельный токен. Для русского текста ошибка в пределах 10–15%"""
+    return len(re.findall(r"\w{1,4}|[^\w\s]", text))
+
+
+def format_entries(relevant) -> Tuple[str, str]:
+    """Записи целиком, как они попадали в промпт до упаковки: контекст до 1500 символов и полная пара
+    вопрос-ответ. Возвращает (контекст из PDF, контекст от пользователей)"""
+    seen_answers = set()
+    pdf_context = ""
+    user_context = ""
+    for i, (_, q, a, ctx, sim, is_from_pdf, tags) in enumerate(relevant, 1):
+        if not a and not ctx:
+            logger.warning(f"Пустой ответ и контекст для вопроса: {q}")
+            continue
+        answer_key = a if a else ctx
+        if answer_key in seen_answers:
+            logger.info(f"Пропущен дублирующийся ответ: {answer_key[:50]}...")
+            continue
+        seen_answers.add(answer_key)
+        entry = f"\nЗапись {i} (схожесть: {sim:.2f}):\n"
+        if ctx:
+            entry += f"Контекст: {ctx[:1500]}...\n"
+        if q and a:
+            entry += f"Вопрос: {q}\nОтвет: {a}\n"
+        if tags:
+            entry += f"Теги: {tags}\n"
+        if is_from_pdf:
+            pdf_context += entry
+        else:
+            user_context += entry
+    return pdf_context, user_context
+
+
+class ContextPacker:
+    """Упаковка найденных записей в промпт с бюджетом токенов.
+
+    Контекст и ответы записей режутся на предложения, каждое оценивается близостью к запросу (плюс
+    небольшая добавка за близость самой записи), и бюджет token_budget заполняется лучшими предложениями.
+    Повторы и почти совпадающие предложения (близость не ниже duplicate_threshold) из пересекающихся
+    чанков отбрасываются. Выбранные предложения собираются обратно по записям в исходном порядке.
+    """
+
+    def __init__(self, encode: Callable[[List[str]], np.ndarray], model_name: str, token_budget: int = 600,
+                 count_tokens: Callable[[str], int] = estimate_tokens, entry_weight: float = 0.1,
+                 duplicate_threshold: float = 0.95):
+        self.encode = encode
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens
+        self.entry_weight = entry_weight
+        self.duplicate_threshold = duplicate_threshold
+        # Предложения популярных чанков повторяются из запроса в запрос — их векторы кэшируются
+        self.sentence_cache = EmbeddingCache(model_name, max_size=4096)
+
+    def _sentence_vectors(self, sentences: List[str]) -> np.ndarray:
+        vectors = [self.sentence_cache.get(sentence) for sentence in sentences]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            for i, vector in zip(missing, self.encode([sentences[i] for i in missing])):
+                vectors[i] = self.sentence_cache.put(sentences[i], vector)
+        return np.stack([normalize_vector(vector) for vector in vectors])
+
+    @staticmethod
+    def _header(index: int, question: Optional[str], sim: float, tags: Optional[str], with_question: bool) -> str:
+        header = f"\nЗапись {index} (схожесть: {sim:.2f}):\n"
+        if with_question:
+            header += f"Вопрос: {question}\n"
+        if tags:
+            header += f"Теги: {tags}\n"
+        return header
+
+    def pack(self, query_vector, relevant) -> Tuple[str, str]:
+        """Возвращает (контекст из PDF, контекст от пользователей) в пределах token_budget"""
+        # (номер записи, поле, порядок в поле, предложение)
+        units = []
+        for entry, (_, q, a, ctx, sim, is_from_pdf, tags) in enumerate(relevant):
+            for field, text in (("context", ctx), ("answer", a if q else None)):
+                for order, sentence in enumerate(sent_tokenize(text) if text else []):
+                    if sentence.strip():
+                        units.append((entry, field, order, sentence.strip()))
+        if not units:
+            return "", ""
+
+        vectors = self._sentence_vectors([unit[3] for unit in units])
+        scores = vectors @ normalize_vector(query_vector)
+        scores += self.entry_weight * np.array([relevant[unit[0]][4] for unit in units], dtype=np.float32)
+
+        remaining = self.token_budget
+        chosen, chosen_vectors, seen = [], [], set()
+        opened = set()
+        for i in np.argsort(-scores, kind="stable"):
+            entry, field, order, sentence = units[i]
+            key = EmbeddingCache.normalize(sentence)
+            if key in seen:
+                continue
+            if chosen_vectors and float(np.max(np.stack(chosen_vectors) @ vectors[i])) >= self.duplicate_threshold:
+                continue
+            _, q, a, _, sim, _, tags = relevant[entry]
+            cost = self.count_tokens(sentence) + 1
+            if entry not in opened:
+                cost += self.count_tokens(self._header(entry + 1, q, sim, tags, bool(q and a)))
+            if cost > remaining:
+                continue
+            remaining -= cost
+            opened.add(entry)
+            seen.add(key)
+            chosen.append(i)
+            chosen_vectors.append(vectors[i])
+
+        pdf_context = ""
+        user_context = ""
+        for entry in sorted(opened):
+            _, q, a, _, sim, is_from_pdf, tags = relevant[entry]
+            parts = {"context": [], "answer": []}
+            for i in sorted((i for i in chosen if units[i][0] == entry), key=lambda i: (units[i][1], units[i][2])):
+                parts[units[i][1]].append(units[i][3])
+            text = f"\nЗапись {entry + 1} (схожесть: {sim:.2f}):\n"
+            if parts["context"]:
+                text += f"Контекст: {' '.join(parts['context'])}\n"
+            if q and a:
+                text += f"Вопрос: {q}\n"
+                if parts["answer"]:
+                    text += f"Ответ: {' '.join(parts['answer'])}\n"
+            if tags:
+                text += f"Теги: {tags}\n"
+            if is_from_pdf:
+                pdf_context += text
+            else:
+                user_context += text
+
+        full_tokens = self.count_tokens("".join(format_entries(relevant)))
+        packed_tokens = self.count_tokens(pdf_context + user_context)
+        logger.info(f"Контекст упакован: {packed_tokens} токенов вместо {full_tokens} "
+                    f"(сэкономлено {max(full_tokens - packed_tokens, 0)}), предложений {len(chosen)} из {len(units)}")
+        return pdf_context, user_context
@@ -0,0 +1,96 @@
+import os
+import re
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """Ограниченный LRU-кэш векторов запросов: ключ — нормализованный текст, значение — float32 вектор модели.
+
+    Повторные и отличающиеся только регистром, пробелами или знаками препинания по краям вопросы
+    не доходят до модели. При заданном path кэш сохраняется в .npz вместе с именем модели и
+    подхватывается после перезапуска; кэш другой модели игнорируется.
+    """
+
+    def __init__(self, model_name: str, max_size: int = 1024, path: Optional[str] = None):
+        self.model_name = model_name
+        self.max_size = max_size
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        text = re.sub(r"\s+", " ", text.lower().replace("ё", "е")).strip()
+        return text.strip(" .,!?;:…\"'«»()-")
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        key = self.normalize(text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return vector
+
+    def put(self, text: str, vector) -> np.ndarray:
+        if not self.max_size:
+            return vector
+        vector = np.array(vector, dtype=np.float32).ravel()
+        vector.setflags(write=False)
+        key = self.normalize(text)
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return vector
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
+
+    def save(self):
+        if not self.path or not self._entries:
+            return
+        with self._lock:
+            keys = list(self._entries)
+            vectors = np.stack([self._entries[key] for key in keys])
+        # Пишем во временный файл и переименовываем, чтобы прерванное сохранение не портило кэш
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, model=np.array(self.model_name), keys=np.array(keys),
+                     vectors=vectors)
+        os.replace(tmp_path, self.path)
+        logger.info(f"Кэш векторов запросов сохранён: {len(keys)} записей")
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        try:
+            data = np.load(self.path)
+            if str(data["model"]) != self.model_name:
+                logger.info("Кэш векторов запросов построен другой моделью и не загружается")
+                return False
+            for key, vector in zip(data["keys"].tolist(), data["vectors"]):
+                self.put(key, vector)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки кэша векторов запросов {self.path}: {e}")
+            return False
+        logger.info(f"Загружен кэш векторов запросов: {len(self._entries)} записей")
+        return True
@@ -0,0 +1,242 @@
+import re
+from typing import Dict, List
+
+# Тематические группы ключевых слов для буста релевантности
+KEYWORD_GROUPS = {
+    "heart": [
+        "сердце", "сосуды", "кровообращение", "давление", "холестерин", "гипертония", "артерии",
+        "аритмия", "тахикардия", "брадикардия", "атеросклероз", "сердечная недостаточность",
+        "кровяное давление", "венозная система", "капилляры", "сердечный ритм", "миокард"
+    ],
+    "sleep": [
+        "сон", "бессонница", "уснуть", "отдых", "расслабление", "спать", "ночной",
+        "качество сна", "глубокий сон", "проблемы со сном", "сонливость", "циркадный ритм",
+        "мелатонин", "нарушение сна", "дневная усталость", "пробуждение"
+    ],
+    "stress": [
+        "стресс", "тревога", "напряжение", "нервы", "успокоение", "паника", "эмоции",
+        "нервозность", "переутомление", "выгорание", "эмоциональное напряжение", "релаксация",
+        "психоэмоциональное состояние", "стрессоустойчивость", "кортизол", "адаптация"
+    ],
+    "energy": [
+        "энергия", "бодрость", "усталость", "активность", "жизненная сила", "тонус",
+        "упадок сил", "энергичность", "вялость", "хроническая усталость", "выносливость",
+        "митохондрии", "энергетический баланс", "жизненный тонус", "сила"
+    ],
+    "gut": [
+        "жкт", "пищеварение", "желудок", "кишечник", "микрофлора", "запор", "диарея",
+        "гастрит", "дисбактериоз", "вздутие", "рефлюкс", "перистальтика", "энзимы",
+        "микробиом", "синдром раздраженного кишечника", "ферменты", "кишечная проницаемость",
+        "язва", "колит"
+    ],
+    "immunity": [
+        "иммунитет", "защита организма", "инфекции", "простуда", "вирусы", "иммунная система",
+        "грипп", "ОРВИ", "иммунодефицит", "иммунный ответ", "вакцинация", "антитела",
+        "лимфоциты", "воспалительные процессы", "интерфероны", "укрепление иммунитета"
+    ],
+    "joints": [
+        "суставы", "кости", "хрящи", "артрит", "боль в суставах", "гибкость", "остеопороз",
+        "артроз", "ревматизм", "остеохондроз", "подагра", "хондропротекторы", "синовиальная жидкость",
+        "суставная смазка", "коллаген", "минерализация костей", "переломы"
+    ],
+    "skin": [
+        "кожа", "дерма", "акне", "прыщи", "увлажнение кожи", "экзема", "псориаз",
+        "дерматит", "сухость кожи", "морщины", "пигментация", "покраснение", "сыпь",
+        "коллаген кожи", "эластичность кожи", "заживление ран", "кожный зуд", "шелушение"
+    ],
+    "hair": [
+        "волосы", "выпадение волос", "ломкость волос", "перхоть", "рост волос", "здоровье волос",
+        "себорея", "алопеция", "секущиеся концы", "укрепление волос", "волосяные луковицы",
+        "кожа головы", "жирность волос", "сухость волос", "блеск волос"
+    ],
+    "vision": [
+        "зрение", "глаза", "усталость глаз", "катаракта", "глаукома", "здоровье глаз",
+        "дальнозоркость", "близорукость", "астигматизм", "сухость глаз", "сетчатка",
+        "хрусталик", "глазное давление", "зрительная нагрузка", "цветовое восприятие"
+    ],
+    "hormones": [
+        "гормоны", "гормональный баланс", "щитовидка", "менопауза", "либидо", "эндокринная система",
+        "тиреоидные гормоны", "эстроген", "прогестерон", "тестостерон", "инсулин",
+        "гормон роста", "адреналин", "гормональный сбой", "надпочечники", "гипоталамус"
+    ],
+    "detox": [
+        "детоксикация", "очищение организма", "токсины", "печень", "почки", "чистка",
+        "шлаки", "детокс-программы", "антиоксиданты", "выведение токсинов", "лимфодренаж",
+        "очищение кишечника", "гепатопротекторы", "очищение крови", "почечная фильтрация"
+    ],
+    "weight": [
+        "вес", "похудение", "лишний вес", "ожирение", "метаболизм", "контроль веса",
+        "жиросжигание", "масса тела", "диета", "калорийность", "аппетит", "набор веса",
+        "индекс массы тела", "обмен веществ", "жировая ткань", "стройность"
+    ],
+    "muscles": [
+        "мышцы", "мышечная масса", "боль в мышцах", "восстановление мышц", "сила",
+        "спазмы", "крепатура", "мышечный тонус", "рост мышц", "миофибриллы",
+        "анаболизм", "белковый синтез", "мышечная выносливость", "растяжение мышц"
+    ],
+    "allergies": [
+        "аллергия", "аллергические реакции", "сыпь", "зуд", "астма", "ринит",
+        "анафилаксия", "аллергены", "гистамин", "поллиноз", "пищевая аллергия",
+        "контактный дерматит", "крапивница", "отек Квинке", "аллергический кашель"
+    ],
+    "respiratory": [
+        "дыхание", "легкие", "бронхи", "кашель", "одышка", "дыхательная система",
+        "бронхит", "пневмония", "туберкулез", "хрипы", "оксигенация", "дыхательная гимнастика",
+        "мукоцилиарный клиренс", "легочная вентиляция", "эмфизема"
+    ],
+    "blood_sugar": [
+        "сахар в крови", "диабет", "глюкоза", "инсулин", "гликемия",
+        "гипогликемия", "гиергликемия", "глюкометр", "гликемический индекс",
+        "инсулинорезистентность", "диабет 2 типа", "углеводный обмен", "панкреас"
+    ],
+    "memory": [
+        "память", "концентрация", "мозг", "когнитивные функции", "фокус", "ясность ума",
+        "нейропластичность", "запоминание", "внимание", "умственная работоспособность",
+        "когнитивный спад", "деменция", "нейротрансмиттеры", "мозговая активность"
+    ],
+    "inflammation": [
+        "воспаление", "противовоспалительное", "отек", "хроническое воспаление",
+        "цитокины", "воспалительные маркеры", "боль при воспалении", "покраснение",
+        "воспалительный процесс", "иммунное воспаление", "острые воспаления"
+    ],
+    "circulation": [
+        "кровоток", "микроциркуляция", "варикоз", "тромбы", "капилляры",
+        "венозный отток", "кровообращение", "гемодинамика", "тромбофлебит",
+        "кровяные сгустки", "артериальный кровоток", "лимфоток", "ангиопатия"
+    ],
+    # Новые группы
+    "liver": [
+        "печень", "гепатопротекторы", "желчь", "гепатит", "цирроз", "жировой гепатоз",
+        "детоксикация печени", "ферменты печени", "холестаз", "печеночная недостаточность",
+        "очищение печени", "желчегонные", "печеночный метаболизм"
+    ],
+    "reproductive": [
+        "репродуктивное здоровье", "фертильность", "менструация", "беременность", "либидо",
+        "эректильная дисфункция", "простата", "яичники", "матка", "сперматогенез",
+        "овуляция", "репродуктивная система", "бесплодие", "гормоны пола"
+    ],
+    "mental_health": [
+        "психическое здоровье", "депрессия", "тревожное расстройство", "эмоциональное состояние",
+        "психоэмоциональный баланс", "апатия", "настроение", "биполярное расстройство",
+        "психологическое благополучие", "антидепрессанты", "серотонин"
+    ],
+    "thyroid": [
+        "щитовидная железа", "тиреоидные гормоны", "гипотериоз", "гипертериоз", "зоб",
+        "йод", "тироксин", "ТТГ", "аутоиммунный тиреоидит", "узлы щитовидки",
+        "метаболизм щитовидки", "эндокринология"
+    ],
+    "kidneys": [
+        "почки", "мочевыделительная система", "почечная недостаточность", "мочекаменная болезнь",
+        "пиелонефрит", "почечная фильтрация", "мочеиспускание", "уремия", "диуретики",
+        "отечность", "почечные канальцы", "гломерулонефрит"
+    ],
+    "pain": [
+        "боль", "хроническая боль", "головная боль", "мигрень", "невралгия", "мышечная боль",
+        "суставная боль", "болеутоляющее", "спазмолитическое", "боль в спине", "острая боль",
+        "фибромиалгия", "боль в шее"
+    ],
+    "aging": [
+        "старение", "антивозрастной", "долголетие", "возрастные изменения", "антиоксиданты",
+        "клеточное обновление", "морщины", "снижение тонуса", "возрастной метаболизм",
+        "гериатрия", "оксидативный стресс", "теломеры"
+    ]
+}
+
+# Группы для тегирования фрагментов при загрузке файлов обучения
+TAG_GROUPS = {
+    "sleep": ["сон", "бессонница", "уснуть", "отдых", "расслабление"],
+    "stress": ["стресс", "тревога", "напряжение", "нервы", "успокоение"],
+    "energy": ["энергия", "бодрость", "усталость", "активность"],
+    "immunity": ["иммунитет", "простуда", "вирусы", "иммунная система"],
+    "skin": ["кожа", "акне", "увлажнение", "псориаз"],
+    "vitamins": ["витамины", "витамин", "минералы", "микроэлементы"],
+    "weight": ["вес", "похудение", "метаболизм"],
+    "joints": ["суставы", "кости", "артрит", "гибкость"],
+    "gut": ["жкт", "пищеварение", "желудок", "кишечник"]
+}
+
+
+class KeywordMatcher:
+    """Все ключевые слова групп, скомпилированные в одно регулярное выражение-префиксное дерево.
+
+    Текст просматривается один раз: в каждой позиции опережающая проверка находит самое длинное ключевое
+    слово, а маска этого слова уже включает группы всех более коротких слов, являющихся его префиксами.
+    Результат совпадает с проверкой `kw in text` по каждому слову каждой группы.
+    word_mask учитывает только ключевые слова, стоящие в тексте отдельными словами.
+    """
+
+    def __init__(self, groups: Dict[str, List[str]]):
+        self.group_names = list(groups)
+        keyword_masks = {}
+        for index, keywords in enumerate(groups.values()):
+            for keyword in keywords:
+                keyword = keyword.lower()
+                keyword_masks[keyword] = keyword_masks.get(keyword, 0) | (1 << index)
+        # Совпадение в позиции — самое длинное слово; короткие слова с тем же началом — его префиксы
+        self._masks = {}
+        for keyword in keyword_masks:
+            mask = 0
+            for other, other_mask in keyword_masks.items():
+                if keyword.startswith(other):
+                    mask |= other_mask
+            self._masks[keyword] = mask
+        # Для совпадений целыми словами префикс засчитывается, только если в ключевом слове он сам целое слово
+        self._word_masks = {}
+        for keyword in keyword_masks:
+            mask = 0
+            for other, other_mask in keyword_masks.items():
+                if keyword.startswith(other) and (len(other) == len(keyword) or not keyword[len(other)].isalnum()):
+                    mask |= other_mask
+            self._word_masks[keyword] = mask
+        trie = self._trie_pattern(sorted(keyword_masks)) if keyword_masks else None
+        self._pattern = re.compile(f"(?=({trie}))") if trie else None
+        self._word_pattern = re.compile(rf"(?<!\w)(?=({trie})(?!\w))") if trie else None
+
+    @classmethod
+    def _trie_pattern(cls, keywords: List[str]) -> str:
+        trie = {}
+        for keyword in keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[""] = {}
+        return cls._node_pattern(trie)
+
+    @classmethod
+    def _node_pattern(cls, node: dict) -> str:
+        terminal = "" in node
+        branches = [re.escape(char) + cls._node_pattern(child) for char, child in node.items() if char]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        # Жадный необязательный хвост: сначала пробуется более длинное слово
+        return f"(?:{pattern})?" if terminal else pattern
+
+    def mask(self, text: str) -> int:
+        """Битовая маска групп, ключевые слова которых встречаются в тексте (бит i — group_names[i])"""
+        if not text or self._pattern is None:
+            return 0
+        mask = 0
+        for match in self._pattern.finditer(text.lower()):
+            mask |= self._masks[match.group(1)]
+        return mask
+
+    def word_mask(self, text: str) -> int:
+        """Маска групп, ключевые слова которых стоят в тексте отдельными словами («вес», но не «весной»)"""
+        if not text or self._word_pattern is None:
+            return 0
+        mask = 0
+        for match in self._word_pattern.finditer(text.lower()):
+            mask |= self._word_masks[match.group(1)]
+        return mask
+
+    def groups_from_mask(self, mask: int) -> List[str]:
+        return [name for index, name in enumerate(self.group_names) if mask >> index & 1]
+
+    def match(self, text: str) -> List[str]:
+        """Названия найденных групп в порядке их объявления"""
+        return self.groups_from_mask(self.mask(text))
+
+
+KEYWORD_MATCHER = KeywordMatcher(KEYWORD_GROUPS)
+TAG_MATCHER = KeywordMatcher(TAG_GROUPS)
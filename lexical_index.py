@@ -0,0 +1,124 @@
+import re
+import sqlite3
+import logging
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+# FTS5-таблица с внешним содержимым: тексты не дублируются, индекс ведут триггеры на knowledge_vectors
+FTS_SCHEMA = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_fts USING fts5(
+                    question, answer, context, tags,
+                    content='knowledge_vectors', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2')''',
+    '''CREATE TRIGGER IF NOT EXISTS knowledge_fts_insert AFTER INSERT ON knowledge_vectors
+                    BEGIN INSERT INTO knowledge_fts (rowid, question, answer, context, tags)
+                          VALUES (NEW.id, NEW.question, NEW.answer, NEW.context, NEW.tags); END''',
+    '''CREATE TRIGGER IF NOT EXISTS knowledge_fts_delete AFTER DELETE ON knowledge_vectors
+                    BEGIN INSERT INTO knowledge_fts (knowledge_fts, rowid, question, answer, context, tags)
+                          VALUES ('delete', OLD.id, OLD.question, OLD.answer, OLD.context, OLD.tags); END''',
+    '''CREATE TRIGGER IF NOT EXISTS knowledge_fts_update
+                    AFTER UPDATE OF question, answer, context, tags ON knowledge_vectors
+                    BEGIN INSERT INTO knowledge_fts (knowledge_fts, rowid, question, answer, context, tags)
+                          VALUES ('delete', OLD.id, OLD.question, OLD.answer, OLD.context, OLD.tags);
+                          INSERT INTO knowledge_fts (rowid, question, answer, context, tags)
+                          VALUES (NEW.id, NEW.question, NEW.answer, NEW.context, NEW.tags); END''',
+]
+
+# Веса BM25 по колонкам: question, answer, context, tags
+BM25_WEIGHTS = (2.0, 1.0, 1.0, 0.5)
+
+# Служебные и вопросительные слова: они есть почти в каждой записи и только раздувают выборку FTS5
+STOPWORDS = frozenset("""
+    без более больше был была были было быть вам вас ваш все всё всего всех где даже для его если есть еще ещё
+    зачем здесь как какая какие каким каких какое какой когда кого кто лучше между мне много может можно мой
+    мою над надо нам нас нее неё нет них нужно однако она они оно очень под после потом почему при про пусть
+    раз сам свой себе себя сейчас сколько так также там тем тех того тоже только том тот тут уже хочу чего
+    чем через что чтобы чье чьи эта эти это этого этой этом этот
+""".split())
+
+# Сколько слов запроса идёт в FTS5: каждый префиксный терм — отдельный обход индекса, а длинные вопросы
+# дают десятки слов. Берутся самые длинные — они же самые специфичные
+MAX_TERMS = 8
+
+
+class LexicalIndex:
+    """Полнотекстовый поиск BM25 по knowledge_vectors (SQLite FTS5).
+
+    Ловит то, что плохо видит модель: точные названия продуктов doTERRA, латинские названия
+    растений, артикулы. Если SQLite собран без FTS5, индекс выключается и поиск остаётся векторным.
+    """
+
+    def __init__(self, db_path: str, scan_limit: int = 200):
+        self.db_path = db_path
+        # Сколько совпадений FTS5 оценивается BM25: без предела сортируются все записи, где встретился терм
+        self.scan_limit = scan_limit
+        self.available = False
+
+    def init_schema(self, conn) -> bool:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'knowledge_fts'")
+        exists = cursor.fetchone() is not None
+        try:
+            for statement in FTS_SCHEMA:
+                cursor.execute(statement)
+            if not exists:
+                # Таблица создана для уже заполненной базы — индексируем имеющиеся записи
+                cursor.execute("INSERT INTO knowledge_fts (knowledge_fts) VALUES ('rebuild')")
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            logger.warning(f"Полнотекстовый индекс FTS5 недоступен, используется только векторный поиск: {e}")
+            self.available = False
+            return False
+        self.available = True
+        return True
+
+    def optimize(self, conn):
+        """Сливает сегменты FTS5-индекса, накопившиеся от частых вставок, в один"""
+        if not self.available:
+            return
+        try:
+            conn.execute("INSERT INTO knowledge_fts (knowledge_fts) VALUES ('optimize')")
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Не удалось оптимизировать полнотекстовый индекс: {e}")
+
+    @staticmethod
+    def build_query(text: str) -> str:
+        """Запрос FTS5 из значимых слов текста, термы объединены через OR. У длинных слов отрезается окончание
+        и ищется префикс, чтобы «иммунитета» находило «иммунитет»; короткие слова ищутся целиком — их префикс
+        совпал бы с множеством посторонних слов. Стоп-слова и слова короче трёх букв пропускаются,
+        из остальных остаются MAX_TERMS самых длинных"""
+        words = [word for word in dict.fromkeys(re.findall(r"\w+", text.lower()))
+                 if len(word) >= 3 and word not in STOPWORDS]
+        words = sorted(words, key=len, reverse=True)[:MAX_TERMS]
+        terms = []
+        for word in words:
+            term = f'"{word[:-2]}"*' if len(word) > 5 and not word.isdigit() else f'"{word}"'
+            if term not in terms:
+                terms.append(term)
+        return " OR ".join(terms)
+
+    def search(self, text: str, limit: int = 50) -> List[int]:
+        """Id записей по убыванию релевантности BM25"""
+        if not self.available:
+            return []
+        query = self.build_query(text)
+        if not query:
+            return []
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+            # BM25 считается только для первых scan_limit совпадений, а не сортирует их все
+            cursor.execute(f'''SELECT rowid FROM (
+                                 SELECT rowid, bm25(knowledge_fts, {", ".join(map(str, BM25_WEIGHTS))}) AS score
+                                 FROM knowledge_fts WHERE knowledge_fts MATCH ? LIMIT ?)
+                             ORDER BY score LIMIT ?''',
+                           (query, max(self.scan_limit, limit), limit))
+            return [row[0] for row in cursor.fetchall()]
+        except sqlite3.OperationalError as e:
+            logger.error(f"Ошибка полнотекстового поиска: {e}")
+            return []
+        finally:
+            conn.close()
@@ -0,0 +1,62 @@
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
+
+# Одна загрузка каждой модели на процесс: все RAGHandler и RAGTrainer получают один экземпляр
+_models: Dict[str, Future] = {}
+_lock = threading.Lock()
+
+
+def _load(model_name: str, future: Future):
+    try:
+        # sentence_transformers тянет за собой torch — импортируем только при загрузке модели
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name)
+        # Первый вызов encode выделяет буферы и прогревает ядра — делаем его до первого пользователя
+        model.encode("прогрев модели")
+    except Exception as e:
+        logger.error(f"Ошибка загрузки модели {model_name}: {e}")
+        with _lock:
+            # Неудачная загрузка не кэшируется: следующий вызов попробует снова
+            _models.pop(model_name, None)
+        future.set_exception(e)
+        return
+    logger.info(f"Модель векторизации загружена: {model_name}")
+    future.set_result(model)
+
+
+def _model_future(model_name: str, background: bool) -> Future:
+    with _lock:
+        future = _models.get(model_name)
+        start = future is None
+        if start:
+            future = _models[model_name] = Future()
+    if start:
+        if background:
+            threading.Thread(target=_load, args=(model_name, future), name=f"load-{model_name}", daemon=True).start()
+        else:
+            _load(model_name, future)
+    return future
+
+
+def get_model(model_name: str = DEFAULT_MODEL):
+    """Общий экземпляр модели; если она ещё загружается в фоне, дожидается загрузки"""
+    return _model_future(model_name, background=False).result()
+
+
+def prewarm(model_name: str = DEFAULT_MODEL) -> Future:
+    """Начинает загрузку модели в фоновом потоке и сразу возвращает Future с моделью"""
+    return _model_future(model_name, background=True)
+
+
+def register_model(model_name: str, model):
+    """Регистрирует готовый экземпляр под именем model_name (например, заглушку модели в бенчмарке)"""
+    future = Future()
+    future.set_result(model)
+    with _lock:
+        _models[model_name] = future
@@ -1,27 +1,95 @@
 import sqlite3
+import threading
+import time
 from datetime import datetime
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 import logging
-import nltk
-from nltk.tokenize import sent_tokenize
-
-# Загружаем ресурсы для NLTK
-try:
-    nltk.data.find('tokenizers/punkt_tab')
-except LookupError:
-    nltk.download('punkt_tab', quiet=True)
-
+from vector_store import (VectorStore, backfill_topic_masks, content_hash, init_changelog, init_content_hashes,
+                          near_duplicate_groups, normalize_vector, prune_changelog, row_topic_mask, select_hybrid,
+                          top_k_positions)
+from ann_index import ANNIndex
+from vector_file import VectorFile
+from keyword_groups import KEYWORD_MATCHER
+from embedding_cache import EmbeddingCache
+from lexical_index import LexicalIndex
+from answer_cache import AnswerCache
+from reranker import CrossEncoderReranker, DEFAULT_RERANK_MODEL
+from context_packer import ContextPacker, format_entries
+from reembedding import Reembedder
+from usage_buffer import UsageBuffer
+from model_registry import DEFAULT_MODEL, get_model, prewarm
+from chunking import iter_chunks
 
 logger = logging.getLogger(__name__)
 
 class RAGHandler:
     def __init__(self, db_path='nutrition_bot.db',
-                 model_name='sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'):
+                 model_name=DEFAULT_MODEL,
+                 index_backend=None, index_params=None, ann_candidates=200, quantization=None,
+                 query_cache_size=1024, persist_query_cache=False,
+                 lexical_search=False, lexical_candidates=50, lexical_prefilter=False,
+                 answer_cache=True, answer_cache_threshold=0.92, answer_cache_ttl_hours=72, answer_cache_size=5000,
+                 usage_flush_interval=30.0,
+                 rerank=False, rerank_model=DEFAULT_RERANK_MODEL, rerank_candidates=20, rerank_budget_ms=300,
+                 context_token_budget=600, auto_reembed=True, topic_routing=False):
         self.db_path = db_path
-        self.model = SentenceTransformer(model_name)
+        # Запросы кодируются моделью, которой построены векторы базы (model_name). Если настроена другая
+        # модель (target_model), база переводится на неё фоновой переиндексацией, а до переключения поиск
+        # идёт старой моделью. Модели общие на процесс (model_registry); пока они грузятся в фоне, готовится база
+        self.target_model = model_name
+        self.model_name = VectorFile.active_model(db_path) or model_name
+        prewarm(self.model_name)
+        # Векторы частых вопросов; persist_query_cache сохраняет их рядом с базой между перезапусками
+        self.query_cache_size = query_cache_size
+        self.query_cache_path = db_path + ".query_cache.npz" if persist_query_cache else None
+        self.query_cache = EmbeddingCache(self.model_name, max_size=query_cache_size, path=self.query_cache_path)
+        self.vector_file = VectorFile(db_path)
+        # Чанки, уже записанные в базу (тот же content_hash), при повторной загрузке не кодируются:
+        # reused — сколько чанков нашлось в базе, encoded — сколько пришлось закодировать
+        self.chunk_stats = {"reused": 0, "encoded": 0}
+        # Матрица и ANN-индекс меняются при синхронизации с журналом; потоки пула AsyncRAG
+        # работают с ними по очереди, а векторизация и запросы к LLM идут параллельно
+        self._store_lock = threading.RLock()
+        # Полнотекстовый BM25-поиск дополняет векторный; lexical_prefilter без ANN-индекса считает
+        # близость только по его совпадениям, если их хватает на top_k. Выключен по умолчанию: запрос к FTS5
+        # дороже точного перебора матрицы, включать его стоит, если bench_retrieval покажет выигрыш в recall@k
+        self.lexical_index = LexicalIndex(db_path) if lexical_search else None
+        self.lexical_candidates = lexical_candidates
+        self.lexical_prefilter = lexical_prefilter
+        # Семантический кэш ответов: близкий к сохранённому вопрос получает готовый ответ без LLM
+        self.answer_cache = AnswerCache(db_path, answer_cache_threshold, answer_cache_ttl_hours,
+                                        answer_cache_size) if answer_cache else None
+        # usage_count/last_used копятся в памяти и пишутся пачкой раз в usage_flush_interval секунд
+        self.usage_buffer = UsageBuffer(db_path, flush_interval=usage_flush_interval)
         self.init_vector_db()
+        self._vector_store = None
+        # ANN-индекс (hnsw/ivf) и квантование (float16/int8) необязательны: они отбирают ann_candidates
+        # кандидатов, которые затем пересчитываются точно; без них поиск идёт точным перебором
+        self.ann_candidates = ann_candidates
+        self.quantization = quantization
+        # Запрос, в котором ключевые слова KEYWORD_GROUPS стоят целыми словами, оценивается только по шардам
+        # этих тем и общему шарду; если там не набралось top_k записей выше порога, он пересчитывается по всей
+        # базе. Выключено, пока bench_retrieval не покажет тот же recall@k, что и без шардов
+        self.topic_routing = topic_routing
+        self.routing_stats = {"routed": 0, "scored": 0, "total": 0, "fallback": 0}
+        self._ann_index = None
+        if index_backend:
+            self._ann_index = ANNIndex(db_path, index_backend, **(index_params or {}))
+            self._ann_index.load()
+        # Необязательное переранжирование rerank_candidates лучших кандидатов кросс-энкодером; не уложившись
+        # в rerank_budget_ms, поиск возвращает порядок би-энкодера
+        self.reranker = CrossEncoderReranker(rerank_model, budget_ms=rerank_budget_ms) if rerank else None
+        self.rerank_candidates = rerank_candidates
+        # Контекст промпта собирается из лучших предложений записей в пределах context_token_budget токенов;
+        # None — записи целиком, как раньше
+        self.context_packer = ContextPacker(
+            lambda texts: self.model.encode(texts, batch_size=64, show_progress_bar=False), self.model_name,
+            token_budget=context_token_budget) if context_token_budget else None
+        self.reembedder = None
+        if auto_reembed and self.target_model != self.model_name:
+            logger.warning(f"Векторы базы построены моделью {self.model_name}, настроена {self.target_model}: "
+                           f"запускается фоновая переиндексация")
+            self.start_reembedding(self.target_model)
         self.abbreviations = {
             "жкт": "желудочно-кишечный тракт",
             "цнс": "центральная нервная система",
@@ -36,9 +104,40 @@ class RAGHandler:
             "антиокс": "антиоксидант"
         }
 
+    @property
+    def model(self):
+        return get_model(self.model_name)
+
+    def get_embedding_model(self, model_name):
+        return get_model(model_name)
+
+    def _use_model(self, model_name):
+        """Переход на модель нового файла векторов после переиндексации: кэши векторов прежней модели не годятся"""
+        logger.info(f"Поиск переключён с модели {self.model_name} на {model_name}")
+        self.model_name = model_name
+        self.query_cache = EmbeddingCache(model_name, max_size=self.query_cache_size, path=self.query_cache_path)
+        if self.context_packer is not None:
+            self.context_packer.sentence_cache = EmbeddingCache(model_name, max_size=4096)
+
+    def start_reembedding(self, model_name=None, batch_size=256):
+        """Запускает фоновую переиндексацию базы моделью model_name (по умолчанию — настроенной target_model)"""
+        model_name = model_name or self.target_model
+        if self.reembedder is not None and self.reembedder.is_running():
+            raise RuntimeError(f"Переиндексация моделью {self.reembedder.target_model} уже идёт")
+        if model_name == self.model_name:
+            raise ValueError(f"Векторы базы уже построены моделью {model_name}")
+        self.target_model = model_name
+        self.reembedder = Reembedder(self, model_name, batch_size=batch_size)
+        self.reembedder.start()
+        return self.reembedder
+
+    def reembed_status(self):
+        return self.reembedder.status() if self.reembedder is not None else None
+
     def init_vector_db(self):
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
+        # vector — устаревшая BLOB-колонка; векторы хранятся в файле векторов по смещению vector_offset
         cursor.execute('''CREATE TABLE IF NOT EXISTS knowledge_vectors (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
                         question TEXT,
@@ -48,16 +147,72 @@ class RAGHandler:
                         last_used DATETIME,
                         usage_count INTEGER DEFAULT 1,
                         is_from_pdf BOOLEAN DEFAULT 0,
-                        tags TEXT)''')
+                        tags TEXT,
+                        vector_offset INTEGER,
+                        topic_mask INTEGER,
+                        content_hash TEXT)''')
+        init_changelog(cursor)
+        VectorFile.init_schema(cursor)
+        AnswerCache.init_schema(cursor)
+        conn.commit()
+        # Дубли сливаются до переноса векторов, чтобы не занимать ими строки файла
+        init_content_hashes(conn)
+        backfill_topic_masks(conn)
+        if self.lexical_index is not None:
+            self.lexical_index.init_schema(conn)
+        # Размерность известна только после загрузки модели, поэтому перенос векторов — последним
+        self.vector_file.migrate_blobs(conn, self.model.get_sentence_embedding_dimension())
+        VectorFile.init_model(cursor, self.model_name)
         conn.commit()
         conn.close()
         logger.info("Векторная база знаний инициализирована")
 
-    def text_to_vector(self, text):
+    def backfill_topic_masks(self, force=False):
+        """Пересчёт тематических масок записей; force=True — для всех записей после правки KEYWORD_GROUPS"""
+        conn = sqlite3.connect(self.db_path)
+        updated = backfill_topic_masks(conn, force=force)
+        conn.close()
+        return updated
+
+    def text_to_vector(self, text, use_cache=False):
         if not text or not isinstance(text, str):
             logger.warning("Попытка векторизации пустого текста")
             return np.zeros(self.model.get_sentence_embedding_dimension())
-        return self.model.encode(text)
+        if not use_cache:
+            return self.model.encode(text)
+        vector = self.query_cache.get(text)
+        if vector is None:
+            vector = self.query_cache.put(text, self.model.encode(text))
+        return vector
+
+    def texts_to_vectors(self, texts, use_cache=False, batch_size=64):
+        """Векторы для списка текстов; всё, чего нет в кэше, кодируется одним вызовом модели"""
+        vectors = [None] * len(texts)
+        missing = []
+        for i, text in enumerate(texts):
+            if not text or not isinstance(text, str):
+                vectors[i] = self.text_to_vector(text)
+                continue
+            if use_cache:
+                vectors[i] = self.query_cache.get(text)
+            if vectors[i] is None:
+                missing.append(i)
+        if missing:
+            encoded = self.model.encode([texts[i] for i in missing], batch_size=batch_size, show_progress_bar=False)
+            for i, vector in zip(missing, encoded):
+                vectors[i] = self.query_cache.put(texts[i], vector) if use_cache else vector
+        return vectors
+
+    def chunk_embedding_stats(self):
+        total = self.chunk_stats["reused"] + self.chunk_stats["encoded"]
+        return dict(self.chunk_stats, reuse_rate=self.chunk_stats["reused"] / total if total else 0.0)
+
+    def save_query_cache(self):
+        self.query_cache.save()
+
+    def flush_usage_counts(self):
+        """Записывает накопленные счётчики использования перед чтением usage_count/last_used из базы"""
+        return self.usage_buffer.flush()
 
     def vector_to_blob(self, vector):
         return vector.tobytes()
@@ -74,268 +229,436 @@ class RAGHandler:
         logger.debug(f"Расширенный запрос: {expanded_query}")
         return expanded_query.strip()
 
-    def _split_text_into_chunks(self, text: str, chunk_size: int = 2000) -> list:
-        """Разбивает текст на чанки по предложениям, сохраняя смысловую целостность"""
-        sentences = sent_tokenize(text, language="russian")
-        chunks = []
-        current_chunk = ""
-        for sentence in sentences:
-            if len(current_chunk) + len(sentence) <= chunk_size:
-                current_chunk += sentence + " "
-            else:
-                if current_chunk.strip():
-                    chunks.append(current_chunk.strip())
-                current_chunk = sentence + " "
-        if current_chunk.strip():
-            chunks.append(current_chunk.strip())
-        logger.debug(f"Текст разбит на {len(chunks)} чанков")
-        return chunks
+    def _get_vector_store(self):
+        """Матрица векторов строится один раз, дальше к ней и к ANN-индексу применяются изменения из журнала"""
+        store = self._vector_store
+        if store is None:
+            store = VectorStore(self.model.get_sentence_embedding_dimension(), self.quantization, self.model_name)
+            store.load(self.db_path)
+            self._vector_store = store
+            if self._ann_index is not None and not self._ann_index.catch_up(store):
+                logger.warning("ANN-индекс устарел или отсутствует, используется точный поиск")
+            return store
+
+        ann_was_fresh = self._ann_index is not None and self._ann_index.is_fresh(store)
+        changes = store.sync(self.db_path)
+        if changes is None and store.model_name != self.model_name:
+            # Переиндексация подменила файл: дальше запросы кодируются новой моделью, ANN-индекс строится заново
+            self._use_model(store.model_name)
+            if self._ann_index is not None:
+                self._ann_index.build(store)
+                self._ann_index.save()
+        elif changes is None:
+            # id записей при уплотнении файла не меняются, поэтому индекс достаточно довести по журналу
+            if self._ann_index is not None and not self._ann_index.catch_up(store):
+                logger.warning("ANN-индекс устарел после перезагрузки матрицы, используется точный поиск")
+        elif ann_was_fresh and (changes[0] or changes[1]):
+            self._ann_index.apply_changes(store, *changes)
+        elif ann_was_fresh:
+            self._ann_index.meta.update(last_seq=store.last_seq)
+        return store
+
+    def save_ann_index(self):
+        """Сохраняет инкрементально обновлённый ANN-индекс, если он актуален"""
+        with self._store_lock:
+            if self._ann_index is not None and self._vector_store is not None \
+                    and self._ann_index.is_fresh(self._vector_store):
+                self._ann_index.save()
+
+    def build_ann_index(self):
+        """Перестраивает ANN-индекс по текущим векторам и сохраняет его рядом с базой. Под блокировкой матрицы
+        только снимается копия векторов и подключается готовый индекс: построение и запись файлов идут без неё,
+        а изменения, пришедшие за это время, индекс догоняет по журналу"""
+        if self._ann_index is None:
+            logger.warning("ANN-индекс не настроен (index_backend=None)")
+            return
+        with self._store_lock:
+            snapshot = ANNIndex.snapshot(self._get_vector_store())
+        impl, meta = self._ann_index.build_snapshot(*snapshot)
+        self._ann_index.write_staged(impl, meta)
+        with self._store_lock:
+            store = self._get_vector_store()
+            if meta["model"] != store.model_name or meta["dim"] != store.dim:
+                # Переиндексация сменила модель, пока строился индекс: её индекс уже построен при переключении
+                logger.info("ANN-индекс построен по векторам прежней модели и не подключается")
+                self._ann_index.discard_staged()
+                return
+            self._ann_index.install_staged(impl, meta)
+            if not self._ann_index.catch_up(store):
+                logger.warning("ANN-индекс не догнал журнал после перестроения, используется точный поиск")
+
+    def _candidate_positions(self, store, query_vector, top_k, lexical_positions):
+        """Кандидаты из ANN-индекса или сжатой матрицы вместе с полнотекстовыми совпадениями;
+        None, если нужен точный перебор всей матрицы"""
+        k = max(self.ann_candidates, top_k)
+        if k >= store.live_count:
+            return None
+        if self._ann_index is not None and self._ann_index.is_fresh(store):
+            ids = self._ann_index.search(normalize_vector(query_vector), k)
+            candidates = store.positions_for_ids(ids)
+        elif store.quantization:
+            candidates = store.coarse_candidates(query_vector, k)
+        elif self.lexical_prefilter and len(lexical_positions) >= top_k:
+            return lexical_positions
+        else:
+            return None
+        return np.union1d(candidates, lexical_positions)
+
+    def _route_to_shards(self, store, query_mask, candidates, lexical_positions, top_k):
+        """Оставляет кандидатов из тематических шардов запроса и общего шарда. Кандидаты ANN-индекса или
+        сжатой матрицы фильтруются по шардам; если после фильтра их меньше top_k (или кандидатов нет
+        и нужен полный перебор), точно оцениваются все строки шардов. Полнотекстовые совпадения остаются"""
+        routed = None
+        if candidates is not None:
+            routed = candidates[store.in_topic_shards(candidates, query_mask)]
+        if routed is None or len(routed) < top_k:
+            routed = store.topic_positions(query_mask)
+        self.routing_stats["routed"] += 1
+        self.routing_stats["scored"] += len(routed)
+        self.routing_stats["total"] += store.live_count
+        return np.union1d(routed, lexical_positions) if len(lexical_positions) else routed
+
+    def topic_routing_stats(self):
+        """Число запросов, направленных в тематические шарды, и средняя доля оценённых ими записей базы"""
+        stats = self.routing_stats
+        return {"routed": stats["routed"], "fallback": stats["fallback"],
+                "fraction": stats["scored"] / stats["total"] if stats["total"] else 0.0}
 
     def find_relevant_context(self, query, threshold=0.7, top_k=3, min_threshold=0.4):
-        expanded_query = self.expand_abbreviations(query)
-        query_vector = self.text_to_vector(expanded_query)
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT id, question, answer, context, vector, is_from_pdf, tags 
-                         FROM knowledge_vectors''')
-        results = cursor.fetchall()
-        conn.close()
-
-        similarities = []
-        query_lower = expanded_query.lower()
-        keyword_groups = {
-            "heart": [
-                "сердце", "сосуды", "кровообращение", "давление", "холестерин", "гипертония", "артерии",
-                "аритмия", "тахикардия", "брадикардия", "атеросклероз", "сердечная недостаточность",
-                "кровяное давление", "венозная система", "капилляры", "сердечный ритм", "миокард"
-            ],
-            "sleep": [
-                "сон", "бессонница", "уснуть", "отдых", "расслабление", "спать", "ночной",
-                "качество сна", "глубокий сон", "проблемы со сном", "сонливость", "циркадный ритм",
-                "мелатонин", "нарушение сна", "дневная усталость", "пробуждение"
-            ],
-            "stress": [
-                "стресс", "тревога", "напряжение", "нервы", "успокоение", "паника", "эмоции",
-                "нервозность", "переутомление", "выгорание", "эмоциональное напряжение", "релаксация",
-                "психоэмоциональное состояние", "стрессоустойчивость", "кортизол", "адаптация"
-            ],
-            "energy": [
-                "энергия", "бодрость", "усталость", "активность", "жизненная сила", "тонус",
-                "упадок сил", "энергичность", "вялость", "хроническая усталость", "выносливость",
-                "митохондрии", "энергетический баланс", "жизненный тонус", "сила"
-            ],
-            "gut": [
-                "жкт", "пищеварение", "желудок", "кишечник", "микрофлора", "запор", "диарея",
-                "гастрит", "дисбактериоз", "вздутие", "рефлюкс", "перистальтика", "энзимы",
-                "микробиом", "синдром раздраженного кишечника", "ферменты", "кишечная проницаемость",
-                "язва", "колит"
-            ],
-            "immunity": [
-                "иммунитет", "защита организма", "инфекции", "простуда", "вирусы", "иммунная система",
-                "грипп", "ОРВИ", "иммунодефицит", "иммунный ответ", "вакцинация", "антитела",
-                "лимфоциты", "воспалительные процессы", "интерфероны", "укрепление иммунитета"
-            ],
-            "joints": [
-                "суставы", "кости", "хрящи", "артрит", "боль в суставах", "гибкость", "остеопороз",
-                "артроз", "ревматизм", "остеохондроз", "подагра", "хондропротекторы", "синовиальная жидкость",
-                "суставная смазка", "коллаген", "минерализация костей", "переломы"
-            ],
-            "skin": [
-                "кожа", "дерма", "акне", "прыщи", "увлажнение кожи", "экзема", "псориаз",
-                "дерматит", "сухость кожи", "морщины", "пигментация", "покраснение", "сыпь",
-                "коллаген кожи", "эластичность кожи", "заживление ран", "кожный зуд", "шелушение"
-            ],
-            "hair": [
-                "волосы", "выпадение волос", "ломкость волос", "перхоть", "рост волос", "здоровье волос",
-                "себорея", "алопеция", "секущиеся концы", "укрепление волос", "волосяные луковицы",
-                "кожа головы", "жирность волос", "сухость волос", "блеск волос"
-            ],
-            "vision": [
-                "зрение", "глаза", "усталость глаз", "катаракта", "глаукома", "здоровье глаз",
-                "дальнозоркость", "близорукость", "астигматизм", "сухость глаз", "сетчатка",
-                "хрусталик", "глазное давление", "зрительная нагрузка", "цветовое восприятие"
-            ],
-            "hormones": [
-                "гормоны", "гормональный баланс", "щитовидка", "менопауза", "либидо", "эндокринная система",
-                "тиреоидные гормоны", "эстроген", "прогестерон", "тестостерон", "инсулин",
-                "гормон роста", "адреналин", "гормональный сбой", "надпочечники", "гипоталамус"
-            ],
-            "detox": [
-                "детоксикация", "очищение организма", "токсины", "печень", "почки", "чистка",
-                "шлаки", "детокс-программы", "антиоксиданты", "выведение токсинов", "лимфодренаж",
-                "очищение кишечника", "гепатопротекторы", "очищение крови", "почечная фильтрация"
-            ],
-            "weight": [
-                "вес", "похудение", "лишний вес", "ожирение", "метаболизм", "контроль веса",
-                "жиросжигание", "масса тела", "диета", "калорийность", "аппетит", "набор веса",
-                "индекс массы тела", "обмен веществ", "жировая ткань", "стройность"
-            ],
-            "muscles": [
-                "мышцы", "мышечная масса", "боль в мышцах", "восстановление мышц", "сила",
-                "спазмы", "крепатура", "мышечный тонус", "рост мышц", "миофибриллы",
-                "анаболизм", "белковый синтез", "мышечная выносливость", "растяжение мышц"
-            ],
-            "allergies": [
-                "аллергия", "аллергические реакции", "сыпь", "зуд", "астма", "ринит",
-                "анафилаксия", "аллергены", "гистамин", "поллиноз", "пищевая аллергия",
-                "контактный дерматит", "крапивница", "отек Квинке", "аллергический кашель"
-            ],
-            "respiratory": [
-                "дыхание", "легкие", "бронхи", "кашель", "одышка", "дыхательная система",
-                "бронхит", "пневмония", "туберкулез", "хрипы", "оксигенация", "дыхательная гимнастика",
-                "мукоцилиарный клиренс", "легочная вентиляция", "эмфизема"
-            ],
-            "blood_sugar": [
-                "сахар в крови", "диабет", "глюкоза", "инсулин", "гликемия",
-                "гипогликемия", "гиергликемия", "глюкометр", "гликемический индекс",
-                "инсулинорезистентность", "диабет 2 типа", "углеводный обмен", "панкреас"
-            ],
-            "memory": [
-                "память", "концентрация", "мозг", "когнитивные функции", "фокус", "ясность ума",
-                "нейропластичность", "запоминание", "внимание", "умственная работоспособность",
-                "когнитивный спад", "деменция", "нейротрансмиттеры", "мозговая активность"
-            ],
-            "inflammation": [
-                "воспаление", "противовоспалительное", "отек", "хроническое воспаление",
-                "цитокины", "воспалительные маркеры", "боль при воспалении", "покраснение",
-                "воспалительный процесс", "иммунное воспаление", "острые воспаления"
-            ],
-            "circulation": [
-                "кровоток", "микроциркуляция", "варикоз", "тромбы", "капилляры",
-                "венозный отток", "кровообращение", "гемодинамика", "тромбофлебит",
-                "кровяные сгустки", "артериальный кровоток", "лимфоток", "ангиопатия"
-            ],
-            # Новые группы
-            "liver": [
-                "печень", "гепатопротекторы", "желчь", "гепатит", "цирроз", "жировой гепатоз",
-                "детоксикация печени", "ферменты печени", "холестаз", "печеночная недостаточность",
-                "очищение печени", "желчегонные", "печеночный метаболизм"
-            ],
-            "reproductive": [
-                "репродуктивное здоровье", "фертильность", "менструация", "беременность", "либидо",
-                "эректильная дисфункция", "простата", "яичники", "матка", "сперматогенез",
-                "овуляция", "репродуктивная система", "бесплодие", "гормоны пола"
-            ],
-            "mental_health": [
-                "психическое здоровье", "депрессия", "тревожное расстройство", "эмоциональное состояние",
-                "психоэмоциональный баланс", "апатия", "настроение", "биполярное расстройство",
-                "психологическое благополучие", "антидепрессанты", "серотонин"
-            ],
-            "thyroid": [
-                "щитовидная железа", "тиреоидные гормоны", "гипотериоз", "гипертериоз", "зоб",
-                "йод", "тироксин", "ТТГ", "аутоиммунный тиреоидит", "узлы щитовидки",
-                "метаболизм щитовидки", "эндокринология"
-            ],
-            "kidneys": [
-                "почки", "мочевыделительная система", "почечная недостаточность", "мочекаменная болезнь",
-                "пиелонефрит", "почечная фильтрация", "мочеиспускание", "уремия", "диуретики",
-                "отечность", "почечные канальцы", "гломерулонефрит"
-            ],
-            "pain": [
-                "боль", "хроническая боль", "головная боль", "мигрень", "невралгия", "мышечная боль",
-                "суставная боль", "болеутоляющее", "спазмолитическое", "боль в спине", "острая боль",
-                "фибромиалгия", "боль в шее"
-            ],
-            "aging": [
-                "старение", "антивозрастной", "долголетие", "возрастные изменения", "антиоксиданты",
-                "клеточное обновление", "морщины", "снижение тонуса", "возрастной метаболизм",
-                "гериатрия", "оксидативный стресс", "теломеры"
-            ]
-        }
+        return self.find_relevant_context_many([query], threshold, top_k, min_threshold)[0]
+
+    def find_relevant_context_many(self, queries, threshold=0.7, top_k=3, min_threshold=0.4):
+        """Поиск для списка запросов: все запросы кодируются одним вызовом модели, а запросы без
+        кандидатов из индекса оцениваются одним умножением матрицы базы на матрицу запросов.
+        Возвращает списки записей в порядке queries с теми же правилами отбора, что и для одного запроса"""
+        expanded_queries = [self.expand_abbreviations(query) for query in queries]
+        model_name = self.model_name
+        query_vectors = self.texts_to_vectors(expanded_queries, use_cache=True)
+        # Полнотекстовый поиск идёт в своём соединении SQLite и матрицы не касается
+        lexical_hits = [self.lexical_index.search(expanded_query, self.lexical_candidates)
+                        if self.lexical_index is not None else [] for expanded_query in expanded_queries]
+        search_k = max(top_k, self.rerank_candidates) if self.reranker is not None else top_k
+        with self._store_lock:
+            results = self._search_store(expanded_queries, query_vectors, lexical_hits,
+                                         threshold, search_k, min_threshold, model_name)
+        if self.reranker is not None:
+            results = [self._rerank(query, found, top_k) for query, found in zip(expanded_queries, results)]
+
+        if len(queries) == 1:
+            logger.info(f"Найдено {len(results[0])} релевантных записей: "
+                        f"threshold={threshold}, min_threshold={min_threshold}")
+        else:
+            logger.info(f"Пакетный поиск: {len(queries)} запросов, найдено {sum(map(len, results))} записей: "
+                        f"threshold={threshold}, min_threshold={min_threshold}")
+        return results
 
-        seen_entries = set()
-        for row in results:
-            vec_id, question, answer, context, vec_blob, is_from_pdf, tags = row
-            text_to_compare = context if context else (question or answer)
-            if not text_to_compare:
-                logger.warning(f"Пустая запись в базе: id={vec_id}")
-                continue
+    def _search_store(self, expanded_queries, query_vectors, lexical_hits, threshold, top_k, min_threshold,
+                      model_name):
+        store = self._get_vector_store()
+        if not len(store):
+            return [[] for _ in expanded_queries]
+        if store.model_name != model_name:
+            # Файл векторов переключили на другую модель, пока запросы кодировались
+            query_vectors = self.texts_to_vectors(expanded_queries, use_cache=True)
+
+        query_masks = [KEYWORD_MATCHER.mask(expanded_query) for expanded_query in expanded_queries]
+        # Шарды выбираются только по ключевым словам, стоящим целыми словами: подстрока («вес» в «весной»)
+        # увела бы запрос в чужую тему
+        route_masks = [KEYWORD_MATCHER.word_mask(expanded_query) if self.topic_routing else 0
+                       for expanded_query in expanded_queries]
+        # Кандидаты без маршрутизации для запросов, направленных в шарды (None — полный перебор)
+        unrouted = {}
+        candidates, lexical_ranks = [], []
+        for query_vector, hits, route_mask in zip(query_vectors, lexical_hits, route_masks):
+            # Ранги полнотекстового поиска по позициям матрицы (-1 — совпадения нет)
+            ranks = np.full(len(store), -1, dtype=np.int64)
+            for rank, vec_id in enumerate(hits):
+                pos = store.id_to_pos.get(vec_id)
+                if pos is not None:
+                    ranks[pos] = rank
+            lexical_ranks.append(ranks)
+            lexical_positions = np.nonzero(ranks >= 0)[0]
+            positions = self._candidate_positions(store, query_vector, top_k, lexical_positions)
+            if route_mask:
+                unrouted[len(candidates)] = positions
+                positions = self._route_to_shards(store, route_mask, positions, lexical_positions, top_k)
+            candidates.append(positions)
+
+        # Столбец общей матрицы близостей для каждого запроса, которому нужен полный перебор. Строки
+        # тематических шардов разбросаны по матрице, и выборка больше половины базы копируется дольше,
+        # чем идёт полный проход, — такие запросы тоже считаются по общей матрице и берут из неё свои строки
+        full_scan = {i: column for column, i in
+                     enumerate(i for i, positions in enumerate(candidates)
+                               if positions is None or len(positions) > len(store) // 2)}
+        if full_scan:
+            full_similarities = store.similarities_many([query_vectors[i] for i in full_scan])
+
+        def select(i, positions):
+            if i in full_scan:
+                column = full_similarities[:, full_scan[i]]
+                similarities = column if positions is None else column[positions]
+            else:
+                similarities = store.similarities(query_vectors[i], positions)
+            if positions is None:
+                positions = np.arange(len(store))
+            return self._select_context(store, query_masks[i], positions, similarities,
+                                        lexical_ranks[i][positions], threshold, top_k, min_threshold)
+
+        results = []
+        for i in range(len(expanded_queries)):
+            found = select(i, candidates[i])
+            if i in unrouted and sum(entry[4] >= threshold for entry in found) < top_k:
+                # Шарды лишь ускоряют поиск и не должны терять записи: не набрав top_k выше порога,
+                # запрос оценивается без маршрутизации
+                self.routing_stats["fallback"] += 1
+                found = select(i, unrouted[i])
+            results.append(found)
+        return results
 
-            entry_key = (question or "", answer or "", context or "")
-            if entry_key in seen_entries:
-                logger.debug(f"Пропущена дублирующаяся запись: id={vec_id}")
-                continue
-            seen_entries.add(entry_key)
-
-            stored_vector = self.blob_to_vector(vec_blob)
-            similarity = cosine_similarity([query_vector], [stored_vector])[0][0]
-
-            text_lower = text_to_compare.lower()
-            tags_lower = tags.lower() if tags else ""
-            keyword_boost = 1.0
-            for group, keywords in keyword_groups.items():
-                if any(kw in query_lower for kw in keywords) and \
-                   (any(kw in text_lower for kw in keywords) or any(kw in tags_lower for kw in keywords)):
-                    keyword_boost = 1.5
-                    break
-
-            adjusted_similarity = similarity * (1.2 if is_from_pdf else 1.0) * keyword_boost
-            similarities.append((vec_id, question, answer, context, adjusted_similarity, is_from_pdf, tags))
-
-        similarities.sort(key=lambda x: x[4], reverse=True)
-        filtered = [item for item in similarities if item[4] >= threshold][:top_k]
-        if not filtered and similarities:
-            filtered = [item for item in similarities if item[4] >= min_threshold][:top_k]
-        logger.info(f"Найдено {len(filtered)} релевантных записей: threshold={threshold}, min_threshold={min_threshold}")
+    def _select_context(self, store, query_mask, positions, similarities, lexical_ranks,
+                        threshold, top_k, min_threshold):
+        scores = similarities * np.where(store.is_from_pdf[positions], 1.2, 1.0)
+        scores[~store.valid[positions]] = -np.inf
+
+        # Буст 1.5, если запрос и запись относятся к одной тематической группе
+        if query_mask:
+            scores = np.where((store.topic_masks[positions] & query_mask) != 0, scores * 1.5, scores)
+
+        filtered = []
+        for i in select_hybrid(scores, lexical_ranks, threshold, top_k, min_threshold):
+            pos = positions[i]
+            question, answer, context, tags = store.rows[pos]
+            filtered.append((int(store.ids[pos]), question, answer, context, float(scores[i]),
+                             bool(store.is_from_pdf[pos]), tags))
         return filtered
 
-    def add_to_knowledge_base(self, question=None, answer=None, context=None, is_from_pdf=False, tags=None):
-        text_to_vectorize = context if context else question
-        if not text_to_vectorize:
-            logger.warning("Попытка добавить пустую запись")
-            return
+    def _rerank(self, query, found, top_k):
+        """Первые top_k записей по оценке кросс-энкодера; схожесть в записях остаётся от би-энкодера"""
+        if len(found) <= 1:
+            return found[:top_k]
+        texts = [f"{q}\n{a}" if q and a else ctx or q for _, q, a, ctx, _, _, _ in found]
+        scores = self.reranker.rerank(query, texts)
+        if scores is None:
+            return found[:top_k]
+        order = sorted(range(len(found)), key=lambda i: -scores[i])
+        return [found[i] for i in order[:top_k]]
 
-        # Разбиваем длинный контекст на чанки, если нужно
-        if context and len(context) > 2000:
-            chunks = self._split_text_into_chunks(context, chunk_size=2000)
-        else:
-            chunks = [context] if context else [question]
+    def add_to_knowledge_base(self, question=None, answer=None, context=None, is_from_pdf=False, tags=None):
+        added = self.add_many_to_knowledge_base([(question, answer, context, tags)], is_from_pdf=is_from_pdf)
+        if added:
+            logger.info(f"Добавлено {added} чанков: question={question}, is_from_pdf={is_from_pdf}")
+
+    def add_many_to_knowledge_base(self, records, is_from_pdf=False, batch_size=64):
+        """Пакетное добавление записей (question, answer, context, tags) одной транзакцией.
+
+        Длинный контекст режется на чанки, все чанки векторизуются пачками по batch_size,
+        новые записи вставляются через executemany. Повторный вопрос, уже известный базе или
+        встретившийся раньше в этой пачке, обновляет существующую запись; запись с уже известным
+        content_hash не вставляется, а увеличивает usage_count. Возвращает число чанков.
+        """
+        entries = []
+        for question, answer, context, tags in records:
+            if not (context if context else question):
+                logger.warning("Попытка добавить пустую запись")
+                continue
+            # Разбиваем длинный контекст на чанки, если нужно
+            if context and len(context) > 2000:
+                chunks = iter_chunks(context, chunk_size=2000)
+            else:
+                chunks = [context] if context else [question]
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if question and chunk == question:
+                    entries.append((question, answer, context, tags, chunk))
+                else:
+                    entries.append((None, None, chunk, tags, chunk))
+        if not entries:
+            return 0
+
+        # Вектор нужен только новым записям: повторно загруженный чанк (тот же content_hash) и правка
+        # известного вопроса вектор не меняют. Векторизуем до захвата блокировки записи, чтобы не держать
+        # её во время работы модели
+        model_name = self.model_name
+        hashes = [content_hash(*entry[:3]) for entry in entries]
+        conn = sqlite3.connect(self.db_path)
+        new = self._plan_entries(entries, hashes, *self._known_entries(conn.cursor(), entries, hashes))[0]
+        conn.close()
+        vectors = dict(zip(new, self._encode_entries(entries, new, model_name, batch_size)))
+        self.chunk_stats["reused"] += len(entries) - len(new)
+        self.chunk_stats["encoded"] += len(new)
+        now = datetime.now().isoformat()
 
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        active_model = VectorFile.current_model(cursor) or model_name
+        if active_model != model_name:
+            # Переиндексация переключила файл векторов, пока шла векторизация: векторы прежней модели не годятся
+            model_name = active_model
+            vectors = {}
+        dim = get_model(model_name).get_sentence_embedding_dimension()
+        new, changed, repeated = self._plan_entries(entries, hashes, *self._known_entries(cursor, entries, hashes))
+        missing = [i for i in new if i not in vectors]
+        if missing:
+            # Записи удалили или модель сменилась, пока шла векторизация: недостающее кодируем под транзакцией
+            vectors.update(zip(missing, self._encode_entries(entries, missing, model_name, batch_size)))
+
+        inserts, insert_vectors, updates = [], [], []
+        for i in new:
+            question, answer, context, tags, _ = entries[i]
+            inserts.append((question, answer, context, now, int(is_from_pdf), tags,
+                            row_topic_mask(question, answer, context, tags), hashes[i]))
+            insert_vectors.append(vectors[i])
+        for i in changed:
+            question, answer, context, tags, _ = entries[i]
+            updates.append((now, answer, context, tags, row_topic_mask(question, answer, context, tags),
+                            hashes[i], question))
+        bumps = [(now, hashes[i]) for i in repeated]
+
+        if inserts:
+            offsets = self.vector_file.append(cursor, insert_vectors, dim, model_name)
+            cursor.executemany('''INSERT INTO knowledge_vectors
+                                (question, answer, context, vector, vector_offset, last_used, is_from_pdf, tags,
+                                 topic_mask, content_hash, embedding_model)
+                                VALUES (?, ?, ?, x'', ?, ?, ?, ?, ?, ?, ?)''',
+                               [row[:3] + (offset,) + row[3:] + (model_name,) for row, offset in zip(inserts, offsets)])
+        if updates:
+            # OR IGNORE: если после правки запись совпала бы с другой, оставляем её как есть
+            cursor.executemany('''UPDATE OR IGNORE knowledge_vectors
+                                SET usage_count = usage_count + 1, last_used = ?, answer = ?, context = ?, tags = ?,
+                                    topic_mask = ?, content_hash = ?
+                                WHERE id = (SELECT MIN(id) FROM knowledge_vectors WHERE question = ?)''', updates)
+        if bumps:
+            cursor.executemany('''UPDATE knowledge_vectors SET usage_count = usage_count + 1, last_used = ?
+                                WHERE content_hash = ?''', bumps)
 
-        for chunk in chunks:
-            if not chunk:
+        conn.commit()
+        conn.close()
+        logger.debug(f"Пакетное добавление: {len(inserts)} новых записей, {len(updates)} обновлений, "
+                     f"{len(bumps)} повторов")
+        return len(entries)
+
+    @staticmethod
+    def _known_entries(cursor, entries, hashes):
+        """Вопросы и хеши содержимого entries, которые уже есть в базе"""
+        questions = list({entry[0] for entry in entries if entry[0]})
+        known_questions, known_hashes = set(), set()
+        for start in range(0, len(questions), 500):
+            batch = questions[start:start + 500]
+            cursor.execute(f'''SELECT DISTINCT question FROM knowledge_vectors
+                             WHERE question IN ({",".join("?" * len(batch))})''', batch)
+            known_questions.update(row[0] for row in cursor.fetchall())
+        unique_hashes = list(set(hashes))
+        for start in range(0, len(unique_hashes), 500):
+            batch = unique_hashes[start:start + 500]
+            cursor.execute(f'''SELECT content_hash FROM knowledge_vectors
+                             WHERE content_hash IN ({",".join("?" * len(batch))})''', batch)
+            known_hashes.update(row[0] for row in cursor.fetchall())
+        return known_questions, known_hashes
+
+    @staticmethod
+    def _plan_entries(entries, hashes, known_questions, known_hashes):
+        """Индексы entries: новые записи, правки известных вопросов и повторы известного содержимого.
+        Повтор вопроса или содержимого внутри пачки считается известным"""
+        known_questions, known_hashes = set(known_questions), set(known_hashes)
+        new, changed, repeated = [], [], []
+        for i, (question, digest) in enumerate(zip((entry[0] for entry in entries), hashes)):
+            if question and question in known_questions:
+                changed.append(i)
+                known_hashes.add(digest)
                 continue
-            vector = self.text_to_vector(chunk)
-            vector_blob = self.vector_to_blob(vector)
-
-            if question and chunk == question:
-                cursor.execute('''SELECT id, usage_count FROM knowledge_vectors 
-                                WHERE question = ? LIMIT 1''', (question,))
-                existing = cursor.fetchone()
-                if existing:
-                    vec_id, count = existing
-                    cursor.execute('''UPDATE knowledge_vectors 
-                                    SET usage_count = ?, last_used = ?, answer = ?, context = ?, tags = ?
-                                    WHERE id = ?''',
-                                   (count + 1, datetime.now().isoformat(), answer, context, tags, vec_id))
-                    logger.debug(f"Обновлена существующая запись: question={question}")
+            if digest in known_hashes:
+                repeated.append(i)
+                continue
+            if question:
+                known_questions.add(question)
+            known_hashes.add(digest)
+            new.append(i)
+        return new, changed, repeated
+
+    def _encode_entries(self, entries, indices, model_name, batch_size):
+        if not indices:
+            return []
+        return get_model(model_name).encode([entries[i][4] for i in indices], batch_size=batch_size,
+                                            show_progress_bar=False)
+
+    def _cached_answer(self, query):
+        """Готовый ответ на сохранённый вопрос, достаточно близкий к запросу, или None"""
+        model_name = self.model_name
+        query_vector = self.text_to_vector(self.expand_abbreviations(query), use_cache=True)
+        candidates = []
+        with self._store_lock:
+            store = self._get_vector_store()
+            if store.model_name != model_name:
+                query_vector = self.text_to_vector(self.expand_abbreviations(query), use_cache=True)
+            if store.live_count:
+                positions = self._candidate_positions(store, query_vector, 5, np.zeros(0, dtype=np.int64))
+                if positions is None:
+                    positions = np.arange(len(store))
+                    similarities = store.similarities(query_vector)
                 else:
-                    cursor.execute('''INSERT INTO knowledge_vectors 
-                                    (question, answer, context, vector, last_used, is_from_pdf, tags)
-                                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                                   (question, answer, context, vector_blob, datetime.now().isoformat(), int(is_from_pdf), tags))
-                    logger.debug(f"Добавлена новая запись: question={question}")
-            else:
-                cursor.execute('''INSERT INTO knowledge_vectors 
-                                (context, vector, last_used, is_from_pdf, tags)
-                                VALUES (?, ?, ?, ?, ?)''',
-                               (chunk, vector_blob, datetime.now().isoformat(), int(is_from_pdf), tags))
-                logger.debug(f"Добавлен новый контекстный чанк: {chunk[:50]}...")
-
+                    similarities = store.similarities(query_vector, positions)
+                similarities[~store.valid[positions]] = -np.inf
+                above = np.nonzero(similarities >= self.answer_cache.threshold)[0]
+                for i in top_k_positions(similarities, above, 5):
+                    question, answer = store.rows[positions[i]][:2]
+                    if question and answer:
+                        candidates.append((int(store.ids[positions[i]]), float(similarities[i])))
+        cached = self.answer_cache.lookup(candidates)
+        return cached[1] if cached else None
+
+    def remember_answer(self, question, answer, approved=False):
+        """Сохраняет пару вопрос-ответ в базу знаний и в семантический кэш ответов.
+        Сгенерированный ответ (approved=False) не заменяет одобренный экспертом ответ на тот же вопрос"""
+        if not question or not answer:
+            return
+        if not approved and self.answer_cache is not None:
+            conn = sqlite3.connect(self.db_path)
+            keep_approved = AnswerCache.is_approved(conn.cursor(), question)
+            conn.close()
+            if keep_approved:
+                logger.info(f"Ответ на вопрос уже одобрен экспертом, сгенерированный не сохраняется: {question}")
+                return
+        self.add_to_knowledge_base(question, answer)
+        if self.answer_cache is None:
+            return
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT MIN(id) FROM knowledge_vectors WHERE question = ?', (question,))
+        row_id = cursor.fetchone()[0]
+        if row_id is not None:
+            self.answer_cache.remember(cursor, row_id, approved)
+            self.answer_cache.prune(cursor)
         conn.commit()
         conn.close()
-        logger.info(f"Добавлено {len(chunks)} чанков: question={question}, is_from_pdf={is_from_pdf}")
 
-    def generate_rag_response(self, query, llm_generate_func):
+    def generate_rag_response(self, query, llm_generate_func, use_cache=True, remember=False):
+        """use_cache=False — обход семантического кэша ответов (запросы администратора);
+        remember=True — сохранить сгенерированный ответ в базу знаний и кэш ответов"""
+        answer, prompt, relevant = self.prepare_rag_prompt(query, use_cache)
+        if answer is not None:
+            return answer
+        return self.finish_rag_response(query, llm_generate_func(prompt), relevant, remember)
+
+    def prepare_rag_prompt(self, query, use_cache=True):
+        """Всё, что нужно до запроса к LLM: общий вопрос, кэш ответов, поиск контекста и промпт.
+        Возвращает (готовый ответ, None, None) или (None, промпт, найденные записи)"""
         query_lower = query.lower().strip()
         general_keywords = [
             "как дела", "кто ты", "что ты", "что умеешь",
             "кто создал", "как настроение", "чем занимаешься", "расскажи о себе"
         ]
         if any(keyword in query_lower for keyword in general_keywords):
-            return "😊 Кажется, это общий вопрос! Я бот-нутрициолог, готов ответить на темы питания, здоровья или БАДов. Задай что-нибудь ещё! 🌟"
+            return "😊 Кажется, это общий вопрос! Я бот-нутрициолог, готов ответить на темы питания, здоровья или БАДов. Задай что-нибудь ещё! 🌟", None, None
+
+        if self.answer_cache is not None:
+            if use_cache:
+                cached = self._cached_answer(query)
+                if cached:
+                    return cached, None, None
+            else:
+                self.answer_cache.bypassed += 1
 
         relevant = self.find_relevant_context(query, threshold=0.7, top_k=3, min_threshold=0.4)
         prompt_base = (
@@ -349,33 +672,14 @@ class RAGHandler:
             "Не придумывай информацию о БАДах и эфирных самлах, которых нет в контексте."
         )
 
-        seen_answers = set()
         if relevant:
             logger.info(f"Найдено {len(relevant)} релевантных контекстов")
-            context = "Контекст из базы знаний:\n"
-            pdf_context = ""
-            user_context = ""
-            for i, (_, q, a, ctx, sim, is_from_pdf, tags) in enumerate(relevant, 1):
-                if not a and not ctx:
-                    logger.warning(f"Пустой ответ и контекст для вопроса: {q}")
-                    continue
-                answer_key = a if a else ctx
-                if answer_key in seen_answers:
-                    logger.info(f"Пропущен дублирующийся ответ: {answer_key[:50]}...")
-                    continue
-                seen_answers.add(answer_key)
-                entry = f"\nЗапись {i} (схожесть: {sim:.2f}):\n"
-                if ctx:
-                    entry += f"Контекст: {ctx[:1500]}...\n"
-                if q and a:
-                    entry += f"Вопрос: {q}\nОтвет: {a}\n"
-                if tags:
-                    entry += f"Теги: {tags}\n"
-                if is_from_pdf:
-                    pdf_context += entry
-                else:
-                    user_context += entry
-
+            if self.context_packer is not None:
+                # Вектор запроса уже в кэше после поиска
+                query_vector = self.texts_to_vectors([self.expand_abbreviations(query)], use_cache=True)[0]
+                pdf_context, user_context = self.context_packer.pack(query_vector, relevant)
+            else:
+                pdf_context, user_context = format_entries(relevant)
             context = pdf_context + (f"\nДанные от пользователей:\n{user_context}" if user_context else "")
             prompt = (
                 f"{prompt_base}\n\n"
@@ -395,15 +699,21 @@ class RAGHandler:
                 "Если вопрос не тематический, дай краткий, вежливый ответ без рекомендаций."
             )
 
-        response = llm_generate_func(prompt)
+        return None, prompt, relevant
+
+    def finish_rag_response(self, query, response, relevant, remember=False):
+        """Всё, что нужно после ответа LLM: учёт использованных записей и сохранение ответа"""
         if not response:
             logger.error("LLM не вернул ответ")
             return "Извините, не удалось сгенерировать ответ. Попробуйте уточнить запрос."
         if relevant:
-            self._update_usage_counts([item[0] for item in relevant])
+            self.usage_buffer.add(item[0] for item in relevant)
+        if remember and "Недостаточно информации" not in response:
+            self.remember_answer(query, response)
         return response
 
     def get_recent_entries(self, limit=5):
+        self.flush_usage_counts()
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         cursor.execute('''SELECT question, answer, context, last_used, usage_count, is_from_pdf 
@@ -414,19 +724,9 @@ class RAGHandler:
         conn.close()
         return results
 
-    def _update_usage_counts(self, vector_ids):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        for vec_id in vector_ids:
-            cursor.execute('''UPDATE knowledge_vectors 
-                            SET usage_count = usage_count + 1, last_used = ?
-                            WHERE id = ?''',
-                           (datetime.now().isoformat(), vec_id))
-        conn.commit()
-        conn.close()
-        logger.info(f"Обновлены счетчики для {len(vector_ids)} записей")
-
     def optimize_knowledge_base(self, min_usage=5, max_items=2000):
+        # Отбор по usage_count/last_used должен видеть и ещё не записанные использования
+        self.flush_usage_counts()
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         cursor.execute('SELECT COUNT(*) FROM knowledge_vectors')
@@ -434,7 +734,7 @@ class RAGHandler:
         if total <= max_items:
             conn.close()
             logger.info("Оптимизация не требуется")
-            return
+            return 0
 
         # Приоритет для записей с тегами и PDF
         cursor.execute('''DELETE FROM knowledge_vectors 
@@ -447,6 +747,140 @@ class RAGHandler:
                             LIMIT ?
                         )''', (min_usage, max_items))
         deleted = cursor.rowcount
+        prune_changelog(cursor)
+        conn.commit()
+
+        # Удалённые записи оставляют свободные строки в файле векторов; уплотняем, когда их больше живых
+        cursor.execute('SELECT COUNT(*) FROM knowledge_vectors WHERE vector_offset IS NOT NULL')
+        live = cursor.fetchone()[0]
+        state = VectorFile.current(cursor)
+        if state and len(self.vector_file.open_matrix(*state)) > 2 * live:
+            self.vector_file.compact(conn)
+        conn.close()
+        logger.info(f"Удалено {deleted} редко используемых записей")
+        return deleted
+
+    def compact_knowledge_base(self, min_usage=5, max_items=2000, duplicate_threshold=0.97):
+        """Периодическое обслуживание базы знаний: удаление редко используемых записей, слияние почти
+        одинаковых пар вопрос-ответ, уплотнение файла векторов, перестройка ANN-индекса, incremental VACUUM
+        и ANALYZE. Возвращает отчёт о том, что удалось освободить"""
+        started = time.monotonic()
+        report = {"pruned": self.optimize_knowledge_base(min_usage, max_items),
+                  "merged": self._merge_near_duplicates(duplicate_threshold)}
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        report["answer_cache"] = self.answer_cache.prune(cursor) if self.answer_cache is not None else 0
+        report["changelog"] = prune_changelog(cursor)
+        conn.commit()
+        report["vector_rows"] = self.vector_file.compact(conn)
+        if self.lexical_index is not None:
+            self.lexical_index.optimize(conn)
+        conn.close()
+
+        if self._ann_index is not None:
+            with self._store_lock:
+                ann_fresh = self._ann_index.is_fresh(self._get_vector_store())
+            # Граф перестраивается, чтобы выбросить удалённые записи, или если индекс не догнал журнал
+            if report["pruned"] or report["merged"] or not ann_fresh:
+                self.build_ann_index()
+        report["freed_bytes"] = self._vacuum_database()
+        report["seconds"] = round(time.monotonic() - started, 1)
+        logger.info(f"Обслуживание базы знаний: удалено {report['pruned']}, слито дублей {report['merged']}, "
+                    f"освобождено строк векторов {report['vector_rows']}, "
+                    f"байт в базе {report['freed_bytes']} за {report['seconds']} с")
+        return report
+
+    def _merge_near_duplicates(self, threshold):
+        """Сливает пользовательские пары вопрос-ответ с почти одинаковыми векторами в одну запись: остаётся
+        одобренная экспертом, затем наиболее используемая; счётчики и теги переходят к ней"""
+        # Под блокировкой только копируются id и векторы; попарное сравнение (O(n²)) идёт без неё,
+        # чтобы обслуживание не задерживало поиск
+        with self._store_lock:
+            store = self._get_vector_store()
+            positions = np.array([pos for pos in np.nonzero(store.valid & ~store.is_from_pdf)[0]
+                                  if store.rows[pos][0]], dtype=np.int64)
+            ids = store.ids[positions].copy()
+            vectors = np.array(store.matrix[positions])
+        groups = near_duplicate_groups(ids, vectors, threshold)
+        if not groups:
+            return 0
+
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        group_ids = [vec_id for group in groups for vec_id in group]
+        info = {}
+        for start in range(0, len(group_ids), 500):
+            batch = group_ids[start:start + 500]
+            cursor.execute(f'''SELECT k.id, k.usage_count, k.last_used, k.tags, COALESCE(c.approved, 0)
+                             FROM knowledge_vectors k LEFT JOIN answer_cache c ON c.row_id = k.id
+                             WHERE k.id IN ({",".join("?" * len(batch))})''', batch)
+            info.update((row[0], row[1:]) for row in cursor.fetchall())
+        merges, duplicates = [], []
+        for group in groups:
+            # Записи, удалённые после чтения матрицы, в слиянии не участвуют
+            members = [vec_id for vec_id in group if vec_id in info]
+            if len(members) < 2:
+                continue
+            keep = max(members, key=lambda vec_id: (info[vec_id][3], info[vec_id][0] or 0, -vec_id))
+            for vec_id in members:
+                if vec_id != keep:
+                    usage_count, last_used, tags, _ = info[vec_id]
+                    merges.append((usage_count or 0, last_used, tags, keep))
+                    duplicates.append((vec_id,))
+        cursor.executemany('''UPDATE knowledge_vectors
+                            SET usage_count = usage_count + ?, last_used = MAX(COALESCE(last_used, ''), COALESCE(?, '')),
+                                tags = COALESCE(tags, ?)
+                            WHERE id = ?''', merges)
+        cursor.executemany('DELETE FROM knowledge_vectors WHERE id = ?', duplicates)
         conn.commit()
         conn.close()
-        logger.info(f"Удалено {deleted} редко используемых записей")
\ No newline at end of file
+        logger.info(f"Слито почти одинаковых записей: {len(duplicates)}")
+        return len(duplicates)
+
+    def _vacuum_database(self):
+        """Возвращает свободные страницы базы файловой системе (incremental_vacuum, если режим включён
+        enable_incremental_vacuum) и обновляет статистику планировщика; результат — число освобождённых байт"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA page_size')
+        page_size = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_count')
+        pages_before = pages_after = cursor.fetchone()[0]
+        try:
+            cursor.execute('PRAGMA auto_vacuum')
+            if cursor.fetchone()[0] == 2:
+                # execute выполняет прагму на один шаг и освобождает одну страницу; executescript — до конца
+                cursor.executescript('PRAGMA incremental_vacuum;')
+                # Размер замеряется до ANALYZE: таблица статистики сама занимает страницы
+                cursor.execute('PRAGMA page_count')
+                pages_after = cursor.fetchone()[0]
+            else:
+                logger.info("Режим auto_vacuum INCREMENTAL не включён, свободные страницы остаются в базе "
+                            "(включается командой /vacuum)")
+            cursor.execute('ANALYZE')
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            logger.warning(f"VACUUM/ANALYZE пропущены: {e}")
+        conn.close()
+        return max(pages_before - pages_after, 0) * page_size
+
+    def enable_incremental_vacuum(self):
+        """Разовый перевод базы в режим auto_vacuum INCREMENTAL полным VACUUM. VACUUM держит монопольную
+        блокировку всей базы и переписывает файл целиком, поэтому запускается отдельно, в спокойное время,
+        а не плановым обслуживанием. Возвращает число освобождённых байт"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA page_size')
+        page_size = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_count')
+        pages_before = cursor.fetchone()[0]
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+        cursor.execute('PRAGMA page_count')
+        pages_after = cursor.fetchone()[0]
+        conn.close()
+        freed = max(pages_before - pages_after, 0) * page_size
+        logger.info(f"База переведена в режим auto_vacuum INCREMENTAL, освобождено {freed} байт")
+        return freed
@@ -1,29 +1,28 @@
 import os
+import asyncio
 import tempfile
 from pathlib import Path
 from datetime import datetime
 from typing import Optional, List
 from aiogram import Bot
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
-import pdfplumber
 import sqlite3
 import logging
 import requests
-from nltk.tokenize import sent_tokenize
-import nltk
-
-# Загружаем ресурсы для NLTK
-try:
-    nltk.data.find('tokenizers/punkt_tab')
-except LookupError:
-    nltk.download('punkt_tab', quiet=True)
+from keyword_groups import TAG_MATCHER
+from chunking import batched, iter_chunks, read_blocks
 
 logger = logging.getLogger(__name__)
 
 class RAGTrainer:
-    def __init__(self, db_path: str = 'nutrition_bot.db', llm_url: str = "http://localhost:11434/api/generate"):
+    def __init__(self, db_path: str = 'nutrition_bot.db', llm_url: str = "http://localhost:11434/api/generate",
+                 rag=None):
         self.db_path = db_path
         self.llm_url = llm_url
+        # RAGHandler бота; без него создаётся один собственный при первой загрузке файла
+        self.rag = rag
+        # AsyncRAG бота: синхронная обработка файла выполняется в его пуле потоков (без него — asyncio.to_thread)
+        self.rag_async = None
         self._init_db()
         logger.info("RAGTrainer инициализирован с базой данных: %s", db_path)
 
@@ -50,60 +49,17 @@ class RAGTrainer:
                 logger.debug("Создан временный файл: %s", file_path)
 
                 file_info = await bot.get_file(message.document.file_id)
-                downloaded_file = await bot.download_file(file_info.file_path)
-                logger.info("Файл загружен, размер: %s байт", len(downloaded_file.getbuffer()))
-
-                with open(file_path, 'wb') as f:
-                    f.write(downloaded_file.read())
-                logger.debug("Файл сохранён во временной директории")
+                # Файл пишется сразу на диск, а не в память: TXT может занимать сотни мегабайт
+                await bot.download_file(file_info.file_path, destination=file_path)
+                logger.info("Файл загружен, размер: %s байт", os.path.getsize(file_path))
 
-                if original_file_type == 'pdf':
-                    text_chunks = self._process_large_pdf(file_path)
-                else:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        text = f.read()
-                    logger.info("Извлечён текст из TXT: %s символов", len(text))
-                    text_chunks = self._split_text_into_chunks(text, chunk_size=2000)
-
-                total_chunks = 0
-                total_qa_pairs = 0
-                from rag_handler import RAGHandler
-                rag = RAGHandler()
-                logger.debug("RAGHandler инициализирован для добавления чанков")
-
-                for chunk, tags in text_chunks:
-                    logger.info("Добавляется чанк: %s символов, теги: %s", len(chunk), tags or "нет")
-                    rag.add_to_knowledge_base(context=chunk, is_from_pdf=True, tags=tags)
-                    total_chunks += 1
-
-                    if generate_qa:
-                        qa_pairs = self._generate_qa_pairs(chunk)
-                        logger.info("Сгенерировано %s QA-пар для чанка", len(qa_pairs))
-                        for question, answer in qa_pairs:
-                            logger.debug("Добавляется QA-пара: Вопрос: %s, Ответ: %s...",
-                                        question[:50], answer[:50])
-                            rag.add_to_knowledge_base(question, answer, is_from_pdf=True, tags=tags)
-                            total_qa_pairs += 1
-
-                self._save_file_metadata(
-                    filename=message.document.file_name,
-                    file_type=original_file_type,
-                    chunks_count=total_chunks
-                )
-                logger.info("Метаданные файла сохранены: %s, чанков: %s",
-                           message.document.file_name, total_chunks)
+                # Разбор, векторизация и запросы к LLM идут в пуле потоков RAG, чтобы не останавливать бота
+                total_chunks, total_qa_pairs = await self._run(
+                    self._ingest_file, file_path, message.document.file_name, original_file_type, generate_qa)
 
                 #await self._send_extracted_text_to_admin(bot, message.document.file_name, [chunk for chunk, _ in text_chunks])
                 logger.debug("Извлечённые чанки отправлены администратору")
 
-                # Сохраняем полный текст чанков в лог-файл для анализа
-                log_file = f"extracted_{message.document.file_name.replace('.pdf', '').replace('.txt', '')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-                with open(log_file, 'w', encoding='utf-8') as f:
-                    f.write(f"Файл: {message.document.file_name}\nОбработан: {datetime.now().isoformat()}\n\n")
-                    for i, (chunk, tags) in enumerate(text_chunks, 1):
-                        f.write(f"Чанк {i} ({len(chunk)} символов, теги: {tags or 'нет'}):\n{chunk}\n{'-' * 50}\n")
-                logger.info("Полный текст чанков сохранён в файл: %s", log_file)
-
                 back_keyboard = ReplyKeyboardMarkup(
                     keyboard=[[KeyboardButton(text="Назад")]],
                     resize_keyboard=True
@@ -122,6 +78,65 @@ class RAGTrainer:
             logger.error("Ошибка обработки файла %s: %s", message.document.file_name, str(e), exc_info=True)
             return f"❌ Ошибка обработки файла: {e}"
 
+    def _ingest_file(self, file_path: str, file_name: str, file_type: str, generate_qa: bool) -> tuple:
+        """Синхронная часть обработки: разбор файла, векторизация, генерация QA-пар и запись в базу.
+        Возвращает (число чанков, число QA-пар)"""
+        if file_type == 'pdf':
+            text_chunks = self._process_large_pdf(file_path)
+        else:
+            text_chunks = self._iter_txt_chunks(file_path, chunk_size=2000)
+
+        total_chunks = 0
+        total_qa_pairs = 0
+        rag = self._get_rag()
+
+        # Полный текст чанков сохраняется в лог-файл для анализа по мере обработки
+        log_file = f"extracted_{file_name.replace('.pdf', '').replace('.txt', '')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        with open(log_file, 'w', encoding='utf-8') as log:
+            log.write(f"Файл: {file_name}\nОбработан: {datetime.now().isoformat()}\n\n")
+            # Чанки добавляются пачками по мере чтения файла, QA-пары пачки — следом за её чанками
+            for batch in batched(text_chunks, 256):
+                rag.add_many_to_knowledge_base([(None, None, chunk, tags) for chunk, tags in batch],
+                                               is_from_pdf=True)
+                for chunk, tags in batch:
+                    total_chunks += 1
+                    log.write(f"Чанк {total_chunks} ({len(chunk)} символов, теги: {tags or 'нет'}):\n"
+                              f"{chunk}\n{'-' * 50}\n")
+                logger.info("Добавлено %s чанков", total_chunks)
+
+                if generate_qa:
+                    qa_records = []
+                    for chunk, tags in batch:
+                        qa_pairs = self._generate_qa_pairs(chunk)
+                        logger.info("Сгенерировано %s QA-пар для чанка", len(qa_pairs))
+                        for question, answer in qa_pairs:
+                            logger.debug("Добавляется QA-пара: Вопрос: %s, Ответ: %s...",
+                                        question[:50], answer[:50])
+                            qa_records.append((question, answer, None, tags))
+                    rag.add_many_to_knowledge_base(qa_records, is_from_pdf=True)
+                    total_qa_pairs += len(qa_records)
+        logger.info("Полный текст чанков сохранён в файл: %s", log_file)
+
+        self._save_file_metadata(
+            filename=file_name,
+            file_type=file_type,
+            chunks_count=total_chunks
+        )
+        logger.info("Метаданные файла сохранены: %s, чанков: %s", file_name, total_chunks)
+        return total_chunks, total_qa_pairs
+
+    async def _run(self, func, *args):
+        if self.rag_async is not None:
+            return await self.rag_async.run(func, *args)
+        return await asyncio.to_thread(func, *args)
+
+    def _get_rag(self):
+        if self.rag is None:
+            from rag_handler import RAGHandler
+            self.rag = RAGHandler(self.db_path)
+            logger.debug("RAGHandler инициализирован для добавления чанков")
+        return self.rag
+
     def _process_large_pdf(self, file_path: str, max_chunk_size: int = 2000, max_pages_per_chunk: int = 10) -> List[
         tuple]:
         text_chunks = []
@@ -129,18 +144,9 @@ class RAGTrainer:
         page_count = 0
         total_chars = 0
 
-        keyword_groups = {
-            "sleep": ["сон", "бессонница", "уснуть", "отдых", "расслабление"],
-            "stress": ["стресс", "тревога", "напряжение", "нервы", "успокоение"],
-            "energy": ["энергия", "бодрость", "усталость", "активность"],
-            "immunity": ["иммунитет", "простуда", "вирусы", "иммунная система"],
-            "skin": ["кожа", "акне", "увлажнение", "псориаз"],
-            "vitamins": ["витамины", "витамин", "минералы", "микроэлементы"],
-            "weight": ["вес", "похудение", "метаболизм"],
-            "joints": ["суставы", "кости", "артрит", "гибкость"],
-            "gut": ["жкт", "пищеварение", "желудок", "кишечник"]
-        }
-        logger.debug("Инициализированы группы ключевых слов для тегирования: %s групп", len(keyword_groups))
+        logger.debug("Группы ключевых слов для тегирования: %s групп", len(TAG_MATCHER.group_names))
+
+        import pdfplumber
 
         with pdfplumber.open(file_path) as pdf:
             logger.info("Открыт PDF-файл: %s, страниц: %s", file_path, len(pdf.pages))
@@ -173,7 +179,7 @@ class RAGTrainer:
                                  i + 1, len(current_chunk))
                 else:
                     if current_chunk.strip():
-                        tags = self._generate_tags(current_chunk, keyword_groups)
+                        tags = self._generate_tags(current_chunk)
                         text_chunks.append((current_chunk.strip(), tags))
                         logger.info("Создан чанк %s: %s символов, теги: %s",
                                     len(text_chunks), len(current_chunk.strip()), tags or "нет")
@@ -183,7 +189,7 @@ class RAGTrainer:
                                  i + 1, len(current_chunk))
 
                 if i == len(pdf.pages) - 1 and current_chunk.strip():
-                    tags = self._generate_tags(current_chunk, keyword_groups)
+                    tags = self._generate_tags(current_chunk)
                     text_chunks.append((current_chunk.strip(), tags))
                     logger.info("Создан финальный чанк %s: %s символов, теги: %s",
                                 len(text_chunks), len(current_chunk.strip()), tags or "нет")
@@ -191,19 +197,15 @@ class RAGTrainer:
         logger.info("PDF обработан: %s чанков, всего извлечено %s символов", len(text_chunks), total_chars)
         return text_chunks
 
-    def _generate_tags(self, text: str, keyword_groups: dict) -> str:
-        text_lower = text.lower()
-        tags = []
-        for group, keywords in keyword_groups.items():
-            if any(kw in text_lower for kw in keywords):
-                tags.append(group)
+    def _generate_tags(self, text: str) -> Optional[str]:
+        tags = TAG_MATCHER.match(text)
         result = ",".join(tags) if tags else None
         logger.debug("Сгенерированы теги для текста (%s символов): %s", len(text), result or "нет")
         return result
 
     def _generate_qa_pairs(self, text: str) -> List[tuple]:
         qa_pairs = []
-        chunks = self._split_text_into_chunks(text, chunk_size=1500)
+        chunks = list(iter_chunks(text, chunk_size=1500))
         logger.info("Чанк разбит на %s подчанков для генерации QA-пар", len(chunks))
 
         for i, chunk in enumerate(chunks):
@@ -268,23 +270,15 @@ class RAGTrainer:
         logger.info("Распарсено %s QA-пар из ответа LLM", len(qa_pairs))
         return qa_pairs
 
-    def _split_text_into_chunks(self, text: str, chunk_size: int = 2000) -> List[str]:
-        sentences = sent_tokenize(text, language="russian")
-        chunks = []
-        current_chunk = ""
-        for sentence in sentences:
-            if len(current_chunk) + len(sentence) <= chunk_size:
-                current_chunk += sentence + " "
-            else:
-                if current_chunk.strip():
-                    chunks.append(current_chunk.strip())
-                    logger.debug("Создан чанк: %s символов", len(current_chunk.strip()))
-                current_chunk = sentence + " "
-        if current_chunk.strip():
-            chunks.append(current_chunk.strip())
-            logger.debug("Создан финальный чанк: %s символов", len(current_chunk.strip()))
-        logger.info("Текст разбит на %s чанков", len(chunks))
-        return chunks
+    def _iter_txt_chunks(self, file_path: str, chunk_size: int = 2000):
+        """Чанки TXT-файла с тегами по мере чтения: файл читается блоками, а не целиком"""
+        count = 0
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for chunk in iter_chunks(read_blocks(f), chunk_size=chunk_size):
+                count += 1
+                logger.debug("Создан чанк %s: %s символов", count, len(chunk))
+                yield chunk, self._generate_tags(chunk)
+        logger.info("Текст разбит на %s чанков", count)
 
     def _save_file_metadata(self, filename: str, file_type: str, chunks_count: int):
         conn = sqlite3.connect(self.db_path)
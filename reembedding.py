@@ -0,0 +1,180 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Optional
+from vector_file import VectorFile
+
+logger = logging.getLogger(__name__)
+
+
+class Reembedder:
+    """Фоновая переиндексация базы знаний другой моделью без остановки бота.
+
+    Векторы новой модели пишутся в отдельный файл поколения staging_generation пачками по batch_size;
+    у записи запоминаются смещение (staged_offset) и content_hash, по которому вектор посчитан, поэтому
+    записи, добавленные или изменённые во время работы, пересчитываются на следующем проходе. Поиск всё
+    это время идёт по текущему файлу старой моделью. Когда догонять почти нечего, последний остаток
+    пересчитывается под блокировкой записи, и одна транзакция переключает vector_offset всех записей,
+    файл и модель в vector_files — экземпляры RAGHandler видят смену поколения и переходят на новую модель.
+    """
+
+    def __init__(self, rag, target_model: str, batch_size: int = 256, pause: float = 0.05):
+        self.rag = rag
+        self.db_path = rag.db_path
+        self.vector_file = rag.vector_file
+        self.target_model = target_model
+        self.batch_size = batch_size
+        self.pause = pause
+        self.embedded = 0
+        self.total = 0
+        self.state = "ожидание"
+        self.error = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="reembed", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def status(self) -> dict:
+        return {"model": self.target_model, "state": self.state, "embedded": self.embedded,
+                "total": self.total, "error": self.error}
+
+    def _run(self):
+        started = time.monotonic()
+        try:
+            self.state = "загрузка модели"
+            dim = self.rag.get_embedding_model(self.target_model).get_sentence_embedding_dimension()
+            generation = self._prepare(dim)
+            if generation is None:
+                self.state = "завершена"
+                logger.info(f"База векторов пуста, модель переключена на {self.target_model}")
+                return
+            self.state = "переиндексация"
+            while not self._stopped.is_set():
+                if self._embed_pending(generation, dim) < self.batch_size:
+                    break
+                time.sleep(self.pause)
+            if self._stopped.is_set():
+                self.state = "остановлена"
+                return
+            self.state = "переключение"
+            self._swap(generation, dim)
+        except Exception as e:
+            self.state = "ошибка"
+            self.error = str(e)
+            logger.error(f"Ошибка переиндексации моделью {self.target_model}: {e}")
+            return
+        self.state = "завершена"
+        logger.info(f"Переиндексация моделью {self.target_model} завершена: {self.embedded} векторов "
+                    f"за {time.monotonic() - started:.0f} с")
+
+    def _prepare(self, dim: int) -> Optional[int]:
+        """Создаёт файл переиндексации или продолжает прерванную переиндексацию той же моделью"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        if VectorFile.current(cursor) is None:
+            cursor.execute('INSERT INTO vector_files (id, generation, dim, model_name) VALUES (1, 1, ?, ?)',
+                           (dim, self.target_model))
+            conn.commit()
+            conn.close()
+            return None
+        staging = VectorFile.staging(cursor)
+        if staging and staging[2] == self.target_model and staging[1] == dim:
+            generation = staging[0]
+            logger.info(f"Продолжение переиндексации моделью {self.target_model}")
+        else:
+            if staging:
+                logger.info(f"Прервана переиндексация моделью {staging[2]}, начинается заново")
+                cursor.execute('UPDATE knowledge_vectors SET staged_offset = NULL, staged_hash = NULL '
+                               'WHERE staged_offset IS NOT NULL')
+            generation = VectorFile.next_generation(cursor)
+            if os.path.exists(self.vector_file.path(generation)):
+                os.remove(self.vector_file.path(generation))
+            cursor.execute('''UPDATE vector_files SET staging_generation = ?, staging_model = ?, staging_dim = ?
+                            WHERE id = 1''', (generation, self.target_model, dim))
+        cursor.execute('SELECT COUNT(*) FROM knowledge_vectors WHERE vector_offset IS NOT NULL')
+        self.total = cursor.fetchone()[0]
+        conn.commit()
+        conn.close()
+        return generation
+
+    @staticmethod
+    def _pending_rows(cursor, limit: int):
+        cursor.execute('''SELECT id, question, answer, context, content_hash FROM knowledge_vectors
+                        WHERE vector_offset IS NOT NULL AND (staged_hash IS NULL OR staged_hash IS NOT content_hash)
+                        ORDER BY id LIMIT ?''', (limit,))
+        return cursor.fetchall()
+
+    def _stage(self, cursor, generation: int, dim: int, rows, vectors):
+        offsets = self.vector_file.append(cursor, vectors, dim, generation=generation)
+        # Запись, изменившаяся после чтения, останется непересчитанной и попадёт в следующий проход
+        cursor.executemany('''UPDATE knowledge_vectors SET staged_offset = ?, staged_hash = ?
+                            WHERE id = ? AND content_hash IS ?''',
+                           [(offset, row[4], row[0], row[4]) for offset, row in zip(offsets, rows)])
+
+    def _embed(self, rows):
+        # Тот же текст, по которому строился вектор записи при добавлении
+        texts = [context if context else (question or answer or "") for _, question, answer, context, _ in rows]
+        return self.rag.get_embedding_model(self.target_model).encode(texts, batch_size=64, show_progress_bar=False)
+
+    def _embed_pending(self, generation: int, dim: int) -> int:
+        """Одна пачка: векторизация без блокировки базы, запись под короткой транзакцией"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        rows = self._pending_rows(cursor, self.batch_size)
+        if rows:
+            vectors = self._embed(rows)
+            cursor.execute('BEGIN IMMEDIATE')
+            self._check_staging(cursor, generation)
+            self._stage(cursor, generation, dim, rows, vectors)
+            conn.commit()
+            self.embedded += len(rows)
+        conn.close()
+        return len(rows)
+
+    def _check_staging(self, cursor, generation: int):
+        staging = VectorFile.staging(cursor)
+        if not staging or staging[0] != generation:
+            raise RuntimeError("переиндексацию перезапустили из другого процесса")
+
+    def _swap(self, generation: int, dim: int):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        self._check_staging(cursor, generation)
+        # Остаток меньше пачки: пересчитываем его, не отпуская блокировку, чтобы ничего не успело измениться
+        rows = self._pending_rows(cursor, self.batch_size)
+        while rows:
+            self._stage(cursor, generation, dim, rows, self._embed(rows))
+            self.embedded += len(rows)
+            rows = self._pending_rows(cursor, self.batch_size)
+        state = VectorFile.current(cursor)
+        cursor.execute('''UPDATE knowledge_vectors
+                        SET vector_offset = staged_offset, embedding_model = ?, staged_offset = NULL, staged_hash = NULL
+                        WHERE vector_offset IS NOT NULL''', (self.target_model,))
+        cursor.execute('''UPDATE vector_files
+                        SET generation = staging_generation, dim = staging_dim, model_name = staging_model,
+                            staging_generation = NULL, staging_model = NULL, staging_dim = NULL
+                        WHERE id = 1''')
+        conn.commit()
+        conn.close()
+        logger.info(f"Файл векторов переключён на модель {self.target_model}: поколение {generation}, "
+                    f"размерность {dim}")
+        # Процессы, успевшие отобразить старый файл, дочитают его и перейдут на новое поколение при синхронизации
+        if state:
+            try:
+                os.remove(self.vector_file.path(state[0]))
+            except OSError as e:
+                logger.warning(f"Не удалось удалить старый файл векторов: {e}")
@@ -0,0 +1,84 @@
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RERANK_MODEL = 'cross-encoder/mmarco-mMiniLMv2-L12-H384-v1'
+
+
+class CrossEncoderReranker:
+    """Переранжирование кандидатов би-энкодера небольшим многоязычным кросс-энкодером на CPU.
+
+    Кросс-энкодер читает запрос и текст записи вместе и точнее решает, какой чанк отвечает на вопрос.
+    На всё переранжирование отводится budget_ms: если модель ещё грузится, очередь занята или пары
+    не успели оцениться, rerank возвращает None и остаётся порядок би-энкодера. Пары оцениваются
+    пачками по batch_size; опоздавшая оценка прекращается после текущей пачки.
+    """
+
+    def __init__(self, model_name: str = DEFAULT_RERANK_MODEL, budget_ms: float = 300, batch_size: int = 16,
+                 max_length: int = 256):
+        self.model_name = model_name
+        self.budget = budget_ms / 1000
+        self.batch_size = batch_size
+        self.max_length = max_length
+        # Один поток: оценки не конкурируют за ядра, а не уложившиеся в бюджет не копятся
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+        self._model = Future()
+        threading.Thread(target=self._load, name=f"load-{model_name}", daemon=True).start()
+        self.reranked = 0
+        self.fallbacks = 0
+
+    def _load(self):
+        try:
+            # CrossEncoder из sentence_transformers тянет torch — импортируем только при загрузке
+            from sentence_transformers import CrossEncoder
+            model = CrossEncoder(self.model_name, max_length=self.max_length, device="cpu")
+            model.predict([("прогрев модели", "прогрев модели")])
+        except Exception as e:
+            logger.error(f"Ошибка загрузки кросс-энкодера {self.model_name}: {e}")
+            self._model.set_exception(e)
+            return
+        logger.info(f"Кросс-энкодер загружен: {self.model_name}")
+        self._model.set_result(model)
+
+    def _score(self, model, query: str, texts: List[str], deadline: float) -> Optional[List[float]]:
+        scores = []
+        for start in range(0, len(texts), self.batch_size):
+            if time.monotonic() > deadline:
+                return None
+            batch = [(query, text) for text in texts[start:start + self.batch_size]]
+            scores.extend(float(score) for score in model.predict(batch, batch_size=self.batch_size,
+                                                                  show_progress_bar=False))
+        return scores
+
+    def rerank(self, query: str, texts: List[str]) -> Optional[List[float]]:
+        """Оценки кросс-энкодера для пар (query, texts[i]) или None, если бюджет времени исчерпан"""
+        if not texts:
+            return []
+        started = time.monotonic()
+        deadline = started + self.budget
+        if not self._model.done() or self._model.exception() is not None:
+            self.fallbacks += 1
+            return None
+        future = self._executor.submit(self._score, self._model.result(), query, texts, deadline)
+        try:
+            scores = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeout:
+            scores = None
+        if scores is None:
+            self.fallbacks += 1
+            logger.warning(f"Переранжирование не уложилось в {self.budget * 1000:.0f} мс, порядок би-энкодера")
+            return None
+        self.reranked += 1
+        logger.debug(f"Переранжировано {len(texts)} кандидатов за {(time.monotonic() - started) * 1000:.0f} мс")
+        return scores
+
+    def stats(self) -> dict:
+        return {"ready": self._model.done() and self._model.exception() is None,
+                "reranked": self.reranked, "fallbacks": self.fallbacks}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
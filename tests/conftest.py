@@ -0,0 +1,25 @@
+import pytest
+
+from bench_retrieval import StubEmbeddingModel
+from model_registry import register_model
+
+STUB_MODEL = "stub-test-model"
+
+
+@pytest.fixture
+def make_rag(tmp_path):
+    """RAGHandler над базой во временном каталоге с моделью-заглушкой вместо SentenceTransformer"""
+    from rag_handler import RAGHandler
+
+    register_model(STUB_MODEL, StubEmbeddingModel(64))
+    handlers = []
+
+    def make(**params):
+        params = {"model_name": STUB_MODEL, "answer_cache": False, "auto_reembed": False, **params}
+        handler = RAGHandler(str(tmp_path / "knowledge.db"), **params)
+        handlers.append(handler)
+        return handler
+
+    yield make
+    for handler in handlers:
+        handler.usage_buffer.stop()
@@ -0,0 +1,25 @@
+import sqlite3
+
+
+def cached(rag, question):
+    conn = sqlite3.connect(rag.db_path)
+    row = conn.execute('''SELECT k.answer, c.approved FROM knowledge_vectors k JOIN answer_cache c ON c.row_id = k.id
+                        WHERE k.question = ?''', (question,)).fetchone()
+    conn.close()
+    return row
+
+
+def test_generated_answer_does_not_replace_approved(make_rag):
+    rag = make_rag(answer_cache=True)
+    rag.remember_answer("чем полезен магний", "ответ эксперта", approved=True)
+    rag.remember_answer("чем полезен магний", "черновик модели")
+    assert cached(rag, "чем полезен магний") == ("ответ эксперта", 1)
+
+
+def test_generated_answer_replaces_generated(make_rag):
+    rag = make_rag(answer_cache=True)
+    rag.remember_answer("чем полезен цинк", "первый ответ")
+    rag.remember_answer("чем полезен цинк", "второй ответ")
+    assert cached(rag, "чем полезен цинк") == ("второй ответ", 0)
+    rag.remember_answer("чем полезен цинк", "ответ эксперта", approved=True)
+    assert cached(rag, "чем полезен цинк") == ("ответ эксперта", 1)
@@ -0,0 +1,60 @@
+import random
+
+import pytest
+
+punkt = pytest.importorskip("nltk.tokenize.punkt")
+
+import chunking
+from chunking import iter_chunks, iter_sentences
+
+
+@pytest.fixture(autouse=True)
+def untrained_punkt(monkeypatch):
+    # Алгоритм Punkt без обученных параметров языка: ресурс punkt_tab для теста не нужен
+    tokenizer = punkt.PunktSentenceTokenizer()
+    monkeypatch.setattr(chunking, "_punkt_tokenizer", lambda language: tokenizer)
+    return tokenizer
+
+
+def sample_text(sentences=400, seed=0):
+    rng = random.Random(seed)
+    words = ["сон", "магний", "помогает", "уснуть", "стресс", "кишечник", "витамин", "и", "при", "для"]
+    parts = []
+    for _ in range(sentences):
+        sentence = " ".join(rng.choice(words) for _ in range(rng.randint(2, 25))).capitalize()
+        parts.append(sentence + rng.choice([".", "!", "?"]) + rng.choice([" ", "  ", "\n", "\n\n"]))
+    return "".join(parts)
+
+
+def blocks(text, size):
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+def test_sentences_do_not_depend_on_block_boundaries(untrained_punkt):
+    text = sample_text()
+    expected = untrained_punkt.tokenize(text)
+    for size in list(range(1, 60)) + [97, 256, 1000, 4096, len(text)]:
+        assert list(iter_sentences(blocks(text, size))) == expected, size
+
+
+@pytest.mark.parametrize("overlap", [0, 2])
+def test_chunks_do_not_depend_on_block_boundaries(overlap):
+    text = sample_text(seed=1)
+    expected = list(iter_chunks(text, chunk_size=300, overlap=overlap))
+    for size in list(range(1, 60)) + [97, 256, 1000, 4096]:
+        assert list(iter_chunks(blocks(text, size), chunk_size=300, overlap=overlap)) == expected, size
+
+
+def test_chunks_match_greedy_split_of_whole_text(untrained_punkt):
+    text = sample_text(seed=2)
+    expected, current = [], ""
+    for sentence in untrained_punkt.tokenize(text):
+        if len(current) + len(sentence) <= 500:
+            current += sentence + " "
+        else:
+            if current.strip():
+                expected.append(current.strip())
+            current = sentence + " "
+    if current.strip():
+        expected.append(current.strip())
+    assert list(iter_chunks(blocks(text, 64), chunk_size=500)) == expected
@@ -0,0 +1,28 @@
+import numpy as np
+
+
+def add(rag, *texts):
+    rag.add_many_to_knowledge_base([(None, None, text, None) for text in texts], is_from_pdf=True)
+
+
+def max_error(store):
+    """Наибольшее отклонение сжатой int8-копии от точных векторов в долях шага квантования"""
+    coarse = store._coarse[:store.size].astype(np.float32) * store._scale
+    return float((np.abs(coarse - store.matrix)[store.valid] / store._scale).max())
+
+
+def test_int8_scale_follows_synced_rows(make_rag):
+    rag = make_rag(quantization="int8")
+    add(rag, "магний", "цинк")
+    store = rag._get_vector_store()
+    assert max_error(store) <= 0.5 + 1e-3
+
+    # Строки, пришедшие синхронизацией, не должны обрезаться масштабом, посчитанным по первым двум
+    add(rag, *[f"запись {i} про витамины группы б и минералы {i * 7}" for i in range(200)])
+    store = rag._get_vector_store()
+    assert store.live_count == 202
+    assert max_error(store) <= 0.5 + 1e-3
+    assert np.all(store._scale <= 1.0 / 127 + 1e-9)
+
+    found = store.coarse_candidates(store.matrix[-1], 5)
+    assert store.size - 1 in found
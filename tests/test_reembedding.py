@@ -0,0 +1,112 @@
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from bench_retrieval import StubEmbeddingModel
+from model_registry import register_model
+from vector_file import VectorFile
+from vector_store import normalize_vector
+
+NEW_MODEL = "stub-test-model-48"
+
+QUESTIONS = ["польза магния для сна", "витамин д зимой", "омега три и сердце", "цинк и иммунитет",
+             "железо при анемии", "пробиотики после антибиотиков", "коллаген для суставов"]
+
+
+def add(rag, *questions):
+    rag.add_many_to_knowledge_base([(question, f"ответ: {question}", None, None) for question in questions])
+
+
+def file_vectors(rag):
+    """question -> (vector_offset, embedding_model, вектор из текущего файла) для всех записей базы"""
+    conn = sqlite3.connect(rag.db_path)
+    cursor = conn.cursor()
+    generation, dim = VectorFile.current(cursor)
+    rows = cursor.execute('''SELECT question, vector_offset, embedding_model FROM knowledge_vectors
+                           WHERE vector_offset IS NOT NULL''').fetchall()
+    conn.close()
+    matrix = rag.vector_file.open_matrix(generation, dim)
+    return {question: (offset, model, np.array(matrix[offset])) for question, offset, model in rows}
+
+
+def test_reembedding_swaps_file_offsets_and_model(make_rag):
+    new_model = StubEmbeddingModel(48)
+    register_model(NEW_MODEL, new_model)
+    rag = make_rag()
+    add(rag, *QUESTIONS)
+    old_dim = rag._get_vector_store().dim
+
+    reembedder = rag.start_reembedding(NEW_MODEL, batch_size=3)
+    while reembedder.is_running():
+        time.sleep(0.01)
+    assert reembedder.status()["state"] == "завершена", reembedder.status()
+
+    conn = sqlite3.connect(rag.db_path)
+    cursor = conn.cursor()
+    assert VectorFile.current_model(cursor) == NEW_MODEL
+    assert VectorFile.staging(cursor) is None
+    generation, dim = VectorFile.current(cursor)
+    assert cursor.execute("SELECT COUNT(*) FROM knowledge_vectors WHERE staged_offset IS NOT NULL").fetchone()[0] == 0
+    conn.close()
+    assert dim == 48 != old_dim
+    assert not [name for name in os.listdir(os.path.dirname(rag.db_path))
+                if name.startswith("knowledge.db.vectors.") and not name.endswith(f".{generation}")]
+
+    vectors = file_vectors(rag)
+    assert sorted(vectors) == sorted(QUESTIONS)
+    offsets = [offset for offset, _, _ in vectors.values()]
+    assert len(set(offsets)) == len(offsets) and max(offsets) < len(rag.vector_file.open_matrix(generation, dim))
+    for question, (_, model, vector) in vectors.items():
+        assert model == NEW_MODEL
+        assert np.allclose(normalize_vector(vector), normalize_vector(new_model.encode(question)), atol=1e-5)
+
+    # Обработчик замечает смену поколения и дальше кодирует запросы новой моделью
+    store = rag._get_vector_store()
+    assert rag.model_name == NEW_MODEL and store.dim == 48 and store.live_count == len(QUESTIONS)
+    found = rag.find_relevant_context("омега три и сердце", threshold=-1, top_k=1, min_threshold=None)
+    assert found[0][1] == "омега три и сердце"
+
+
+def test_compact_keeps_vectors_of_surviving_rows(make_rag, monkeypatch):
+    rag = make_rag()
+    add(rag, *QUESTIONS)
+    store = rag._get_vector_store()
+    before = file_vectors(rag)
+    conn = sqlite3.connect(rag.db_path)
+    conn.executemany("DELETE FROM knowledge_vectors WHERE question = ?", [(q,) for q in QUESTIONS[::2]])
+    conn.commit()
+
+    # Запись, добавленная, пока живые строки копируются без блокировки, дописывается под ней
+    copy_rows = VectorFile._copy_rows
+    late = []
+
+    def copy_and_insert(self, f, generation, dim, offsets):
+        copy_rows(self, f, generation, dim, offsets)
+        if not late:
+            late.append("магний и мышечные судороги")
+            add(make_rag(), late[0])
+
+    monkeypatch.setattr(VectorFile, "_copy_rows", copy_and_insert)
+    generation = VectorFile.current(conn.cursor())[0]
+    freed = rag.vector_file.compact(conn)
+    conn.close()
+
+    assert freed == len(QUESTIONS[::2])
+    after = file_vectors(rag)
+    assert sorted(after) == sorted(QUESTIONS[1::2] + late)
+    assert sorted(offset for offset, _, _ in after.values()) == list(range(len(after)))
+    for question in QUESTIONS[1::2]:
+        assert np.array_equal(after[question][2], before[question][2])
+    assert not os.path.exists(rag.vector_file.path(generation))
+
+    # Матрица перечитывает уплотнённый файл и совпадает с ним
+    store = rag._get_vector_store()
+    assert store.live_count == len(after)
+    conn = sqlite3.connect(rag.db_path)
+    ids = dict(conn.execute("SELECT question, id FROM knowledge_vectors").fetchall())
+    conn.close()
+    for question, (_, _, vector) in after.items():
+        row_id = ids[question]
+        assert np.allclose(store.matrix[store.id_to_pos[row_id]], normalize_vector(vector), atol=1e-6)
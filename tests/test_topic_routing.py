@@ -0,0 +1,21 @@
+from keyword_groups import KEYWORD_MATCHER
+
+
+def test_routing_mask_needs_whole_words():
+    query = "какие витамины пить весной"
+    assert KEYWORD_MATCHER.match(query) == ["weight"]
+    assert KEYWORD_MATCHER.word_mask(query) == 0
+    assert KEYWORD_MATCHER.groups_from_mask(KEYWORD_MATCHER.word_mask("как сбросить вес весной")) == ["weight"]
+
+
+def test_routing_keeps_rows_outside_query_shards(make_rag):
+    writer = make_rag()
+    writer.add_many_to_knowledge_base([(None, None, "витамины весной укрепляют иммунитет", None)]
+                                      + [(None, None, f"контроль веса и диета неделя {i}", None) for i in range(30)])
+    query = "вес витамины весной"
+    expected = make_rag(topic_routing=False).find_relevant_context(query, threshold=0.5, min_threshold=None)
+    routed = make_rag(topic_routing=True)
+    found = routed.find_relevant_context(query, threshold=0.5, min_threshold=None)
+    assert [entry[0] for entry in found] == [entry[0] for entry in expected]
+    assert any("иммунитет" in entry[3] for entry in found)
+    assert routed.topic_routing_stats()["fallback"] == 1
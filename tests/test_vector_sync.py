@@ -0,0 +1,120 @@
+import json
+import sqlite3
+
+import numpy as np
+
+from ann_index import ANNIndex
+from vector_store import VectorStore, normalize_vector
+
+# IVF не требует hnswlib; nprobe больше числа списков — поиск просматривает все записи
+ANN_PARAMS = {"index_backend": "ivf", "index_params": {"nprobe": 64}}
+
+
+def add(rag, *questions):
+    rag.add_many_to_knowledge_base([(question, f"ответ: {question}", None, None) for question in questions])
+
+
+def delete(rag, *questions):
+    conn = sqlite3.connect(rag.db_path)
+    conn.executemany("DELETE FROM knowledge_vectors WHERE question = ?", [(question,) for question in questions])
+    conn.commit()
+    conn.close()
+
+
+def db_vectors(rag):
+    """id -> нормированный вектор из файла векторов для всех записей базы"""
+    conn = sqlite3.connect(rag.db_path)
+    cursor = conn.cursor()
+    generation, dim = cursor.execute("SELECT generation, dim FROM vector_files WHERE id = 1").fetchone()
+    rows = cursor.execute("SELECT id, vector_offset FROM knowledge_vectors WHERE vector_offset IS NOT NULL").fetchall()
+    conn.close()
+    matrix = rag.vector_file.open_matrix(generation, dim)
+    return {row_id: normalize_vector(matrix[offset]) for row_id, offset in rows}
+
+
+def assert_store_matches_db(store, rag):
+    expected = db_vectors(rag)
+    assert sorted(store.id_to_pos) == sorted(expected)
+    assert store.live_count == len(expected)
+    for row_id, vector in expected.items():
+        assert np.allclose(store.matrix[store.id_to_pos[row_id]], vector, atol=1e-6)
+
+
+def test_sync_applies_inserts_and_deletes(make_rag):
+    rag = make_rag()
+    add(rag, "польза магния для сна", "витамин д зимой", "омега три и сердце")
+    store = rag._get_vector_store()
+    seq = store.last_seq
+
+    # Другой процесс меняет базу: sync должен применить журнал, не перезагружая матрицу
+    writer = make_rag()
+    add(writer, "цинк и иммунитет", "железо при анемии")
+    delete(writer, "витамин д зимой", "цинк и иммунитет")
+    upserted, removed = store.sync(rag.db_path)
+
+    assert store.last_seq > seq
+    assert len(upserted) == 1 and removed
+    assert_store_matches_db(store, rag)
+    assert store.sync(rag.db_path) == ([], [])
+
+
+def test_sync_after_reload_matches_fresh_load(make_rag):
+    rag = make_rag()
+    add(rag, "польза магния для сна", "витамин д зимой")
+    store = rag._get_vector_store()
+    add(rag, "омега три и сердце")
+    delete(rag, "польза магния для сна")
+    store.sync(rag.db_path)
+
+    fresh = VectorStore(store.dim, model_name=store.model_name)
+    fresh.load(rag.db_path)
+    assert sorted(fresh.id_to_pos) == sorted(store.id_to_pos)
+    assert_store_matches_db(store, rag)
+
+
+def test_stale_ann_meta_is_rebuilt(make_rag):
+    rag = make_rag(**ANN_PARAMS)
+    add(rag, "польза магния для сна", "витамин д зимой", "омега три и сердце", "железо при анемии")
+    rag.build_ann_index()
+    assert rag._ann_index.is_fresh(rag._get_vector_store())
+
+    # Отпечаток meta.json не совпадает с базой (индекс другой модели): такой индекс не используется
+    with open(rag._ann_index.meta_path, encoding="utf-8") as f:
+        meta = json.load(f)
+    with open(rag._ann_index.meta_path, "w", encoding="utf-8") as f:
+        json.dump(dict(meta, model="old-model"), f)
+
+    restarted = make_rag(**ANN_PARAMS)
+    store = restarted._get_vector_store()
+    assert not restarted._ann_index.is_fresh(store)
+
+    restarted.compact_knowledge_base(min_usage=0)
+    store = restarted._get_vector_store()
+    assert restarted._ann_index.is_fresh(store)
+    with open(restarted._ann_index.meta_path, encoding="utf-8") as f:
+        assert json.load(f)["model"] == store.model_name
+
+
+def test_ann_catch_up_after_out_of_band_writes(make_rag):
+    rag = make_rag(**ANN_PARAMS)
+    add(rag, "польза магния для сна", "витамин д зимой", "омега три и сердце")
+    rag.build_ann_index()
+
+    writer = make_rag()
+    add(writer, "цинк и иммунитет", "железо при анемии")
+    delete(writer, "витамин д зимой")
+
+    # Индекс с диска, сохранённый до этих изменений, догоняет их по журналу
+    index = ANNIndex(rag.db_path, "ivf", nprobe=64)
+    assert index.load()
+    store = VectorStore(model_name=rag.model_name)
+    store.load(rag.db_path)
+    assert not index.is_fresh(store)
+    assert index.catch_up(store)
+    found = set(store.ids[store.positions_for_ids(index.search(store.matrix[0], 10))].tolist())
+    assert found == set(store.id_to_pos)
+
+    # То же для индекса, который держит работающий обработчик
+    store = rag._get_vector_store()
+    assert rag._ann_index.is_fresh(store)
+    assert_store_matches_db(store, rag)
@@ -0,0 +1,88 @@
+import logging
+from typing import Optional
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class TopicShards:
+    """Разбиение строк матрицы VectorStore на тематические шарды по topic_mask.
+
+    Шард группы KEYWORD_GROUPS хранит позиции строк, маска которых содержит эту группу; строки без
+    тем попадают в общий шард. Запрос с темами оценивается только по шардам своих тем и общему шарду,
+    запрос без тем — по всей матрице, как без шардов. Шарды только дописываются: при смене маски строка
+    добавляется в новые шарды, а старое вхождение отсеивается проверкой маски при маршрутизации и
+    выбрасывается при перестроении, когда таких вхождений набирается больше половины.
+    """
+
+    GENERAL = -1
+
+    def __init__(self, groups: int):
+        self.groups = groups
+        self._positions = {shard: np.zeros(0, dtype=np.int64) for shard in self._shard_keys()}
+        self._sizes = {shard: 0 for shard in self._positions}
+        self.entries = 0
+        self.stale = 0
+
+    def _shard_keys(self):
+        return [self.GENERAL] + list(range(self.groups))
+
+    def _shards_for_mask(self, mask: int):
+        shards = [index for index in range(min(mask.bit_length(), self.groups)) if mask >> index & 1]
+        return shards or [self.GENERAL]
+
+    def _append(self, shard: int, pos: int):
+        positions = self._positions[shard]
+        size = self._sizes[shard]
+        if size == len(positions):
+            grown = np.zeros(max(16, 2 * len(positions)), dtype=np.int64)
+            grown[:size] = positions
+            self._positions[shard] = positions = grown
+        positions[size] = pos
+        self._sizes[shard] = size + 1
+        self.entries += 1
+
+    def add(self, pos: int, mask: int, old_mask: Optional[int] = None):
+        """Строка pos получила маску mask (old_mask — прежняя маска, если строка уже была в шардах)"""
+        old = set(self._shards_for_mask(old_mask)) if old_mask is not None else set()
+        for shard in self._shards_for_mask(mask):
+            if shard not in old:
+                self._append(shard, pos)
+        self.stale += len(old - set(self._shards_for_mask(mask)))
+
+    def remove(self, mask: int):
+        """Строка с маской mask удалена из матрицы; её вхождения станут устаревшими"""
+        self.stale += len(self._shards_for_mask(mask))
+
+    def rebuild(self, masks: np.ndarray, valid: np.ndarray):
+        self._positions = {}
+        live = np.nonzero(valid)[0]
+        live_masks = masks[live]
+        self._positions[self.GENERAL] = live[live_masks == 0]
+        for index in range(self.groups):
+            self._positions[index] = live[(live_masks >> index & 1) != 0]
+        self._sizes = {shard: len(positions) for shard, positions in self._positions.items()}
+        logger.debug(f"Тематические шарды перестроены: выброшено {self.stale} устаревших вхождений")
+        self.entries = sum(self._sizes.values())
+        self.stale = 0
+
+    def route(self, query_mask: int, masks: np.ndarray, valid: np.ndarray) -> Optional[np.ndarray]:
+        """Отсортированные позиции строк из шардов тем запроса и общего шарда;
+        None — тем в запросе нет, и оценивать нужно всю матрицу"""
+        if not query_mask:
+            return None
+        if self.stale > self.entries // 2:
+            self.rebuild(masks, valid)
+        # Строка из нескольких шардов отмечается один раз; сортировка объединения обошлась бы дороже
+        selected = np.zeros(len(masks), dtype=bool)
+        for shard in set(self._shards_for_mask(query_mask)) | {self.GENERAL}:
+            selected[self._positions[shard][:self._sizes[shard]]] = True
+        positions = np.flatnonzero(selected)
+        return positions[self.member(positions, query_mask, masks, valid)]
+
+    @staticmethod
+    def member(positions: np.ndarray, query_mask: int, masks: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        """Какие из positions относятся к шардам запроса с маской query_mask"""
+        row_masks = masks[positions]
+        return valid[positions] & (((row_masks & query_mask) != 0) | (row_masks == 0))
+
@@ -0,0 +1,94 @@
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class UsageBuffer:
+    """Отложенная запись usage_count/last_used для knowledge_vectors.
+
+    После каждого ответа счётчики найденных записей только накапливаются в памяти; фоновый поток раз в
+    flush_interval секунд (или при max_pending ожидающих записях) сбрасывает их в базу одной транзакцией.
+    Так горячий путь ответа не открывает пишущую транзакцию и не конкурирует с записью диалогов.
+    """
+
+    def __init__(self, db_path: str, flush_interval: float = 30.0, max_pending: int = 500):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        # id записи -> (число использований, время последнего использования)
+        self._pending: Dict[int, Tuple[int, str]] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.flushed = 0
+
+    def add(self, vector_ids: Iterable[int]):
+        now = datetime.now().isoformat()
+        with self._lock:
+            for vec_id in vector_ids:
+                count, _ = self._pending.get(vec_id, (0, now))
+                self._pending[vec_id] = (count + 1, now)
+            overflow = len(self._pending) >= self.max_pending
+        if self._thread is None:
+            self.start()
+        if overflow:
+            self._wake.set()
+
+    def flush(self) -> int:
+        """Записывает накопленные счётчики одной транзакцией; возвращает число обновлённых записей"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            conn = sqlite3.connect(self.db_path)
+            try:
+                cursor = conn.cursor()
+                # Записи, удалённые после поиска, просто не найдутся по id
+                cursor.executemany('''UPDATE knowledge_vectors
+                                    SET usage_count = usage_count + ?,
+                                        last_used = MAX(COALESCE(last_used, ''), ?)
+                                    WHERE id = ?''',
+                                   [(count, last_used, vec_id) for vec_id, (count, last_used) in pending.items()])
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                logger.error(f"Ошибка записи счетчиков использования: {e}")
+                # Возвращаем несохранённое в буфер, чтобы не потерять при следующей попытке
+                with self._lock:
+                    for vec_id, (count, last_used) in pending.items():
+                        new_count, new_last_used = self._pending.get(vec_id, (0, last_used))
+                        self._pending[vec_id] = (count + new_count, max(last_used, new_last_used))
+                return 0
+            finally:
+                conn.close()
+            self.flushed += len(pending)
+            logger.info(f"Обновлены счетчики для {len(pending)} записей")
+            return len(pending)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="usage-flush", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def stop(self):
+        """Останавливает фоновый поток и записывает остаток буфера"""
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
@@ -0,0 +1,231 @@
+import os
+import sqlite3
+import tempfile
+import logging
+from typing import List, Optional, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Описание текущего файла векторов: поколение меняется при уплотнении, dim — размерность строк,
+# model_name — модель, которой построены векторы. staging_* — файл, который заполняет фоновая
+# переиндексация другой моделью; он становится текущим одной транзакцией в конце переиндексации
+VECTOR_FILES_SCHEMA = '''CREATE TABLE IF NOT EXISTS vector_files (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    generation INTEGER NOT NULL,
+                    dim INTEGER NOT NULL,
+                    model_name TEXT,
+                    staging_generation INTEGER,
+                    staging_model TEXT,
+                    staging_dim INTEGER)'''
+
+
+class VectorFile:
+    """Append-only файл L2-нормированных float32 векторов рядом с базой (nutrition_bot.db.vectors.<поколение>).
+
+    Строка файла с номером vector_offset принадлежит записи knowledge_vectors с этим смещением.
+    Читатели отображают файл в память (np.memmap) и считают по нему без копирования, страницы
+    общие для бота и процессов загрузки через page cache. Дописывать и уплотнять файл можно только
+    внутри транзакции BEGIN IMMEDIATE: блокировка записи SQLite упорядочивает всех писателей.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+
+    def path(self, generation: int) -> str:
+        return f"{self.db_path}.vectors.{generation}"
+
+    @staticmethod
+    def init_schema(cursor):
+        cursor.execute(VECTOR_FILES_SCHEMA)
+        cursor.execute('PRAGMA table_info(vector_files)')
+        columns = [column[1] for column in cursor.fetchall()]
+        for column, column_type in (("model_name", "TEXT"), ("staging_generation", "INTEGER"),
+                                    ("staging_model", "TEXT"), ("staging_dim", "INTEGER")):
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE vector_files ADD COLUMN {column} {column_type}')
+        # embedding_model — модель вектора записи; staged_offset/staged_hash — её вектор в файле
+        # переиндексации и content_hash, по которому он посчитан
+        cursor.execute('PRAGMA table_info(knowledge_vectors)')
+        columns = [column[1] for column in cursor.fetchall()]
+        for column, column_type in (("vector_offset", "INTEGER"), ("embedding_model", "TEXT"),
+                                    ("staged_offset", "INTEGER"), ("staged_hash", "TEXT")):
+            if column not in columns:
+                cursor.execute(f'ALTER TABLE knowledge_vectors ADD COLUMN {column} {column_type}')
+
+    @staticmethod
+    def init_model(cursor, model_name: str):
+        """Векторы, построенные до появления метаданных, считаются векторами model_name"""
+        cursor.execute('UPDATE vector_files SET model_name = ? WHERE id = 1 AND model_name IS NULL', (model_name,))
+        cursor.execute('''UPDATE knowledge_vectors SET embedding_model = (SELECT model_name FROM vector_files)
+                        WHERE embedding_model IS NULL AND vector_offset IS NOT NULL''')
+
+    @staticmethod
+    def active_model(db_path: str) -> Optional[str]:
+        """Модель текущего файла векторов или None, если база ещё не размечена"""
+        conn = sqlite3.connect(db_path)
+        try:
+            return conn.execute('SELECT model_name FROM vector_files WHERE id = 1').fetchone()[0]
+        except (sqlite3.OperationalError, TypeError):
+            return None
+        finally:
+            conn.close()
+
+    @staticmethod
+    def current(cursor) -> Optional[Tuple[int, int]]:
+        cursor.execute('SELECT generation, dim FROM vector_files WHERE id = 1')
+        return cursor.fetchone()
+
+    @staticmethod
+    def current_model(cursor) -> Optional[str]:
+        cursor.execute('SELECT model_name FROM vector_files WHERE id = 1')
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def staging(cursor) -> Optional[Tuple[int, int, str]]:
+        """(поколение, размерность, модель) файла переиндексации, если она идёт"""
+        cursor.execute('''SELECT staging_generation, staging_dim, staging_model FROM vector_files
+                        WHERE id = 1 AND staging_generation IS NOT NULL''')
+        return cursor.fetchone()
+
+    @staticmethod
+    def next_generation(cursor) -> int:
+        """Свободный номер поколения: больше и текущего файла, и файла переиндексации"""
+        cursor.execute('SELECT MAX(generation, COALESCE(staging_generation, 0)) FROM vector_files WHERE id = 1')
+        row = cursor.fetchone()
+        return (row[0] if row else 0) + 1
+
+    def open_matrix(self, generation: int, dim: int) -> np.ndarray:
+        """Отображение файла поколения generation в память только для чтения"""
+        path = self.path(generation)
+        rows = os.path.getsize(path) // (dim * 4) if os.path.exists(path) else 0
+        if not rows or not dim:
+            return np.zeros((0, dim), dtype=np.float32)
+        return np.memmap(path, dtype=np.float32, mode='r', shape=(rows, dim))
+
+    def append(self, cursor, vectors: List[np.ndarray], dim: int, model_name: Optional[str] = None,
+               generation: Optional[int] = None) -> List[int]:
+        """Дописывает векторы в конец текущего файла (или файла поколения generation) и возвращает
+        их смещения; вызывать внутри BEGIN IMMEDIATE"""
+        if generation is not None:
+            state = (generation, dim)
+        else:
+            state = self.current(cursor)
+        if state is None:
+            cursor.execute('INSERT INTO vector_files (id, generation, dim, model_name) VALUES (1, 1, ?, ?)',
+                           (dim, model_name))
+            state = (1, dim)
+        generation, file_dim = state
+        if file_dim != dim:
+            raise ValueError(f"Размерность вектора {dim} не совпадает с файлом векторов ({file_dim})")
+
+        block = np.zeros((len(vectors), dim), dtype=np.float32)
+        for i, vector in enumerate(vectors):
+            vector = np.asarray(vector, dtype=np.float32).ravel()
+            norm = np.linalg.norm(vector)
+            block[i] = vector / norm if norm > 0 else vector
+        with open(self.path(generation), 'ab') as f:
+            start = f.tell() // (dim * 4)
+            f.write(block.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        return list(range(start, start + len(vectors)))
+
+    def migrate_blobs(self, conn, dim: int) -> int:
+        """Переносит векторы из BLOB-колонки vector в файл и очищает BLOB; записи другой размерности остаются как есть"""
+        cursor = conn.cursor()
+        cursor.execute('''SELECT COUNT(*) FROM knowledge_vectors
+                        WHERE vector_offset IS NULL AND length(vector) = ?''', (dim * 4,))
+        if not cursor.fetchone()[0]:
+            return 0
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('''SELECT id, vector FROM knowledge_vectors
+                        WHERE vector_offset IS NULL AND length(vector) = ? ORDER BY id''', (dim * 4,))
+        rows = cursor.fetchall()
+        migrated = 0
+        for start in range(0, len(rows), 1000):
+            batch = rows[start:start + 1000]
+            offsets = self.append(cursor, [np.frombuffer(blob, dtype=np.float32) for _, blob in batch], dim)
+            cursor.executemany('''UPDATE knowledge_vectors SET vector_offset = ?, vector = x'' WHERE id = ?''',
+                               [(offset, vec_id) for offset, (vec_id, _) in zip(offsets, batch)])
+            migrated += len(batch)
+        conn.commit()
+        logger.info(f"Перенесено {migrated} векторов из BLOB в файл {self.path(self.current(cursor)[0])}")
+        return migrated
+
+    def compact(self, conn) -> int:
+        """Переписывает живые векторы в файл нового поколения и возвращает число освобождённых строк.
+
+        Векторы, известные на начало, копируются без блокировки записи, так что вставки и запись счётчиков
+        не ждут копирования. Под коротким BEGIN IMMEDIATE дописываются строки, появившиеся за это время,
+        переписываются смещения и меняется поколение."""
+        cursor = conn.cursor()
+        state = self.current(cursor)
+        if state is None:
+            return 0
+        generation, dim = state
+        copied = self._live_rows(cursor)
+        if len(self.open_matrix(generation, dim)) - len(copied) <= 0:
+            return 0
+
+        # Номер поколения выбирается под блокировкой, поэтому копия пишется во временный файл рядом с базой
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(self.db_path) + ".vectors.", suffix=".compact",
+                                         dir=os.path.dirname(os.path.abspath(self.db_path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self._copy_rows(f, generation, dim, copied[:, 1])
+                f.flush()
+                os.fsync(f.fileno())
+
+                cursor.execute('BEGIN IMMEDIATE')
+                if self.current(cursor) != state:
+                    # Файл успела сменить переиндексация или другое уплотнение
+                    conn.rollback()
+                    return 0
+                live = self._live_rows(cursor)
+                old_rows = len(self.open_matrix(generation, dim))
+                # Строка сохраняет место в копии, если с начала копирования не сменила смещение; остальные
+                # (добавленные за время копирования) дописываются в конец
+                index = np.minimum(np.searchsorted(copied[:, 0], live[:, 0]), max(len(copied) - 1, 0))
+                same = (copied[index] == live).all(axis=1) if len(copied) else np.zeros(len(live), dtype=bool)
+                new_offsets = np.where(same, index, 0)
+                new_offsets[~same] = len(copied) + np.arange(np.count_nonzero(~same))
+                self._copy_rows(f, generation, dim, live[~same, 1])
+                f.flush()
+                os.fsync(f.fileno())
+            new_generation = self.next_generation(cursor)
+            os.replace(temp_path, self.path(new_generation))
+            cursor.executemany('UPDATE knowledge_vectors SET vector_offset = ? WHERE id = ?',
+                               zip(new_offsets.tolist(), live[:, 0].tolist()))
+            cursor.execute('UPDATE vector_files SET generation = ? WHERE id = 1', (new_generation,))
+            conn.commit()
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        # Процессы, успевшие отобразить старый файл, дочитают его и перейдут на новое поколение при синхронизации
+        try:
+            os.remove(self.path(generation))
+        except OSError as e:
+            logger.warning(f"Не удалось удалить старый файл векторов: {e}")
+        reclaimed = old_rows - len(live)
+        logger.info(f"Файл векторов уплотнён: поколение {new_generation}, освобождено {reclaimed} строк, "
+                    f"под блокировкой дописано {np.count_nonzero(~same)}")
+        return reclaimed
+
+    @staticmethod
+    def _live_rows(cursor) -> np.ndarray:
+        """Пары (id, vector_offset) записей с вектором в файле, по возрастанию id"""
+        cursor.execute('''SELECT id, vector_offset FROM knowledge_vectors
+                        WHERE vector_offset IS NOT NULL ORDER BY id''')
+        return np.array(cursor.fetchall(), dtype=np.int64).reshape(-1, 2)
+
+    def _copy_rows(self, f, generation: int, dim: int, offsets: np.ndarray):
+        matrix = self.open_matrix(generation, dim)
+        for start in range(0, len(offsets), 10000):
+            f.write(np.ascontiguousarray(matrix[offsets[start:start + 10000]]).tobytes())
@@ -0,0 +1,533 @@
+import os
+import re
+import sqlite3
+import hashlib
+import logging
+from typing import List, Optional, Tuple
+import numpy as np
+from vector_file import VectorFile
+from keyword_groups import KEYWORD_MATCHER
+from topic_shards import TopicShards
+
+logger = logging.getLogger(__name__)
+
+# Журнал изменений knowledge_vectors ведут триггеры, поэтому вставки, правки и удаления видны
+# всем экземплярам RAGHandler и процессам, а не только тому, кто писал в базу.
+# Обновления usage_count/last_used в журнал не попадают — на поиск они не влияют.
+CHANGELOG_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS knowledge_changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    row_id INTEGER NOT NULL,
+                    op TEXT NOT NULL)''',
+    '''CREATE TRIGGER IF NOT EXISTS knowledge_vectors_insert AFTER INSERT ON knowledge_vectors
+                    BEGIN INSERT INTO knowledge_changes (row_id, op) VALUES (NEW.id, 'upsert'); END''',
+    '''CREATE TRIGGER IF NOT EXISTS knowledge_vectors_update
+                    AFTER UPDATE OF question, answer, context, vector, is_from_pdf, tags, topic_mask ON knowledge_vectors
+                    BEGIN INSERT INTO knowledge_changes (row_id, op) VALUES (NEW.id, 'upsert'); END''',
+    '''CREATE TRIGGER IF NOT EXISTS knowledge_vectors_delete AFTER DELETE ON knowledge_vectors
+                    BEGIN INSERT INTO knowledge_changes (row_id, op) VALUES (OLD.id, 'delete'); END''',
+]
+
+ROW_COLUMNS = "id, question, answer, context, vector_offset, is_from_pdf, tags, topic_mask"
+
+
+def init_changelog(cursor):
+    # topic_mask входит в список колонок триггера правки, поэтому колонка добавляется до триггеров
+    cursor.execute('PRAGMA table_info(knowledge_vectors)')
+    if 'topic_mask' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE knowledge_vectors ADD COLUMN topic_mask INTEGER')
+    # Триггер правки из старых версий не следит за topic_mask — пересоздаём его
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'knowledge_vectors_update'")
+    trigger = cursor.fetchone()
+    if trigger and 'topic_mask' not in trigger[0]:
+        cursor.execute('DROP TRIGGER knowledge_vectors_update')
+    for statement in CHANGELOG_SCHEMA:
+        cursor.execute(statement)
+
+
+def prune_changelog(cursor, keep: int = 50000) -> int:
+    """Оставляет в журнале последние keep изменений; отставшие читатели перезагрузят матрицу целиком"""
+    cursor.execute('''DELETE FROM knowledge_changes
+                    WHERE seq <= (SELECT MAX(seq) FROM knowledge_changes) - ?''', (keep,))
+    return cursor.rowcount
+
+
+def row_topic_mask(question, answer, context, tags) -> int:
+    """Маска тематических групп KEYWORD_GROUPS для записи: по тексту, с которым сравнивается запрос, и тегам"""
+    text_to_compare = context if context else (question or answer)
+    return KEYWORD_MATCHER.mask(f"{text_to_compare or ''}\n{tags or ''}")
+
+
+def backfill_topic_masks(conn, force: bool = False) -> int:
+    """Заполняет topic_mask у записей без маски (force=True — пересчитывает все, например после правки групп)"""
+    cursor = conn.cursor()
+    where = '' if force else 'WHERE topic_mask IS NULL'
+    cursor.execute(f'SELECT COUNT(*) FROM knowledge_vectors {where}')
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute(f'SELECT id, question, answer, context, tags FROM knowledge_vectors {where}')
+    updates = [(row_topic_mask(*row[1:]), row[0]) for row in cursor.fetchall()]
+    # Совпадающие маски не переписываем, чтобы не засорять журнал изменений
+    cursor.executemany('UPDATE knowledge_vectors SET topic_mask = ? WHERE id = ? AND topic_mask IS NOT ?',
+                       [(mask, vec_id, mask) for mask, vec_id in updates])
+    conn.commit()
+    logger.info(f"Тематические маски пересчитаны для {len(updates)} записей")
+    return len(updates)
+
+
+def content_hash(question, answer, context) -> str:
+    """Хеш нормализованного содержимого записи: регистр и пробельные символы не различаются"""
+    parts = [re.sub(r"\s+", " ", (part or "").lower()).strip() for part in (question, answer, context)]
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def init_content_hashes(conn) -> int:
+    """Заполняет content_hash у записей без хеша, сливая дубли в запись с наименьшим id, и создаёт
+    уникальный индекс. Возвращает число удалённых дублей"""
+    cursor = conn.cursor()
+    cursor.execute('PRAGMA table_info(knowledge_vectors)')
+    if 'content_hash' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE knowledge_vectors ADD COLUMN content_hash TEXT')
+        conn.commit()
+    cursor.execute('SELECT COUNT(*) FROM knowledge_vectors WHERE content_hash IS NULL')
+    if not cursor.fetchone()[0]:
+        cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_knowledge_content_hash
+                        ON knowledge_vectors (content_hash)''')
+        conn.commit()
+        return 0
+
+    cursor.execute('BEGIN IMMEDIATE')
+    cursor.execute('SELECT content_hash, id FROM knowledge_vectors WHERE content_hash IS NOT NULL')
+    owners = dict(cursor.fetchall())
+    cursor.execute('''SELECT id, question, answer, context, usage_count, last_used, is_from_pdf, tags
+                    FROM knowledge_vectors WHERE content_hash IS NULL ORDER BY id''')
+    hashes, merges, duplicates = [], [], []
+    for vec_id, question, answer, context, usage_count, last_used, is_from_pdf, tags in cursor.fetchall():
+        digest = content_hash(question, answer, context)
+        if digest in owners:
+            merges.append((usage_count or 0, last_used, is_from_pdf, tags, owners[digest]))
+            duplicates.append((vec_id,))
+        else:
+            owners[digest] = vec_id
+            hashes.append((digest, vec_id))
+    cursor.executemany('UPDATE knowledge_vectors SET content_hash = ? WHERE id = ?', hashes)
+    cursor.executemany('''UPDATE knowledge_vectors
+                        SET usage_count = usage_count + ?, last_used = MAX(COALESCE(last_used, ''), COALESCE(?, '')),
+                            is_from_pdf = MAX(is_from_pdf, ?), tags = COALESCE(tags, ?)
+                        WHERE id = ?''', merges)
+    cursor.executemany('DELETE FROM knowledge_vectors WHERE id = ?', duplicates)
+    cursor.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_knowledge_content_hash
+                    ON knowledge_vectors (content_hash)''')
+    conn.commit()
+    logger.info(f"Хеши содержимого заполнены для {len(hashes)} записей, удалено дублей: {len(duplicates)}")
+    return len(duplicates)
+
+
+def normalize_vector(vector) -> np.ndarray:
+    """Возвращает L2-нормированную float32 копию вектора (нулевой вектор остаётся нулевым)"""
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector = vector / norm
+    return vector.astype(np.float32, copy=False)
+
+
+class VectorStore:
+    """Все векторы knowledge_vectors в одной непрерывной L2-нормированной float32 матрице.
+
+    Матрица — отображение в память файла векторов (VectorFile), поэтому загрузка и поиск идут без копирования:
+    позиция строки совпадает с vector_offset записи, а ids[i], is_from_pdf[i], topic_masks[i] и rows[i] =
+    (question, answer, context, tags) описывают запись, которой принадлежит строка i. Косинусная близость запроса ко всей базе
+    считается одним умножением матрицы на вектор.
+
+    Матрица поддерживается инкрементально по журналу knowledge_changes: новые строки файла подхватываются
+    переотображением (массивы метаданных растут удвоением), правка — O(1) на месте, удаление — O(1) пометкой
+    valid=False. Освобождённые строки остаются в файле до уплотнения (VectorFile.compact), после которого
+    меняется поколение файла и матрица перезагружается.
+
+    quantization='float16' или 'int8' держит в памяти сжатую копию матрицы (int8 — с масштабом по каждой
+    размерности) для грубого просмотра всей базы; лучшие кандидаты затем пересчитываются по точным float32
+    векторам из файла, страницы которого ядро может вытеснять.
+    """
+
+    QUANTIZATIONS = (None, "float16", "int8")
+    _SCAN_BLOCK = 8192
+
+    _ARRAYS = ("_ids", "_is_from_pdf", "_topic_masks", "_valid")
+
+    def __init__(self, dim: Optional[int] = None, quantization: Optional[str] = None,
+                 model_name: Optional[str] = None):
+        # dim=None — размерность берётся из описания файла векторов
+        if quantization not in self.QUANTIZATIONS:
+            raise ValueError(f"Неизвестный тип квантования: {quantization}")
+        self.dim = dim
+        self.quantization = quantization
+        # Модель векторов файла; меняется, когда фоновая переиндексация подменяет файл
+        self.model_name = model_name
+        self.db_path = None
+        self.vector_file = None
+        self.generation = 0
+        self._reset(0)
+
+    def _reset(self, capacity: int):
+        self._matrix = np.zeros((0, self.dim or 0), dtype=np.float32)
+        self._coarse = np.zeros((capacity, self.dim or 0), dtype=np.int8 if self.quantization == "int8" else np.float16)
+        self._scale = None
+        self._ids = np.full(capacity, -1, dtype=np.int64)
+        self._is_from_pdf = np.zeros(capacity, dtype=bool)
+        # Бит i — группа KEYWORD_MATCHER.group_names[i]; тематический буст считается одним & по массиву
+        self._topic_masks = np.zeros(capacity, dtype=np.int64)
+        # Позиции строк по тематическим шардам — для маршрутизации запросов с темами
+        self.shards = TopicShards(len(KEYWORD_MATCHER.group_names))
+        # valid = False для свободных строк файла и пустых записей; дублей в таблице нет (content_hash)
+        self._valid = np.zeros(capacity, dtype=bool)
+        self.size = 0
+        self.live_count = 0
+        self.rows: List[Optional[tuple]] = []
+        self.id_to_pos = {}
+        self.last_seq = 0
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._matrix[:self.size]
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self._ids[:self.size]
+
+    @property
+    def is_from_pdf(self) -> np.ndarray:
+        return self._is_from_pdf[:self.size]
+
+    @property
+    def topic_masks(self) -> np.ndarray:
+        return self._topic_masks[:self.size]
+
+    @property
+    def valid(self) -> np.ndarray:
+        return self._valid[:self.size]
+
+    def __len__(self):
+        return self.size
+
+    def load(self, db_path: str, attempts: int = 3):
+        self.db_path = db_path
+        self.vector_file = VectorFile(db_path)
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        init_changelog(cursor)
+        VectorFile.init_schema(cursor)
+        conn.commit()
+        for _ in range(attempts):
+            # Номер журнала, поколение файла и смещения читаются одним снимком
+            cursor.execute('BEGIN')
+            cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM knowledge_changes')
+            last_seq = cursor.fetchone()[0]
+            state = VectorFile.current(cursor)
+            file_model = VectorFile.current_model(cursor)
+            cursor.execute(f'''SELECT {ROW_COLUMNS} FROM knowledge_vectors
+                             WHERE vector_offset IS NOT NULL ORDER BY id''')
+            results = cursor.fetchall()
+            conn.commit()
+            # Файл могли уплотнить и удалить между снимком и отображением — тогда читаем заново
+            if state is None or os.path.exists(self.vector_file.path(state[0])):
+                break
+        conn.close()
+
+        generation, dim = state or (0, self.dim or 0)
+        if self.dim is None or (state and file_model and self.model_name and file_model != self.model_name):
+            # Переиндексация завершилась: файл построен другой моделью, и размерность берётся из него
+            self.dim = dim
+        elif dim != self.dim:
+            logger.error(f"Размерность файла векторов ({dim}) не совпадает с моделью ({self.dim})")
+            results = []
+        self.generation = generation
+        self.model_name = file_model or self.model_name
+        self._reset(0)
+        self._remap()
+        for row in results:
+            self._put_row(row)
+        self.last_seq = last_seq
+        logger.info(f"Загружено {self.live_count} векторов (поколение файла {generation}), размерность {self.dim}")
+        if self.quantization and self.live_count:
+            recall = self.measure_recall(k=10, candidates=200)
+            logger.info(f"Квантование {self.quantization}: {self._coarse[:self.size].nbytes // 1024} КБ в памяти "
+                        f"вместо {self.matrix.nbytes // 1024} КБ, recall@10 относительно точного поиска: {recall:.3f}")
+
+    @staticmethod
+    def _read_changes(cursor, since_seq: int) -> Optional[Tuple[List[int], List[int], int]]:
+        cursor.execute('''SELECT seq, row_id, op FROM knowledge_changes
+                        WHERE seq > ? ORDER BY seq''', (since_seq,))
+        changes = cursor.fetchall()
+        if not changes:
+            return [], [], since_seq
+        if changes[0][0] > since_seq + 1:
+            return None
+
+        latest = {}
+        for _, row_id, op in changes:
+            latest[row_id] = op
+        upserted = [row_id for row_id, op in latest.items() if op == 'upsert']
+        removed = [row_id for row_id, op in latest.items() if op == 'delete']
+        return upserted, removed, changes[-1][0]
+
+    def changed_ids(self, db_path: str, since_seq: int) -> Optional[Tuple[List[int], List[int], int]]:
+        """Id записей, изменённых и удалённых после since_seq, и новый номер журнала.
+        None — журнал уже обрезан дальше since_seq и нужна полная перезагрузка"""
+        conn = sqlite3.connect(db_path)
+        changed = self._read_changes(conn.cursor(), since_seq)
+        conn.close()
+        return changed
+
+    def sync(self, db_path: str) -> Optional[Tuple[List[int], List[int]]]:
+        """Применяет к матрице изменения из журнала. Возвращает (upserted_ids, removed_ids)
+        или None, если пришлось перезагрузить матрицу целиком"""
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        state = VectorFile.current(cursor)
+        changed = None
+        if state is None or state[0] == self.generation:
+            changed = self._read_changes(cursor, self.last_seq)
+        if changed is None:
+            conn.commit()
+            conn.close()
+            logger.warning("Файл векторов уплотнён или журнал обрезан, матрица перезагружается целиком")
+            self.load(db_path)
+            return None
+        upserted, removed, last_seq = changed
+        if last_seq == self.last_seq:
+            conn.commit()
+            conn.close()
+            return [], []
+
+        rows = []
+        for start in range(0, len(upserted), 500):
+            batch = upserted[start:start + 500]
+            # Записи без строки в файле векторов (старая размерность, не перенесённая migrate_blobs) в матрицу
+            # не попадают: ниже они считаются удалёнными
+            cursor.execute(f'''SELECT {ROW_COLUMNS} FROM knowledge_vectors
+                             WHERE id IN ({",".join("?" * len(batch))}) AND vector_offset IS NOT NULL
+                             ORDER BY id''', batch)
+            rows.extend(cursor.fetchall())
+        conn.commit()
+        conn.close()
+
+        found = [row[0] for row in rows if self._put_row(row)]
+        # Записи, которых уже нет в таблице или в файле, считаем удалёнными
+        found_set = set(found)
+        removed = removed + [row_id for row_id in upserted if row_id not in found_set]
+        removed = [row_id for row_id in removed if self._remove(row_id)]
+        self.last_seq = last_seq
+        logger.debug(f"Синхронизация матрицы: +{len(found)} / -{len(removed)} записей")
+        return found, removed
+
+    def similarities(self, query_vector, positions: Optional[np.ndarray] = None) -> np.ndarray:
+        """Косинусная близость запроса ко всем строкам матрицы или только к строкам positions"""
+        if not self.size:
+            return np.zeros(0, dtype=np.float32)
+        matrix = self.matrix if positions is None else self.matrix[positions]
+        return matrix @ normalize_vector(query_vector)
+
+    def similarities_many(self, query_vectors) -> np.ndarray:
+        """Близость каждого из запросов ко всем строкам матрицы одним умножением: массив (size, число запросов)"""
+        queries = np.stack([normalize_vector(vector) for vector in query_vectors], axis=1)
+        if not self.size:
+            return np.zeros((0, queries.shape[1]), dtype=np.float32)
+        return self.matrix @ queries
+
+    def coarse_candidates(self, query_vector, count: int) -> np.ndarray:
+        """Позиции count лучших строк по сжатой копии матрицы (для последующего точного пересчёта)"""
+        query = normalize_vector(query_vector)
+        if self.quantization == "int8":
+            query = query * self._scale
+        scores = np.empty(self.size, dtype=np.float32)
+        for start in range(0, self.size, self._SCAN_BLOCK):
+            block = self._coarse[start:min(start + self._SCAN_BLOCK, self.size)]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query
+        scores[~self.valid] = -np.inf
+        return top_k_positions(scores, np.nonzero(scores > -np.inf)[0], count)
+
+    def measure_recall(self, k: int = 10, candidates: int = 200, sample: int = 32) -> float:
+        """recall@k грубого просмотра с пересчётом относительно точного поиска; запросы — случайные векторы базы"""
+        live = np.nonzero(self.valid)[0]
+        if not len(live):
+            return 1.0
+        rng = np.random.default_rng(0)
+        hits = total = 0
+        for pos in rng.choice(live, size=min(sample, len(live)), replace=False):
+            query = np.array(self.matrix[pos])
+            exact = self.similarities(query)
+            exact[~self.valid] = -np.inf
+            expected = set(top_k_positions(exact, live, k).tolist())
+            found = self.coarse_candidates(query, candidates)
+            rescored = top_k_positions(exact, found, k)
+            hits += len(expected & set(rescored.tolist()))
+            total += len(expected)
+        return hits / total
+
+    def positions_for_ids(self, ids: np.ndarray) -> np.ndarray:
+        """Позиции строк матрицы для id из knowledge_vectors; неизвестные и удалённые id отбрасываются"""
+        positions = {self.id_to_pos[vec_id] for vec_id in np.asarray(ids).tolist() if vec_id in self.id_to_pos}
+        return np.array(sorted(positions), dtype=np.int64)
+
+    def topic_positions(self, query_mask: int) -> Optional[np.ndarray]:
+        """Позиции строк тематических шардов запроса и общего шарда; None — запрос без тем"""
+        return self.shards.route(query_mask, self.topic_masks, self.valid)
+
+    def in_topic_shards(self, positions: np.ndarray, query_mask: int) -> np.ndarray:
+        """Булева маска: какие из positions входят в тематические шарды запроса или в общий шард"""
+        return TopicShards.member(positions, query_mask, self.topic_masks, self.valid)
+
+    def _remap(self):
+        """Переотображает файл векторов, чтобы увидеть строки, дописанные после прошлого отображения"""
+        if self.generation:
+            self._matrix = self.vector_file.open_matrix(self.generation, self.dim)
+        rows = len(self._matrix)
+        if rows > len(self._ids):
+            capacity = max(rows, 2 * len(self._ids))
+            for name in self._ARRAYS:
+                old = getattr(self, name)
+                new = np.full(capacity, -1, dtype=old.dtype) if name == "_ids" else np.zeros(capacity, dtype=old.dtype)
+                new[:self.size] = old[:self.size]
+                setattr(self, name, new)
+            if self.quantization:
+                coarse = np.zeros((capacity, self.dim), dtype=self._coarse.dtype)
+                coarse[:self.size] = self._coarse[:self.size]
+                self._coarse = coarse
+        if self.quantization and rows > self.size:
+            self._quantize_rows(self.size, rows)
+        self.rows.extend([None] * (rows - len(self.rows)))
+        self.size = rows
+
+    def _quantize_rows(self, start: int, end: int):
+        if self.quantization == "float16":
+            for block in range(start, end, self._SCAN_BLOCK):
+                stop = min(block + self._SCAN_BLOCK, end)
+                self._coarse[block:stop] = self._matrix[block:stop].astype(np.float16)
+            return
+        # Масштаб по каждой размерности берётся по максимуму модуля: при загрузке — по всей матрице, при
+        # синхронизации — по новым строкам. Если новые строки выходят за текущий масштаб, он расширяется с запасом
+        # и вся матрица пересжимается, иначе их компоненты обрезались бы до ±127
+        rescale = self._scale is None
+        if rescale:
+            start = 0
+        max_abs = np.zeros(self.dim, dtype=np.float32)
+        for block in range(start, end, self._SCAN_BLOCK):
+            max_abs = np.maximum(max_abs, np.abs(self._matrix[block:min(block + self._SCAN_BLOCK, end)]).max(axis=0))
+        if not rescale and (np.rint(max_abs / self._scale) > 127).any():
+            max_abs = np.maximum(max_abs, self._scale * 127.0) * 1.25
+            rescale, start = True, 0
+        if rescale:
+            # Компоненты L2-нормированного вектора не больше 1 по модулю — больше масштаб не нужен
+            max_abs = np.minimum(max_abs, 1.0)
+            self._scale = np.where(max_abs > 0, max_abs, 1.0).astype(np.float32) / 127.0
+        for block in range(start, end, self._SCAN_BLOCK):
+            stop = min(block + self._SCAN_BLOCK, end)
+            self._coarse[block:stop] = np.clip(np.rint(self._matrix[block:stop] / self._scale), -127, 127)
+
+    def _put_row(self, row) -> bool:
+        vec_id, question, answer, context, offset, is_from_pdf, tags, topic_mask = row
+        if offset >= self.size:
+            self._remap()
+            if offset >= self.size:
+                logger.warning(f"Смещение вектора за пределами файла: id={vec_id}, offset={offset}")
+                self._remove(vec_id)
+                return False
+        text_to_compare = context if context else (question or answer)
+        if not text_to_compare:
+            logger.warning(f"Пустая запись в базе: id={vec_id}")
+
+        pos = self.id_to_pos.get(vec_id)
+        if pos is not None and pos != offset:
+            # Вектор записи переписан в другую строку файла
+            self._remove(vec_id)
+            pos = None
+        old_mask = None
+        if pos is None:
+            pos = offset
+            self.live_count += 1
+            self.id_to_pos[vec_id] = pos
+            self._ids[pos] = vec_id
+        else:
+            old_mask = int(self._topic_masks[pos])
+
+        self._is_from_pdf[pos] = bool(is_from_pdf)
+        self.rows[pos] = (question, answer, context, tags)
+        # Маску пишут при вставке; записям, до которых ещё не дошёл backfill_topic_masks, считаем её здесь
+        self._topic_masks[pos] = row_topic_mask(question, answer, context, tags) if topic_mask is None else topic_mask
+        self.shards.add(pos, int(self._topic_masks[pos]), old_mask)
+        self._valid[pos] = bool(text_to_compare)
+        return True
+
+    def _remove(self, vec_id) -> bool:
+        pos = self.id_to_pos.get(vec_id)
+        if pos is None:
+            return False
+        self._valid[pos] = False
+        self.shards.remove(int(self._topic_masks[pos]))
+        del self.id_to_pos[vec_id]
+        self.rows[pos] = None
+        self.live_count -= 1
+        return True
+
+
+def near_duplicate_groups(ids: np.ndarray, vectors: np.ndarray, threshold: float = 0.97,
+                          block_elements: int = 1 << 24) -> List[List[int]]:
+    """Группы id почти одинаковых записей: близость каждой записи группы к первой (идущей раньше в ids)
+    не ниже threshold. Одиночные записи не возвращаются. Векторы — L2-нормированные строки копии матрицы;
+    близости считаются блоками не больше block_elements чисел, чтобы память не росла как n²"""
+    assigned = np.zeros(len(ids), dtype=bool)
+    step = max(1, block_elements // max(len(ids), 1))
+    groups = []
+    for start in range(0, len(ids), step):
+        block = vectors[start:start + step] @ vectors.T
+        for offset, row in enumerate(block):
+            i = start + offset
+            if assigned[i]:
+                continue
+            members = np.nonzero(row[i + 1:] >= threshold)[0] + i + 1
+            members = members[~assigned[members]]
+            if len(members):
+                assigned[members] = True
+                groups.append([int(ids[i])] + [int(ids[j]) for j in members])
+    return groups
+
+
+def top_k_positions(scores: np.ndarray, positions: np.ndarray, k: int) -> np.ndarray:
+    """Позиции k лучших оценок из positions, отсортированные по убыванию"""
+    if len(positions) > k:
+        part = np.argpartition(-scores[positions], k - 1)[:k]
+        positions = positions[part]
+    return positions[np.argsort(-scores[positions], kind='stable')]
+
+
+def select_by_thresholds(scores: np.ndarray, threshold: float, top_k: int,
+                         min_threshold: Optional[float]) -> np.ndarray:
+    """Сначала top_k записей выше threshold, если таких нет — выше min_threshold"""
+    positions = np.nonzero(scores >= threshold)[0]
+    if not len(positions) and min_threshold is not None:
+        positions = np.nonzero(scores >= min_threshold)[0]
+    return top_k_positions(scores, positions, top_k)
+
+
+def select_hybrid(scores: np.ndarray, lexical_ranks: np.ndarray, threshold: float, top_k: int,
+                  min_threshold: Optional[float], rrf_k: int = 60) -> np.ndarray:
+    """Гибридный отбор: пороги те же, что в select_by_thresholds (threshold, а если выше него ничего нет —
+    min_threshold), но записям, найденным полнотекстовым поиском (lexical_ranks >= 0), всегда достаточно
+    min_threshold; порядок — reciprocal rank fusion рангов по близости и по BM25"""
+    lexical = lexical_ranks >= 0
+    if not lexical.any():
+        return select_by_thresholds(scores, threshold, top_k, min_threshold)
+    floor = threshold if min_threshold is None else min_threshold
+    passed = scores >= threshold
+    if not passed.any():
+        passed = scores >= floor
+    eligible = np.nonzero(passed | (lexical & (scores >= floor)))[0]
+    if not len(eligible):
+        return eligible
+    by_score = eligible[np.argsort(-scores[eligible], kind='stable')]
+    fused = 1.0 / (rrf_k + np.arange(1, len(by_score) + 1))
+    fused += np.where(lexical[by_score], 1.0 / (rrf_k + 1 + lexical_ranks[by_score]), 0.0)
+    return by_score[np.argsort(-fused, kind='stable')][:top_k]